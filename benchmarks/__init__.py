@@ -0,0 +1 @@
+"""Mass apk benchmarks against a simulated android device."""
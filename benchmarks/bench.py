@@ -0,0 +1,591 @@
+"""Benchmark mass apk against a simulated device.
+
+Each scenario runs in a fresh python process with `MASS_APK_ADB` pointing
+at the fake adb of a `SimulatedDevice`, so peak RSS is the one of that
+scenario alone. Results are saved as json and can be compared with the
+results of another version.
+
+    python -m benchmarks --packages 200 --latency 0.005 --output new.json
+    python -m benchmarks --compare old.json
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.simulator import DeviceConfig, SimulatedDevice
+
+__all__ = ["SCENARIOS", "run_benchmarks", "compare", "main"]
+
+MB = 1024 * 1024
+
+SCENARIOS = (
+    "map_apk_paths",
+    "backup",
+    "backup_archive",
+    "backup_stalls",
+    "zipify",
+    "unzipify",
+    "restore",
+    "restore_archive",
+    "store_deltas",
+    "startup",
+)
+
+# `python -m mass_apk --help` runs of the startup scenario
+STARTUP_RUNS = 10
+
+
+def _folder_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(folder, name))
+        for folder, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def _ensure_backup(workdir: str, device: SimulatedDevice) -> str:
+    """Return back up folder of the `backup` scenario, copy apks if missing."""
+    path = os.path.join(workdir, "backup")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        for package in device.package_names():
+            shutil.copyfile(
+                device.apk_path(package), os.path.join(path, f"{package}.apk")
+            )
+    return path
+
+
+def _ensure_archive(workdir: str, device: SimulatedDevice) -> str:
+    """Return archive of the `backup_archive` scenario, zip it if missing."""
+    from mass_apk.ziptools import zipify
+
+    path = os.path.join(workdir, "backup_archive.zip")
+    if not os.path.isfile(path):
+        zipify(_ensure_backup(workdir, device), path)
+    return path
+
+
+def _build_versions(path: str, size: int, seed: int) -> List[str]:
+    """Write two versions of a zip apk of about `size` bytes into `path`.
+
+    The update changes `classes.dex`, a quarter of the apk, native libs and
+    assets are the same bytes, like most app updates.
+    """
+    import random
+    import zipfile
+
+    rng = random.Random(seed)
+
+    def random_bytes(count: int) -> bytes:
+        return rng.getrandbits(count * 8).to_bytes(count, "little")
+
+    lib = random_bytes(max(size // 2, 1))
+    assets = random_bytes(max(size // 4, 1))
+    paths = []
+    for version in (1, 2):
+        apk = os.path.join(path, f"v{version}.apk")
+        with zipfile.ZipFile(apk, "w") as zip_file:
+            zip_file.writestr("AndroidManifest.xml", f"version {version}")
+            zip_file.writestr("classes.dex", random_bytes(max(size // 4, 1)))
+            zip_file.writestr("lib/arm64-v8a/libapp.so", lib)
+            zip_file.writestr("assets/data.bin", assets, zipfile.ZIP_DEFLATED)
+        paths.append(apk)
+    return paths
+
+
+def _run_cli(args: List[str]) -> None:
+    from mass_apk.cli import cli
+
+    try:
+        cli.main(args, standalone_mode=False)
+    except SystemExit as error:
+        if error.code:
+            raise RuntimeError(f"mass-apk {' '.join(args)} exited with {error.code}")
+
+
+def _map_apk_paths(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Discover apk paths of all packages with one batched shell call."""
+    from mass_apk.adb import Adb
+    from mass_apk.apk import map_apk_paths
+
+    def run() -> Dict[str, int]:
+        server = Adb()
+        paths = map_apk_paths(server.list_device("3"), "3", server=server)
+        server.close()
+        return {"packages": len(paths), "bytes": 0}
+
+    return run
+
+
+def _backup(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Back up the device into a folder, or a zip archive with `backup_archive`."""
+    dest = os.path.join(workdir, name)
+    archive = ["-a"] if name == "backup_archive" else []
+    for path in (dest, f"{dest}.zip"):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def run() -> Dict[str, int]:
+        # 0 jobs leaves parallelism to the adaptive limits
+        parallel = ["-j", str(jobs)] if jobs else []
+        _run_cli(["backup", dest, *parallel, *archive])
+        output = f"{dest}.zip" if archive else dest
+        return {"packages": device.config.packages, "bytes": _folder_bytes(output)}
+
+    return run
+
+
+def _backup_stalls(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Back up with pulls stalling at random, hung ones are killed and retried."""
+    dest = os.path.join(workdir, name)
+    shutil.rmtree(dest, ignore_errors=True)
+    # time a pull needs at the configured bandwidth, hung ones are killed
+    config = device.config
+    transfer = 1.5 * config.apk_size / config.bandwidth if config.bandwidth else 0
+    timeout = str(round(transfer + 2, 1))
+
+    def run() -> Dict[str, int]:
+        parallel = ["-j", str(jobs)] if jobs else []
+        os.environ["FAKE_ADB_STALL_RATE"] = "0.05"
+        try:
+            _run_cli(
+                ["--transfer-timeout", timeout, "backup", dest, "--keep-going"]
+                + parallel
+            )
+        except RuntimeError:
+            # apks stalling on every attempt are left out, count the others
+            pass
+        finally:
+            del os.environ["FAKE_ADB_STALL_RATE"]
+        pulled = [name for name in os.listdir(dest) if name.endswith(".apk")]
+        return {"packages": len(pulled), "bytes": _folder_bytes(dest)}
+
+    return run
+
+
+def _zipify(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Compress the back up folder into a zip archive."""
+    from mass_apk.ziptools import zipify
+
+    src = _ensure_backup(workdir, device)
+    dest = os.path.join(workdir, "zipify.zip")
+
+    def run() -> Dict[str, int]:
+        zipify(src, dest)
+        return {"packages": device.config.packages, "bytes": _folder_bytes(src)}
+
+    return run
+
+
+def _unzipify(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Extract the back up archive into a folder."""
+    from mass_apk.ziptools import unzipify
+
+    src = _ensure_archive(workdir, device)
+    dest = os.path.join(workdir, "unzipify")
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+
+    def run() -> Dict[str, int]:
+        unzipify(src, dest)
+        return {"packages": device.config.packages, "bytes": _folder_bytes(dest)}
+
+    return run
+
+
+def _restore(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Restore the back up folder, or the archive with `restore_archive`."""
+    if name == "restore":
+        src = _ensure_backup(workdir, device)
+    else:
+        src = _ensure_archive(workdir, device)
+    device.reset_counters()
+
+    def run() -> Dict[str, int]:
+        _run_cli(["restore", src, "-b", str(batch_size)])
+        counters = device.counters()
+        return {
+            "packages": counters["installs"],
+            "bytes": counters["installed_bytes"],
+        }
+
+    return run
+
+
+def _store_deltas(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Rebuild the older version of every package a compacted store keeps as a delta."""
+    from mass_apk.manifest import Manifest, ManifestEntry
+    from mass_apk.store import ApkStore
+
+    root = os.path.join(workdir, name)
+    shutil.rmtree(root, ignore_errors=True)
+    store = ApkStore(os.path.join(root, "store")).init()
+    # two back ups, the second one of an update of every package
+    backups: List[List[ManifestEntry]] = [[], []]
+    for index, package in enumerate(device.package_names()):
+        folder = os.path.join(root, package)
+        os.makedirs(folder)
+        versions = _build_versions(folder, device.config.apk_size, index)
+        for version, apk in enumerate(versions):
+            size = os.path.getsize(apk)
+            sha256 = store.add_file(apk, move=True)
+            file = f"{package}.apk"
+            backups[version].append(
+                ManifestEntry(package, version, "t", size, sha256, file)
+            )
+    for version, entries in enumerate(backups):
+        store.save_backup(f"v{version + 1}", Manifest(entries))
+        path = os.path.join(store.backups_dir, f"v{version + 1}.json")
+        os.utime(path, (version, version))
+    full_bytes = sum(size for _, size in store.iter_objects())
+    start = time.perf_counter()
+    store.compact()
+    compact_seconds = time.perf_counter() - start
+    stored_bytes = sum(size for _, size in store.iter_objects())
+
+    def run() -> Dict[str, Any]:
+        # rebuild every older version, the cost of restoring an old back up
+        rebuilt = 0
+        for entry in backups[0]:
+            with store.open_blob(entry.sha256) as in_file:
+                while True:
+                    data = in_file.read(MB)
+                    if not data:
+                        break
+                    rebuilt += len(data)
+        return {
+            "packages": len(backups[0]),
+            "bytes": rebuilt,
+            "compact_seconds": round(compact_seconds, 4),
+            "full_mb": round(full_bytes / MB, 2),
+            "stored_mb": round(stored_bytes / MB, 2),
+            "saved": round(1 - stored_bytes / full_bytes, 3),
+        }
+
+    return run
+
+
+def _startup(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Time `--help`, the start up cost of the command line."""
+    # interpreter start up alone is the baseline `--help` is compared to
+    interpreter = _median_run([sys.executable, "-c", "pass"])
+
+    def run() -> Dict[str, Any]:
+        help_run = _median_run([sys.executable, "-m", "mass_apk", "--help"])
+        return {
+            "packages": 0,
+            "bytes": 0,
+            "interpreter_ms": round(interpreter * 1000, 1),
+            "startup_ms": round(help_run * 1000, 1),
+            "overhead_ms": round((help_run - interpreter) * 1000, 1),
+        }
+
+    return run
+
+
+# scenario name to the function setting it up
+_SETUPS: Dict[str, Callable[..., Callable[[], Dict[str, Any]]]] = {
+    "map_apk_paths": _map_apk_paths,
+    "backup": _backup,
+    "backup_archive": _backup,
+    "backup_stalls": _backup_stalls,
+    "zipify": _zipify,
+    "unzipify": _unzipify,
+    "restore": _restore,
+    "restore_archive": _restore,
+    "store_deltas": _store_deltas,
+    "startup": _startup,
+}
+
+
+def _scenario(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Callable[[], Dict[str, Any]]:
+    """Return a callable running scenario `name`, untimed set up is done here.
+
+    The callable returns packages and bytes processed, other items it
+    returns are added to the scenario results.
+    """
+    if name not in _SETUPS:
+        raise ValueError(f"Unknown scenario {name}")
+    return _SETUPS[name](name, workdir, device, jobs, batch_size)
+
+
+def _median_run(args: List[str]) -> float:
+    """Return median seconds of `STARTUP_RUNS` runs of `args`."""
+    durations = []
+    for _ in range(STARTUP_RUNS):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2]
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario_here(
+    name: str, workdir: str, device_root: str, jobs: int, batch_size: int
+) -> Dict[str, Any]:
+    """Run scenario `name` in this process and return its measurements."""
+    with open(os.path.join(device_root, "config.json")) as in_file:
+        config = DeviceConfig(**json.load(in_file))
+    device = SimulatedDevice(device_root, config)
+    run = _scenario(name, workdir, device, jobs, batch_size)
+
+    spawns = device.counters()["spawns"]
+    error = None
+    start = time.perf_counter()
+    try:
+        done = run()
+    except BaseException as exc:  # report the failure, don't crash the suite
+        error = repr(exc)
+        done = {"packages": 0, "bytes": 0}
+    seconds = time.perf_counter() - start
+
+    return {
+        **done,
+        "scenario": name,
+        "seconds": round(seconds, 4),
+        "packages": done["packages"],
+        "bytes": done["bytes"],
+        "packages_per_sec": round(done["packages"] / seconds, 2),
+        "mb_per_sec": round(done["bytes"] / MB / seconds, 2),
+        "process_spawns": device.counters()["spawns"] - spawns,
+        "peak_rss_mb": _peak_rss_mb(),
+        "error": error,
+    }
+
+
+def _run_scenario_process(
+    name: str, workdir: str, device: SimulatedDevice, jobs: int, batch_size: int
+) -> Dict[str, Any]:
+    result_path = os.path.join(workdir, f"{name}.result.json")
+    env = dict(os.environ, MASS_APK_ADB=device.adb_path)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks",
+            "--run-scenario",
+            name,
+            "--workdir",
+            workdir,
+            "--device-root",
+            device.root,
+            "--jobs",
+            str(jobs),
+            "--batch-size",
+            str(batch_size),
+            "--output",
+            result_path,
+        ],
+        env=env,
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    with open(result_path) as in_file:
+        return json.load(in_file)
+
+
+def run_benchmarks(
+    config: DeviceConfig,
+    scenarios: List[str],
+    jobs: int = 4,
+    batch_size: int = 16,
+    repeat: int = 1,
+    workdir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Run `scenarios` against a device simulated from `config`.
+
+    Each scenario runs `repeat` times, the fastest run is reported.
+    """
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="mass-apk-bench-")
+    try:
+        device = SimulatedDevice(os.path.join(workdir, "device"), config).create()
+        results = []
+        for name in scenarios:
+            runs = [
+                _run_scenario_process(name, workdir, device, jobs, batch_size)
+                for _ in range(repeat)
+            ]
+            results.append(min(runs, key=lambda result: result["seconds"]))
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    from mass_apk import __version__
+
+    return {
+        "mass_apk_version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": dict(config._asdict(), jobs=jobs, batch_size=batch_size),
+        "results": results,
+    }
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.1
+) -> List[str]:
+    """Return names of scenarios more than `tolerance` slower than `baseline`."""
+    before = {result["scenario"]: result for result in baseline["results"]}
+    regressions = []
+    print(f"{'scenario':<16} {'baseline s':>10} {'current s':>10} {'change':>8}")
+    for result in current["results"]:
+        old = before.get(result["scenario"])
+        if old is None or not old["seconds"]:
+            continue
+        if result["error"] and not old["error"]:
+            print(f"{result['scenario']:<16} failed {result['error']}")
+            regressions.append(result["scenario"])
+            continue
+        change = result["seconds"] / old["seconds"] - 1
+        print(
+            f"{result['scenario']:<16} {old['seconds']:>10.3f} "
+            f"{result['seconds']:>10.3f} {change:>+8.1%}"
+        )
+        if change > tolerance:
+            regressions.append(result["scenario"])
+    return regressions
+
+
+def _print_results(report: Dict[str, Any]) -> None:
+    print(
+        f"{'scenario':<16} {'seconds':>8} {'pkg/s':>8} {'MB/s':>8} "
+        f"{'spawns':>7} {'rss MB':>7}  error"
+    )
+    for result in report["results"]:
+        rss = result["peak_rss_mb"]
+        print(
+            f"{result['scenario']:<16} {result['seconds']:>8.3f} "
+            f"{result['packages_per_sec']:>8.1f} {result['mb_per_sec']:>8.1f} "
+            f"{result['process_spawns']:>7} "
+            f"{rss if rss is None else round(rss, 1)!s:>7}  {result['error'] or ''}"
+        )
+
+
+def _size(value: str) -> int:
+    """Parse sizes like `512K`, `2M` or `1G`."""
+    units = {"K": 1024, "M": MB, "G": 1024 * MB}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument("--packages", type=int, default=100)
+    parser.add_argument("--apk-size", type=_size, default="1M", help="e.g. 512K, 2M")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per adb command"
+    )
+    parser.add_argument(
+        "--bandwidth", type=_size, default="0", help="bytes/s, 0 is unlimited"
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="concurrent pulls, 0 adapts them"
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS), help="comma separated"
+    )
+    parser.add_argument("--workdir", help="keep generated files in this folder")
+    parser.add_argument("--output", help="save results as json")
+    parser.add_argument("--compare", help="json results of a baseline run")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    # internal, runs a single scenario in this process
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--device-root", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_scenario:
+        result = run_scenario_here(
+            args.run_scenario,
+            args.workdir,
+            args.device_root,
+            args.jobs,
+            args.batch_size,
+        )
+        with open(args.output, "w") as out_file:
+            json.dump(result, out_file)
+        return 0
+
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios {', '.join(sorted(unknown))}")
+
+    config = DeviceConfig(
+        packages=args.packages,
+        apk_size=args.apk_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        args.workdir = os.path.abspath(args.workdir)
+    report = run_benchmarks(
+        config, scenarios, args.jobs, args.batch_size, args.repeat, args.workdir
+    )
+    _print_results(report)
+
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as in_file:
+            regressions = compare(json.load(in_file), report, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
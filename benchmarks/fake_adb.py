@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""Fake adb executable serving the simulated device of `FAKE_ADB_ROOT`.
+
+Implements the adb commands mass apk uses, `start-server`, `kill-server`,
+`get-state`, `devices`, `track-devices`, `shell`, `pull`, `install` and
+`exec-in`. Every run is counted in `spawns.log`, every install in
+`installs.log`. `FAKE_ADB_STALL_RATE` of the environment is the fraction
+of pulls hanging until they are killed, like on a flaky cable.
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+CHUNK = 64 * 1024
+
+
+def _copy(in_file, out_file, bandwidth):
+    """Copy `in_file` into `out_file` at most `bandwidth` bytes/s."""
+    start = time.monotonic()
+    copied = 0
+    while True:
+        chunk = in_file.read(CHUNK)
+        if not chunk:
+            return copied
+        if out_file is not None:
+            out_file.write(chunk)
+        copied += len(chunk)
+        if bandwidth:
+            delay = copied / bandwidth - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _append(root, name, data):
+    # O_APPEND writes of concurrent fake adb processes don't interleave
+    fd = os.open(os.path.join(root, name), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, data.encode())
+    finally:
+        os.close(fd)
+
+
+def _get_state(root, config, args, failed):
+    print("device")
+    return 0
+
+
+def _devices(root, config, args, failed):
+    print("List of devices attached")
+    print(f"{config['serial']}\tdevice")
+    return 0
+
+
+def _track_devices(root, config, args, failed):
+    # the device stays attached until the client goes away
+    table = f"{config['serial']}\tdevice\n"
+    sys.stdout.write(f"{len(table):04x}{table}")
+    sys.stdout.flush()
+    while True:
+        time.sleep(3600)
+
+
+def _shell(root, config, args, failed):
+    if args[:1] == ["-T"]:
+        args = args[1:]
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(root, "bin") + os.pathsep + env.get("PATH", "")
+    if not args:
+        os.execvpe("sh", ["sh"], env)
+    return subprocess.call(["sh", "-c", " ".join(args)], env=env)
+
+
+def _pull(root, config, args, failed):
+    src, dest = args[-2:]
+    if random.random() < float(os.environ.get("FAKE_ADB_STALL_RATE", 0)):
+        time.sleep(3600)
+    if failed:
+        print(f"adb: error: failed to copy '{src}': simulated", file=sys.stderr)
+        return 1
+    with open(src, "rb") as in_file, open(dest, "wb") as out_file:
+        size = _copy(in_file, out_file, config["bandwidth"])
+    print(f"{src}: 1 file pulled. ({size} bytes)")
+    return 0
+
+
+def _install(root, config, args, failed):
+    with open(args[-1], "rb") as in_file:
+        size = _copy(in_file, None, config["bandwidth"])
+    if failed:
+        print("Failure [INSTALL_FAILED_SIMULATED]")
+        return 1
+    _append(root, "installs.log", f"{os.path.basename(args[-1])} {size}\n")
+    print("Success")
+    return 0
+
+
+def _exec_in(root, config, args, failed):
+    cmd = " ".join(args)
+    size = _copy(sys.stdin.buffer, None, config["bandwidth"])
+    if failed:
+        print("Failure [INSTALL_FAILED_SIMULATED]")
+    elif cmd.startswith("cmd package install"):
+        # apks written to a session count as installed, commits don't fail
+        _append(root, "installs.log", f"stream {size}\n")
+        print(f"Success: streamed {size} bytes")
+    else:
+        print(f"Unknown command {cmd}")
+    return 0
+
+
+# commands reaching the device, called with the arguments following them
+_COMMANDS = {
+    "get-state": _get_state,
+    "devices": _devices,
+    "track-devices": _track_devices,
+    "shell": _shell,
+    "pull": _pull,
+    "install": _install,
+    "exec-in": _exec_in,
+}
+
+
+def main(argv):
+    root = os.environ["FAKE_ADB_ROOT"]
+    with open(os.path.join(root, "config.json")) as in_file:
+        config = json.load(in_file)
+    _append(root, "spawns.log", "x")
+
+    args = list(argv)
+    if args[:1] == ["-s"]:
+        if args[1:2] != [config["serial"]]:
+            print(f"error: device '{args[1:2]}' not found", file=sys.stderr)
+            return 1
+        args = args[2:]
+    if not args:
+        print("usage: adb [-s SERIAL] COMMAND ...", file=sys.stderr)
+        return 1
+
+    command, args = args[0], args[1:]
+    if command in ("start-server", "kill-server", "version"):
+        return 0
+
+    # round trip to the device
+    time.sleep(config["latency"])
+    failed = random.random() < config["failure_rate"]
+
+    handler = _COMMANDS.get(command)
+    if handler is None:
+        print(f"adb: unknown command {command}", file=sys.stderr)
+        return 1
+    return handler(root, config, args, failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,158 @@
+"""Simulated android device served by the fake adb executable.
+
+The device is a folder on local disk, apks are real files under
+`device/data/app` and device paths reported by `pm` are their absolute
+local paths, so shell scripts, globs and `sha256sum` run unmodified by
+a local `sh`. Device tools, `pm`, `dumpsys` and `cmd`, are small shell
+scripts in `bin/` answering from files generated with the device.
+
+    root/
+        config.json
+        bin/pm bin/dumpsys bin/cmd bin/adb
+        device/data/app/com.bench.app0001-1/base.apk
+        pm_list.txt pm_list_f.txt dumpsys.txt
+        spawns.log installs.log
+"""
+
+from typing import Dict, List
+import collections
+import json
+import os
+import random
+import stat
+import sys
+
+__all__ = ["DeviceConfig", "SimulatedDevice"]
+
+FAKE_ADB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_adb.py")
+
+# `latency` seconds are spent per adb command and per device tool run,
+# `bandwidth` bytes/s caps pulls and installs, 0 means unlimited
+DeviceConfig = collections.namedtuple(
+    "DeviceConfig",
+    "packages apk_size latency bandwidth failure_rate seed serial",
+    defaults=(100, 1024 * 1024, 0.0, 0, 0.0, 1, "bench-0001"),
+)
+
+_PM = """#!/bin/sh
+sleep {latency}
+case "$1 $2" in
+    "list packages")
+        case " $* " in
+            *" -f "*) cat "{root}/pm_list_f.txt" ;;
+            *) cat "{root}/pm_list.txt" ;;
+        esac ;;
+    "path "*) grep -e "=$2\\$" "{root}/pm_list_f.txt" | sed 's/=[^=]*$//' ;;
+    *) echo "Unknown command $*" >&2; exit 1 ;;
+esac
+"""
+
+_DUMPSYS = """#!/bin/sh
+sleep {latency}
+cat "{root}/dumpsys.txt"
+"""
+
+_CMD = """#!/bin/sh
+sleep {latency}
+case "$2" in
+    install-create) echo "Success: created install session [$$]" ;;
+    install-add-session|install-commit|install-abandon) echo "Success" ;;
+    *) echo "Unknown command $*" >&2; exit 1 ;;
+esac
+"""
+
+# run the fake adb with the interpreter running the benchmarks
+_ADB = """#!/bin/sh
+FAKE_ADB_ROOT="{root}" exec "{python}" "{fake_adb}" "$@"
+"""
+
+
+class SimulatedDevice(object):
+    """Device folder generated from a `DeviceConfig`."""
+
+    def __init__(self, root: str, config: DeviceConfig):
+        self.root = os.path.abspath(root)
+        self.config = config
+        self.adb_path = os.path.join(self.root, "bin", "adb")
+        self.apps_dir = os.path.join(self.root, "device", "data", "app")
+
+    def package_names(self) -> List[str]:
+        """Return names of installed packages."""
+        return [f"com.bench.app{index:04d}" for index in range(self.config.packages)]
+
+    def apk_path(self, package: str) -> str:
+        """Return device path of the base apk of `package`."""
+        return os.path.join(self.apps_dir, f"{package}-1", "base.apk")
+
+    def create(self) -> "SimulatedDevice":
+        """Generate apks, device tool scripts and the fake adb."""
+        os.makedirs(os.path.join(self.root, "bin"), exist_ok=True)
+        with open(os.path.join(self.root, "config.json"), "w") as out_file:
+            json.dump(self.config._asdict(), out_file)
+
+        rng = random.Random(self.config.seed)
+        packages = self.package_names()
+        for package in packages:
+            # sizes vary around the configured size, content doesn't compress
+            size = max(int(self.config.apk_size * rng.uniform(0.5, 1.5)), 1)
+            path = self.apk_path(package)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as out_file:
+                out_file.write(rng.getrandbits(size * 8).to_bytes(size, "little"))
+
+        self._write("pm_list.txt", "".join(f"package:{p}\n" for p in packages))
+        self._write(
+            "pm_list_f.txt",
+            "".join(f"package:{self.apk_path(p)}={p}\n" for p in packages),
+        )
+        self._write("dumpsys.txt", self._dumpsys(packages))
+
+        scripts = {"pm": _PM, "dumpsys": _DUMPSYS, "cmd": _CMD, "adb": _ADB}
+        for name, template in scripts.items():
+            path = os.path.join(self.root, "bin", name)
+            self._write(
+                path,
+                template.format(
+                    root=self.root,
+                    latency=self.config.latency,
+                    python=sys.executable,
+                    fake_adb=FAKE_ADB,
+                ),
+            )
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+        self.reset_counters()
+        return self
+
+    def _dumpsys(self, packages: List[str]) -> str:
+        lines = ["Packages:"]
+        for package in packages:
+            lines += [
+                f"  Package [{package}] (5a2bc31):",
+                f"    codePath={os.path.dirname(self.apk_path(package))}",
+                "    versionCode=1 minSdk=21 targetSdk=30",
+                "    lastUpdateTime=2021-02-13 10:21:07",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def _write(self, name: str, content: str) -> None:
+        with open(os.path.join(self.root, name), "w") as out_file:
+            out_file.write(content)
+
+    def reset_counters(self) -> None:
+        """Forget adb spawns and installs recorded so far."""
+        for name in ("spawns.log", "installs.log"):
+            open(os.path.join(self.root, name), "w").close()
+
+    def counters(self) -> Dict[str, int]:
+        """Return adb spawns, installed apks and installed bytes."""
+        spawns = os.path.getsize(os.path.join(self.root, "spawns.log"))
+        installs, installed_bytes = 0, 0
+        with open(os.path.join(self.root, "installs.log")) as in_file:
+            for line in in_file:
+                installs += 1
+                installed_bytes += int(line.split()[-1])
+        return {
+            "spawns": spawns,
+            "installs": installs,
+            "installed_bytes": installed_bytes,
+        }
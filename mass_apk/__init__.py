@@ -31,7 +31,7 @@ Automate back up of android devices
  ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
- """
+"""
 
 __title__ = "mass-apk"
 __version__ = "0.3.1"
@@ -41,36 +41,82 @@ __license__ = "MIT"
 import logging
 import os
 import sys
+import types
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional, TextIO
 
 
-def init_logging(level: int = logging.INFO) -> logging.Logger:
+def init_logging(
+    level: int = logging.INFO, stream: Optional[TextIO] = None
+) -> logging.Logger:
     """Configure logging in mass apk package.
 
-    Create a module wide logger instance.
+    Log records of the package are printed on `stream`, stdout by default,
+    calling it again doesn't add another handler but moves it to `stream`.
+    Importing the package configures nothing, the command line calls it
+    before running a command.
     """
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(
-        logging.Formatter(fmt="%(name)-17s :: %(levelname)-7s - %(message)s")
-    )
     _logger = logging.getLogger(__name__)
     _logger.setLevel(level)
-    _logger.addHandler(handler)
+    handlers = [
+        item
+        for item in _logger.handlers
+        if isinstance(item, logging.StreamHandler) and getattr(item, "_mass_apk", False)
+    ]
+    if handlers and stream is not None:
+        handlers[0].setStream(stream)
+    elif not handlers:
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(
+            logging.Formatter(fmt="%(name)-17s :: %(levelname)-7s - %(message)s")
+        )
+        handler._mass_apk = True  # type: ignore[attr-defined]
+        _logger.addHandler(handler)
 
     return _logger
 
 
-logger = init_logging()
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
 
 pkg_root = Path(os.path.abspath(__file__)).parent
 
 
-# make platform variable available during import time
 from .helpers import detect_platform  # noqa: E402
 
-runtime_platform = detect_platform()
+if TYPE_CHECKING:
+    from .adb import Adb
 
-from .adb import Adb  # noqa: E402
+# created by `__getattr__` on first use
+adb: "Adb"
 
-adb = Adb()
+
+def __getattr__(name: str):
+    # platform is detected when first asked for, not during import
+    if name == "runtime_platform":
+        return detect_platform()
+    # package wide adb interface, created on first use, creating it doesn't
+    # touch adb nor the device, the executable is resolved on first use too
+    if name == "adb":
+        from .adb import Adb
+
+        globals()["adb"] = Adb()
+        return globals()["adb"]
+    if name == "Adb":
+        from .adb import Adb
+
+        return Adb
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name: str, value) -> None:
+        # importing the `adb` submodule binds it on the package, `adb` of the
+        # package stays the adb interface
+        if name == "adb" and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,251 @@
+"""Adapt transfers in flight to what devices and usb buses sustain.
+
+Fixed parallelism fits no setup: a usb 2 hub saturates at 2 or 3 pulls,
+a usb 3 port takes many more and installs are bound by the device cpu.
+Every device and every usb bus gets an `AdaptiveLimit` per kind of
+operation, which measures throughput of the operations completed in a
+window and adjusts how many may be in flight, AIMD style,
+
+    throughput grew                             limit + 1
+    throughput flat after an increase           limit - 1
+    operation timed out or lost the connection, limit / 2
+    took over the target, throughput collapsed
+
+An operation holds a slot of its device and of its bus while it runs.
+Installs of a device run one at a time, they only hold a slot of the bus
+shared with installs to other devices.
+
+    with limits.slot(server, "pull") as measurement:
+        measurement.bytes = server.pull(path, dest)
+"""
+
+from typing import Callable, Dict, Iterator, Optional
+import contextlib
+import logging
+import threading
+import time
+
+from mass_apk.adb import Adb, AdbError
+from mass_apk.helpers import MB
+from mass_apk.metrics import Measurement, metrics
+from mass_apk.retry import is_transient
+
+__all__ = ["AdaptiveLimit", "AdaptiveLimits", "DEFAULT_MAXIMUM", "limits"]
+
+log = logging.getLogger(__name__)
+
+# most operations of a device or bus in flight
+DEFAULT_MAXIMUM = 16
+INITIAL_LIMIT = 2
+# fewest operations completed per window, throughput of less is noise
+MIN_WINDOW = 8
+# throughput increase worth the slot added, decrease cutting the limit
+GAIN = 0.05
+LOSS = 0.25
+# seconds an operation may take, well under adb and install timeouts
+LATENCY_TARGET = 60.0
+# flat windows after which one more slot is probed again
+PROBE_WINDOWS = 8
+
+
+class AdaptiveLimit(object):
+    """Number of operations allowed in flight, adjusted to measured throughput.
+
+    The limit starts at `initial` and stays between 1 and `maximum`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = INITIAL_LIMIT,
+        maximum: int = DEFAULT_MAXIMUM,
+        latency_target: float = LATENCY_TARGET,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.maximum = max(maximum, 1)
+        self.limit = min(max(initial, 1), self.maximum)
+        self.in_flight = 0
+        self._latency_target = latency_target
+        self._clock = clock
+        self._cond = threading.Condition()
+        # throughput of the previous window and whether the limit grew after
+        # it, after a decrease the next window only measures the new baseline
+        self._rate: Optional[float] = None
+        self._grew = False
+        self._shrank = False
+        # the window after a change still completes operations started
+        # under the old limit, it isn't measured
+        self._warming = False
+        self._flat = 0
+        self._start_window(clock())
+        metrics.set_gauge("concurrency_limit", name, self.limit)
+
+    def _start_window(self, now: float) -> None:
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_ops = 0
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[Measurement]:
+        """Wait for a free slot and hold it for the `with` block.
+
+        Set `bytes` of the measurement to the bytes the operation moved.
+        """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        measurement = Measurement()
+        start = self._clock()
+        error = False
+        try:
+            yield measurement
+        except BaseException as exc:
+            # an apk the package manager rejects or a missing path moved its
+            # bytes fine, too many operations in flight show as timeouts and
+            # broken connections
+            error = is_transient(exc)
+            raise
+        finally:
+            self._complete(measurement.bytes, self._clock() - start, error)
+
+    def _complete(self, size: int, seconds: float, error: bool) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._window_bytes += size
+            self._window_ops += 1
+            if error:
+                self._set(self.limit // 2, "operation failed")
+            elif seconds > self._latency_target:
+                self._set(self.limit // 2, f"operation took {seconds:.1f}s")
+            elif self._window_ops >= max(2 * self.limit, MIN_WINDOW):
+                self._evaluate()
+            self._cond.notify_all()
+
+    def _evaluate(self) -> None:
+        now = self._clock()
+        elapsed = now - self._window_start
+        if elapsed <= 0:
+            return
+        if self._warming:
+            self._warming = False
+            self._start_window(now)
+            return
+        rate = self._window_bytes / elapsed
+        previous, self._rate = self._rate, rate
+        grew, shrank = self._grew, self._shrank
+        self._grew = self._shrank = False
+        if shrank:
+            pass
+        elif previous is None or rate >= previous * (1 + GAIN):
+            self._flat = 0
+            self._grew = self._set(self.limit + 1, "throughput grew", rate)
+        elif rate < previous * (1 - LOSS):
+            self._flat = 0
+            self._set(self.limit // 2, "throughput collapsed", rate)
+        elif grew:
+            # the slot added last didn't pay
+            self._set(self.limit - 1, "throughput flat", rate)
+        else:
+            self._flat += 1
+            if self._flat >= PROBE_WINDOWS:
+                self._flat = 0
+                self._grew = self._set(self.limit + 1, "probing", rate)
+        self._start_window(now)
+
+    def _set(self, limit: int, reason: str, rate: Optional[float] = None) -> bool:
+        """Change the limit, return True if it changed.
+
+        Without `rate` the change reacts to a single operation, measuring
+        starts over so it doesn't weigh on the next window.
+        """
+        limit = min(max(limit, 1), self.maximum)
+        changed = limit != self.limit
+        if changed:
+            speed = f" at {rate / MB:.2f} MB/s" if rate is not None else ""
+            log.info(
+                "%s concurrency %s -> %s, %s%s",
+                self.name,
+                self.limit,
+                limit,
+                reason,
+                speed,
+            )
+            self._shrank = limit < self.limit
+            self._warming = True
+            self.limit = limit
+            metrics.set_gauge("concurrency_limit", self.name, limit)
+        if rate is None:
+            self._rate = None
+            self._grew = False
+            self._flat = 0
+            self._start_window(self._clock())
+        return changed
+
+
+class AdaptiveLimits(object):
+    """`AdaptiveLimit` of every device and usb bus of the process."""
+
+    def __init__(self, maximum: int = DEFAULT_MAXIMUM):
+        self.maximum = maximum
+        self._limits: Dict[str, AdaptiveLimit] = {}
+        self._buses: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self._bus_lock = threading.Lock()
+
+    def get(self, name: str) -> AdaptiveLimit:
+        """Return limit `name`, created on first use."""
+        with self._lock:
+            limit = self._limits.get(name)
+            if limit is None:
+                limit = self._limits[name] = AdaptiveLimit(name, maximum=self.maximum)
+            return limit
+
+    def bus(self, server: Adb) -> Optional[str]:
+        """Return usb bus of the device behind `server`, None if unknown."""
+        label = server.device_label
+        # transfers starting together look the bus up once
+        with self._bus_lock:
+            if label in self._buses:
+                return self._buses[label]
+            try:
+                buses = server.usb_buses()
+            except AdbError as error:
+                log.debug("Can't find usb bus of %s %r", label, error)
+                buses = {}
+            if server.serial is not None:
+                bus = buses.get(server.serial)
+            else:
+                # adb picks the only device
+                bus = next(iter(buses.values())) if len(buses) == 1 else None
+            self._buses[label] = bus
+            return bus
+
+    @contextlib.contextmanager
+    def slot(
+        self, server: Adb, kind: str, device: bool = True
+    ) -> Iterator[Measurement]:
+        """Hold a `kind` operation slot of the device and its bus, e.g. `pull`.
+
+        Without `device` only the slot of the bus is held, for operations
+        a device runs one at a time.
+        """
+        bus = self.bus(server)
+        measurement = Measurement()
+        with contextlib.ExitStack() as stack:
+            held = []
+            if device:
+                limit = self.get(f"{kind} {server.device_label}")
+                held.append(stack.enter_context(limit.slot()))
+            if bus is not None:
+                held.append(stack.enter_context(self.get(f"{kind} {bus}").slot()))
+            try:
+                yield measurement
+            finally:
+                for slot in held:
+                    slot.bytes = measurement.bytes
+
+
+# limits of the running process, a daemon keeps what it learned between jobs
+limits = AdaptiveLimits()
@@ -1,16 +1,34 @@
 """Interface to ADB server."""
 
-
-from typing import List, Union
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+import collections
+import contextlib
 import logging
 import os
 from pathlib import Path
+import shlex
+import signal
 import subprocess
 from enum import Enum, unique
 
-from mass_apk import pkg_root, runtime_platform
-from mass_apk.exceptions import MassApkError
-from mass_apk.helpers import Platform
+from mass_apk import pkg_root
+from mass_apk.exceptions import MassApkError, TransportError
+from mass_apk.helpers import Platform, Watchdog, detect_platform
+from mass_apk.metrics import metrics
+from mass_apk.shell import ShellError, ShellPool, ShellSession, ShellTimeoutError
+
+if TYPE_CHECKING:
+    from mass_apk.transport import SocketTransport
 
 
 log = logging.getLogger(__name__)
@@ -20,10 +38,92 @@ class AdbError(MassApkError):
     """Exception raised when interacting with adb executable."""
 
 
+def parse_devices(output: str) -> Dict[str, str]:
+    """Map serials to states of devices listed by adb-server.
+
+    adb lists devices one per line in the form
+    emulator-5554\tdevice
+    """
+    devices = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            devices[fields[0]] = fields[1]
+    return devices
+
+
+def parse_usb_buses(output: str) -> Dict[str, str]:
+    """Map serials of devices listed by `adb devices -l` to their usb bus.
+
+    Devices are listed in the form
+    0123456789ABCDEF\tdevice usb:1-1.2 product:x model:y device:z
+    where `usb:` is the bus number followed by the port path. Devices not
+    attached over usb, e.g. emulators, are left out.
+    """
+    buses = {}
+    for line in output.splitlines():
+        fields = line.split()
+        for field in fields[2:]:
+            if field.startswith("usb:"):
+                buses[fields[0]] = "usb:" + field[len("usb:") :].split("-", 1)[0]
+    return buses
+
+
+def parse_packages(output: str) -> List[str]:
+    """Return package names listed by `pm list packages`."""
+    # adb returns packages name in the form
+    # package:com.skype.raider
+    # we need to strip "package:" prefix
+    return [
+        line.split(":", maxsplit=1)[1].strip()
+        for line in output.splitlines()
+        if line.startswith("package:")
+    ]
+
+
+def parse_package_versions(output: str) -> Dict[str, Optional[int]]:
+    """Map packages listed by `pm list packages --show-versioncode` to versionCode.
+
+    Packages are listed in the form
+    package:com.skype.raider versionCode:1234
+    pm of android before 9 omits the versionCode, such packages map to None.
+    """
+    versions: Dict[str, Optional[int]] = {}
+    for line in output.splitlines():
+        if not line.startswith("package:"):
+            continue
+        package, _, version = line[len("package:") :].partition(" versionCode:")
+        version = version.strip()
+        versions[package.strip()] = int(version) if version.isdigit() else None
+    return versions
+
+
+class AdbTimeoutError(AdbError):
+    """Exception raised when an adb command doesn't complete in time."""
+
+
 class AdbApkExists(AdbError):
     """Exception raised when apk exist in the device."""
 
 
+# seconds after which adb commands are killed, `transfer` applies to pulls,
+# installs and commands whose run time grows with the apks, `command` to
+# the others, None waits forever. The socket backend drops connections
+# without data for `transfer` seconds.
+Timeouts = collections.namedtuple(
+    "Timeouts", "command transfer", defaults=(60.0, 600.0)
+)
+
+
+def _kill(process: subprocess.Popen) -> None:
+    """Kill `process` along with the processes of its session, e.g. a shell's."""
+    if os.name == "posix":
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+    else:
+        process.kill()
+
+
 class Adb(object):
     """Interface to adb server."""
 
@@ -34,9 +134,30 @@ class Adb(object):
         CONNECTED = True
         DISCONNECTED = False
 
+    @unique
+    class Backend(Enum):
+        """Define how commands reach adb-server.
+
+        `PROCESS` spawns the adb executable, `SOCKET` talks the adb-server
+        host protocol directly over TCP.
+        """
+
+        PROCESS = "process"
+        SOCKET = "socket"
+
     @classmethod
     def _get_adb_path(cls) -> os.PathLike:
-        """Return adb path based on operating system detected during import."""
+        """Return adb path based on the operating system, detected on first use.
+
+        Called when `path` is first accessed, not when the module is
+        imported. `MASS_APK_ADB` environment variable overrides the bundled
+        adb, e.g. to use the one of an installed Android SDK.
+        """
+        override = os.environ.get("MASS_APK_ADB")
+        if override:
+            return Path(override)
+
+        runtime_platform = detect_platform()
         if runtime_platform == Platform.OSX:
             path = os.path.join(pkg_root, "bin", "osx", "adb")
         elif runtime_platform == Platform.WIN:
@@ -48,9 +169,43 @@ class Adb(object):
 
         return Path(path)
 
-    def __init__(self, auto_start: bool = False):
-        self._path = self._get_adb_path()
+    def __init__(
+        self,
+        auto_start: bool = False,
+        shell_sessions: int = 4,
+        backend: Union[Backend, str] = Backend.PROCESS,
+        serial: Optional[str] = None,
+        timeouts: Optional[Timeouts] = None,
+    ):
+        """Create adb interface.
+
+        Up to `shell_sessions` persistent `adb shell` sessions are kept open
+        to run device shell commands, set it to zero to always spawn a new
+        adb process per command.
+
+        With `SOCKET` backend device shell commands, state, pulls and
+        installs go through adb-server socket connections, the adb executable
+        is only used to start and stop the server.
+
+        Commands target the device with `serial`, when `serial` is None
+        adb requires exactly one device to be attached.
+
+        Commands running over `timeouts` are killed and raise
+        `AdbTimeoutError`.
+        """
+        self._path: Optional[os.PathLike] = None
+        self._serial = serial
+        self._timeouts = timeouts or Timeouts()
         self._state = self.__class__.ConnectionState.DISCONNECTED
+        self._backend = self.__class__.Backend(backend)
+        self._transport: Optional["SocketTransport"] = None
+        if self._backend is self.__class__.Backend.SOCKET:
+            # socket client loads only with the socket backend
+            from mass_apk.transport import get_transport
+
+            self._transport = get_transport(serial, timeout=self._timeouts.transfer)
+        self._shells = ShellPool(self._open_shell, shell_sessions)
+        self._shells_enabled = shell_sessions > 0
         if auto_start:
             self.start_server()
 
@@ -66,10 +221,41 @@ class Adb(object):
     #     self.stop_server()
 
     @property
-    def path(self):
-        """Get access to detected adb path."""
+    def path(self) -> os.PathLike:
+        """Get access to detected adb path, resolved on first access."""
+        if self._path is None:
+            self._path = self._get_adb_path()
         return self._path
 
+    @property
+    def serial(self) -> Optional[str]:
+        """Get serial of the device targeted by this instance."""
+        return self._serial
+
+    @property
+    def device_label(self) -> str:
+        """Get serial of targeted device, `default` when adb picks it."""
+        return self._serial or "default"
+
+    @property
+    def timeouts(self) -> Timeouts:
+        """Get seconds after which commands are killed."""
+        return self._timeouts
+
+    def for_device(self, serial: str) -> "Adb":
+        """Return an `Adb` instance with the same settings targeting `serial`."""
+        return self.__class__(
+            shell_sessions=self._shells.size,
+            backend=self._backend,
+            serial=serial,
+            timeouts=self._timeouts,
+        )
+
+    @property
+    def backend(self) -> Backend:
+        """Get backend used to reach adb-server."""
+        return self._backend
+
     @property
     def state(self) -> ConnectionState:
         """
@@ -81,6 +267,16 @@ class Adb(object):
 
     def _update_state(self) -> ConnectionState:
         """Check if android device got connected to adb-server via cable."""
+        if self._transport is not None:
+            try:
+                state = self._transport.get_state()
+            except (TransportError, OSError) as error:
+                log.warning("Get state failed %r", error)
+                state = ""
+            if state == "device":
+                self._state = self.__class__.ConnectionState.CONNECTED
+            return self._state
+
         command_output = self.exec_command(
             "get-state", return_stdout=True, silence_errors=True
         )
@@ -99,28 +295,50 @@ class Adb(object):
     def stop_server(self):
         """Kill adb server."""
         log.info("Killing adb server...")
+        self.close()
         self.exec_command("kill-server")
 
+    def close(self):
+        """Close persistent shell sessions and pooled connections."""
+        self._shells.close()
+        if self._transport is not None:
+            self._transport.close()
+
     def exec_command(
-        self, cmd, return_stdout=False, case_sensitive=False, silence_errors=False
+        self,
+        cmd: Union[str, Sequence[str]],
+        return_stdout=False,
+        case_sensitive=False,
+        silence_errors=False,
+        timeout: Optional[float] = None,
     ) -> Union[str, None]:
         """Low level function to send command to running adb-server process.
 
+        A string `cmd` is appended to the adb command line run by the
+        shell, a sequence is passed to adb as its arguments, without a
+        shell quoting of paths doesn't depend on the platform. The command
+        is killed after `timeout` seconds, the command timeout by default.
+
+        :raises AdbTimeoutError if the command doesn't complete in time.
         :raises AdbError if executed command returns non-zero exit code and
         command output is empty string.
         """
-        cmd = f"{self._path} {cmd}"
+        if isinstance(cmd, str):
+            serial = f"-s {shlex.quote(self._serial)} " if self._serial else ""
+            cmd = f"{self.path} {serial}{cmd}"
+        else:
+            serial_args = ["-s", self._serial] if self._serial else []
+            cmd = [str(self.path), *serial_args, *cmd]
         log.debug("Executing %s", cmd)
-        return_code, output = subprocess.getstatusoutput(cmd)
+        with metrics.measure("exec_command", self.device_label):
+            return_code, output = self._run(cmd, timeout or self._timeouts.command)
 
         if return_code:
             if silence_errors:
                 log.warning("Command %s returned %s >>>%s", cmd, return_code, output)
                 return ""
 
-            log.error(
-                    "Command %s returned %s >>>%s", cmd, return_code, output
-                )
+            log.error("Command %s returned %s >>>%s", cmd, return_code, output)
             raise AdbError(f"Command returned error code {cmd} {output}")
 
         if return_stdout:
@@ -128,7 +346,165 @@ class Adb(object):
 
         return None
 
-    def push(self, source_path, ignore_errors=True) -> None:
+    @staticmethod
+    def _run(
+        cmd: Union[str, Sequence[str]], timeout: Optional[float]
+    ) -> Tuple[int, str]:
+        """Run shell command line or argument list `cmd`, return exit code and output.
+
+        Output is read like `subprocess.getstatusoutput` does, the command
+        and the processes it started are killed after `timeout` seconds.
+
+        :raises AdbTimeoutError if the command doesn't complete in time.
+        """
+        with subprocess.Popen(
+            cmd if isinstance(cmd, str) else list(cmd),
+            shell=isinstance(cmd, str),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            errors="replace",
+            start_new_session=True,
+        ) as process:
+            try:
+                output, _ = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                _kill(process)
+                log.error("Command %s timed out after %ss, killed", cmd, timeout)
+                raise AdbTimeoutError(f"Command {cmd} timed out after {timeout}s")
+            except BaseException:
+                # its own session doesn't get Ctrl+C of the terminal
+                _kill(process)
+                raise
+        return process.returncode, output.rstrip("\n")
+
+    def iter_command(
+        self, cmd: Union[str, Sequence[str]], timeout: Optional[float] = None
+    ) -> Iterator[str]:
+        """Send command to adb-server and yield its output line by line.
+
+        Unlike `exec_command` output is consumed while the command is still
+        running, so callers can start parsing before the command returns.
+
+        :raises AdbTimeoutError if the command doesn't complete in time.
+        :raises AdbError if executed command returns non-zero exit code.
+        """
+        args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        if self._serial:
+            args = ["-s", self._serial, *args]
+        log.debug("Streaming %s %s", self.path, args)
+        timeout = timeout or self._timeouts.command
+        with metrics.measure("exec_command", self.device_label), subprocess.Popen(
+            [str(self.path), *args],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            start_new_session=True,
+        ) as process, Watchdog(timeout, lambda: _kill(process)) as watchdog:
+            assert process.stdout is not None
+            try:
+                for line in process.stdout:
+                    yield line.rstrip("\r\n")
+            except BaseException:
+                # its own session doesn't get Ctrl+C of the terminal
+                _kill(process)
+                raise
+
+        if watchdog.fired:
+            raise AdbTimeoutError(f"Command {args} timed out after {timeout}s")
+        if process.returncode:
+            log.error("Command %s returned %s", args, process.returncode)
+            raise AdbError(f"Command returned error code {args}")
+
+    def _open_shell(self) -> ShellSession:
+        serial = ["-s", self._serial] if self._serial else []
+        return ShellSession(
+            [str(self.path), *serial, "shell", "-T"], self._timeouts.command
+        )
+
+    def iter_shell(self, cmd: str, timeout: Optional[float] = None) -> Iterator[str]:
+        """Run `cmd` in device shell and yield its output line by line.
+
+        Command is framed over a persistent shell session, if a session
+        can't be opened the command runs in its own `adb shell` process
+        and sessions are not tried again. The command is killed after
+        `timeout` seconds, the command timeout by default.
+
+        :raises AdbTimeoutError if the command doesn't complete in time.
+        :raises AdbError if executed command returns non-zero exit code.
+        """
+        with metrics.measure("shell", self.device_label):
+            yield from self._iter_shell(cmd, timeout or self._timeouts.command)
+
+    def _transport_error(self, message: str, error: BaseException) -> AdbError:
+        """Return the error raised for a failed socket transport call."""
+        from mass_apk.transport import is_timeout
+
+        if is_timeout(error):
+            return AdbTimeoutError(f"{message} timed out")
+        return AdbError(f"{message} {error}")
+
+    def _iter_shell(self, cmd: str, timeout: Optional[float]) -> Iterator[str]:
+        if self._transport is not None:
+            try:
+                return_code = yield from self._transport.iter_shell(cmd)
+            except (TransportError, OSError) as error:
+                raise self._transport_error(f"Command shell {cmd} failed", error)
+            if return_code:
+                log.error("Command shell %s returned %s", cmd, return_code)
+                raise AdbError(f"Command returned error code shell {cmd}")
+            return
+
+        if self._shells_enabled:
+            started = False
+            try:
+                with self._shells.session() as shell:
+                    lines = shell.iter_lines(cmd, timeout)
+                    while True:
+                        try:
+                            line = next(lines)
+                        except StopIteration as result:
+                            return_code = result.value
+                            break
+                        started = True
+                        yield line
+            except ShellTimeoutError as error:
+                raise AdbTimeoutError(f"Command shell {error}")
+            except ShellError as error:
+                if started:
+                    raise AdbError(f"Command shell {cmd} interrupted {error}")
+                log.warning("Shell session unavailable, spawning processes %r", error)
+                self._shells_enabled = False
+            else:
+                if return_code:
+                    log.error("Command shell %s returned %s", cmd, return_code)
+                    raise AdbError(f"Command returned error code shell {cmd}")
+                return
+
+        yield from self.iter_command(["shell", cmd], timeout)
+
+    def shell(
+        self, cmd: str, silence_errors: bool = False, timeout: Optional[float] = None
+    ) -> str:
+        """Run `cmd` in device shell and return its output.
+
+        :raises AdbTimeoutError if the command runs over `timeout` seconds.
+        :raises AdbError if executed command returns non-zero exit code.
+        """
+        lines: List[str] = []
+        try:
+            for line in self.iter_shell(cmd, timeout):
+                lines.append(line)
+        except AdbError:
+            if silence_errors:
+                log.warning("Command shell %s >>>%s", cmd, "\n".join(lines))
+                return ""
+            raise
+        return "\n".join(lines)
+
+    def push(self, source_path, ignore_errors=False) -> None:
         """Pushes apk package to android device.
 
         Before calling `push` function make sure function `connect` has been
@@ -142,17 +518,180 @@ class Adb(object):
 
          -d allow apk version down grade
          -r reinstall apk if already installed on device
+
+        :raises AdbError if the install fails, unless `ignore_errors` is set.
+        """
+        try:
+            with metrics.measure("install", self.device_label) as measurement:
+                measurement.bytes = os.path.getsize(source_path)
+                if self._transport is not None:
+                    self._install_stream(source_path)
+                else:
+                    self.exec_command(
+                        ["install", "-d", "-r", os.fspath(source_path)],
+                        timeout=self._timeouts.transfer,
+                    )
+        except AdbError as error:
+            log.warning(repr(error))
+            if not ignore_errors:
+                raise error
+
+    def _install_stream(self, source_path) -> None:
+        """Stream apk file to package manager."""
+        with open(source_path, "rb") as apk:
+            self._exec_install(apk, os.path.getsize(source_path), str(source_path))
+
+    def push_stream(
+        self, in_file: BinaryIO, size: int, name: str, ignore_errors=False
+    ) -> None:
+        """Install an apk read from file object `in_file` of `size` bytes.
+
+        The apk is streamed to the package manager stdin, nothing is written
+        on local disk. `size` must be exact, package manager reads that many
+        bytes. Errors are handled like `push` does.
         """
         try:
-            self.exec_command(f"install -d -r {source_path}")
+            with metrics.measure("install", self.device_label) as measurement:
+                measurement.bytes = size
+                self._exec_install(in_file, size, name)
         except AdbError as error:
             log.warning(repr(error))
             if not ignore_errors:
                 raise error
 
-    def pull(self, apk_path: str) -> None:
-        """Pull an apk from the following path in the android device."""
-        self.exec_command(cmd=f" pull {apk_path}")
+    def _exec_install(self, in_file: BinaryIO, size: int, name: str) -> None:
+        """Feed apk to `cmd package install` over `exec:` or `adb exec-in`."""
+        try:
+            output = self.exec_in(f"cmd package install -d -r -S {size}", in_file)
+        except AdbError as error:
+            raise AdbError(f"Install {name} failed {error}")
+        if "Success" not in output:
+            raise AdbError(f"Install {name} failed {output.strip()}")
+
+    def exec_in(self, cmd: str, in_file: BinaryIO) -> str:
+        """Run `cmd` on the device feeding file object `in_file` to its stdin.
+
+        Return command output, stdout and stderr merged.
+
+        :raises AdbError if the command can't be run.
+        """
+        try:
+            with metrics.measure("exec_in", self.device_label):
+                if self._transport is not None:
+                    return self._transport.exec_in(cmd, in_file)
+                return self._exec_in_process(cmd, in_file)
+        except (TransportError, OSError) as error:
+            raise self._transport_error(f"Command exec-in {cmd} failed", error)
+
+    def _exec_in_process(self, cmd: str, in_file: BinaryIO) -> str:
+        """Run `cmd` on the device with `adb exec-in` piping `in_file` to it.
+
+        The process is killed after the transfer timeout.
+        """
+        import shutil
+
+        from mass_apk.transport import SYNC_DATA_MAX
+
+        serial = ["-s", self._serial] if self._serial else []
+        log.debug("Executing exec-in %s", cmd)
+        timeout = self._timeouts.transfer
+        with subprocess.Popen(
+            [str(self.path), *serial, "exec-in", cmd],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        ) as process, Watchdog(timeout, lambda: _kill(process)) as watchdog:
+            assert process.stdin is not None and process.stdout is not None
+            try:
+                try:
+                    shutil.copyfileobj(in_file, process.stdin, SYNC_DATA_MAX)
+                except BrokenPipeError:
+                    pass
+                process.stdin.close()
+                output = process.stdout.read().decode("utf-8", errors="replace")
+            except BaseException:
+                _kill(process)
+                raise
+        if watchdog.fired:
+            raise AdbTimeoutError(f"Command exec-in {cmd} timed out after {timeout}s")
+        return output
+
+    def pull(
+        self, apk_path: str, dest: Optional[Union[str, os.PathLike]] = None
+    ) -> int:
+        """Pull an apk from the following path in the android device.
+
+        Apk is written to a temporary file next to `dest`, by default a
+        file with the same name as the apk in current working directory,
+        and renamed over it once complete. A failed pull leaves an existing
+        `dest`, possibly a link into an older back up, untouched.
+
+        Return size of the pulled apk in bytes.
+        """
+        import uuid
+
+        dest = os.path.basename(apk_path) if dest is None else os.fspath(dest)
+        tmp = os.path.join(
+            os.path.dirname(dest), f".{os.path.basename(dest)}.tmp-{uuid.uuid4().hex}"
+        )
+        try:
+            with metrics.measure("pull", self.device_label) as measurement:
+                if self._transport is not None:
+                    with open(tmp, "wb") as out_file:
+                        measurement.bytes = self.pull_into(apk_path, out_file)
+                else:
+                    self.exec_command(
+                        ["pull", apk_path, tmp], timeout=self._timeouts.transfer
+                    )
+                    measurement.bytes = os.path.getsize(tmp)
+                os.replace(tmp, dest)
+                return measurement.bytes
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def pull_into(self, apk_path: str, out_file: BinaryIO) -> int:
+        """Stream an apk from the android device into file object `out_file`.
+
+        Return the number of bytes written, requires `SOCKET` backend.
+        """
+        if self._transport is None:
+            raise AdbError("Streaming pulls require the socket backend")
+        try:
+            return self._transport.pull(apk_path, out_file)
+        except (TransportError, OSError) as error:
+            raise self._transport_error(f"Pull {apk_path} failed", error)
+
+    def devices(self) -> List[str]:
+        """Return serials of attached devices ready to accept commands.
+
+        Devices in `offline` or `unauthorized` state are left out.
+        """
+        if self._transport is not None:
+            try:
+                output = self._transport.host_request("host:devices")
+            except (TransportError, OSError) as error:
+                raise self._transport_error("Listing devices failed", error)
+        else:
+            output = self.exec_command("devices", return_stdout=True) or ""
+
+        devices = parse_devices(output)
+        return [serial for serial, state in devices.items() if state == "device"]
+
+    def usb_buses(self) -> Dict[str, str]:
+        """Return usb bus of every attached device, devices share its bandwidth.
+
+        :raises AdbError if devices can't be listed.
+        """
+        if self._transport is not None:
+            try:
+                output = self._transport.host_request("host:devices-l")
+            except (TransportError, OSError) as error:
+                raise self._transport_error("Listing devices failed", error)
+        else:
+            output = self.exec_command("devices -l", return_stdout=True) or ""
+        return parse_usb_buses(output)
 
     def list_device(self, flag: str) -> List[str]:
         """Return a list with installed apk  packages on the android device.
@@ -178,20 +717,42 @@ class Adb(object):
 
         """
         log.info("Listing installed apk's in the device ...")
-        output = self.exec_command(
-            f"shell pm list packages -{flag}",
-            return_stdout=True,
-            case_sensitive=True,
-        )
+        output = self.shell(f"pm list packages -{flag}")
+
+        return parse_packages(output)
 
-        if output is None:
-            raise ValueError("Output is None")
-
-        # adb returns packages name in the form
-        # package:com.skype.raider
-        # we need to strip "package:" prefix
-        return [
-            line.split(":", maxsplit=1)[1].strip()
-            for line in output.splitlines()
-            if line.startswith("package:")
-        ]
+    def package_versions(self) -> Dict[str, Optional[int]]:
+        """Return versionCode of every installed package, one `pm` call for all.
+
+        Versions are None when `pm` doesn't report them, before android 9.
+        """
+        return parse_package_versions(self.shell("pm list packages --show-versioncode"))
+
+    def list_device_paths(self, flag: str) -> Iterator[Tuple[str, str]]:
+        """Yield `(package, path)` pairs for installed apk packages.
+
+        Every apk of a package is reported, base apk first followed by its
+        split apks. Paths are resolved in a single shell invocation, a
+        `pm list packages -f` listing expanded on the device, instead of
+        one `pm path` round trip per package.
+        """
+        log.info("Listing installed apk paths in the device ...")
+        for line in self.iter_shell(_LIST_PATHS_SCRIPT.format(flag=flag)):
+            # lines come in the form of `pm list packages -f`
+            # package:/data/app/~~AbC==/com.skype.raider-2/base.apk=com.skype.raider
+            # paths may contain `=` but package names can't, split on the last one
+            if line.startswith("package:") and "=" in line:
+                path, pkg = line[len("package:") :].rsplit("=", maxsplit=1)
+                yield pkg.strip(), path.strip()
+
+
+# expand base apk reported by `pm list packages -f` into every apk found in
+# its code directory, this picks up split apks without calling `pm path`
+_LIST_PATHS_SCRIPT = (
+    "pm list packages -f -{flag} | while IFS= read -r line; do "
+    'p="${{line#package:}}"; pkg="${{p##*=}}"; apk="${{p%=*}}"; '
+    'case "${{apk##*/}}" in '
+    'base.apk) for f in "${{apk%/*}}"/*.apk; do echo "package:$f=$pkg"; done;; '
+    '*) echo "package:$apk=$pkg";; '
+    "esac; done"
+)
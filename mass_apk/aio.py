@@ -0,0 +1,487 @@
+"""asyncio interface to adb-server.
+
+`AsyncAdb` offers the operations of `Adb` to code running in an event
+loop, one loop drives many devices without a thread per device. With the
+`PROCESS` backend commands run as asyncio subprocesses of the adb
+executable, with the `SOCKET` backend they talk the adb-server host
+protocol over asyncio streams.
+
+Every call takes a `timeout` in seconds, a call timing out or being
+cancelled kills its adb process or closes its connection. Concurrent
+calls are bounded by semaphores shared with instances made by
+`for_device`, file transfers have a limit of their own.
+
+    server = AsyncAdb(backend="socket", max_transfers=8)
+    device = server.for_device("emulator-5554")
+    packages = await device.list_device("3", timeout=10)
+    await asyncio.gather(*(device.pull(path) for path in paths))
+"""
+
+from typing import (
+    Any,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+import asyncio
+import copy
+import logging
+import os
+import shlex
+import struct
+import uuid
+
+from mass_apk.adb import Adb, AdbError, AdbTimeoutError, parse_devices, parse_packages
+from mass_apk.metrics import metrics
+from mass_apk.transport import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    SYNC_DATA_MAX,
+    SHELL_EXIT,
+    SHELL_STDERR,
+    SHELL_STDOUT,
+)
+
+__all__ = ["AsyncAdb"]
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+COMMANDS = "commands"
+TRANSFERS = "transfers"
+
+
+class _Limits(object):
+    """Semaphores bounding concurrent calls by kind.
+
+    Semaphores are made on first use, python < 3.10 binds them to the
+    event loop running when they are made.
+    """
+
+    def __init__(self, sizes: Dict[str, int]):
+        self._sizes = sizes
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get(self, kind: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(kind)
+        if semaphore is None:
+            semaphore = self._semaphores[kind] = asyncio.Semaphore(self._sizes[kind])
+        return semaphore
+
+
+async def _send_request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, request: str
+) -> None:
+    """Send a host request and wait for the server to acknowledge it."""
+    payload = request.encode("utf-8")
+    writer.write(b"%04x" % len(payload) + payload)
+    await writer.drain()
+    status = await reader.readexactly(4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        raise AdbError(f"{request} failed: {await _recv_message(reader)}")
+    raise AdbError(f"{request} unexpected reply {status!r}")
+
+
+async def _recv_message(reader: asyncio.StreamReader) -> str:
+    """Read a 4 hex digits length prefixed message."""
+    size = int(await reader.readexactly(4), 16)
+    return (await reader.readexactly(size)).decode("utf-8", errors="replace")
+
+
+class AsyncAdb(object):
+    """asyncio counterpart of `Adb`."""
+
+    Backend = Adb.Backend
+    ConnectionState = Adb.ConnectionState
+
+    def __init__(
+        self,
+        backend: Union[Adb.Backend, str] = Adb.Backend.PROCESS,
+        serial: Optional[str] = None,
+        timeout: Optional[float] = None,
+        max_commands: int = 16,
+        max_transfers: int = 4,
+        host: str = DEFAULT_HOST,
+        port: Optional[int] = None,
+    ):
+        """Create asyncio adb interface.
+
+        `timeout` is the default of calls not given one, None waits
+        forever. At most `max_commands` commands and `max_transfers` pulls
+        and installs run at once, across this instance and the ones made
+        by `for_device`. Time waiting for a slot doesn't count against the
+        call timeout.
+        """
+        if port is None:
+            port = int(os.environ.get("ANDROID_ADB_SERVER_PORT", DEFAULT_PORT))
+        self._backend = Adb.Backend(backend)
+        self._serial = serial
+        self._timeout = timeout
+        self._address = (host, port)
+        self._path: Optional[os.PathLike] = None
+        self._limits = _Limits({COMMANDS: max_commands, TRANSFERS: max_transfers})
+
+    def for_device(self, serial: str) -> "AsyncAdb":
+        """Return an `AsyncAdb` targeting `serial` sharing limits with this one."""
+        device = copy.copy(self)
+        device._serial = serial
+        return device
+
+    @property
+    def path(self) -> os.PathLike:
+        """Get access to detected adb path, resolved on first access."""
+        if self._path is None:
+            self._path = Adb._get_adb_path()
+        return self._path
+
+    @property
+    def serial(self) -> Optional[str]:
+        """Get serial of the targeted device, None when any device is used."""
+        return self._serial
+
+    @property
+    def backend(self) -> Adb.Backend:
+        """Get backend used to reach adb-server."""
+        return self._backend
+
+    @property
+    def device_label(self) -> str:
+        """Get label of the targeted device in metrics."""
+        return self._serial or "default"
+
+    async def _call(
+        self,
+        kind: str,
+        what: str,
+        timeout: Optional[float],
+        func: Callable[..., Awaitable[T]],
+        *args: Any,
+    ) -> T:
+        """Run `func(*args)` in a `kind` slot, within `timeout` seconds.
+
+        :raises AdbTimeoutError if it doesn't complete in time.
+        :raises AdbError if adb-server can't be reached.
+        """
+        timeout = self._timeout if timeout is None else timeout
+        async with self._limits.get(kind):
+            try:
+                return await asyncio.wait_for(func(*args), timeout)
+            except asyncio.TimeoutError:
+                raise AdbTimeoutError(f"{what} timed out after {timeout}s")
+            except (OSError, EOFError) as error:
+                raise AdbError(f"{what} failed {error}")
+
+    async def _run_process(
+        self, args: List[str], in_file: Optional[BinaryIO] = None
+    ) -> Tuple[int, str]:
+        """Run adb with `args`, return its exit code and output.
+
+        The process is killed if the call is cancelled or times out.
+        """
+        serial = ["-s", self._serial] if self._serial else []
+        log.debug("Executing %s %s", self.path, args)
+        process = await asyncio.create_subprocess_exec(
+            str(self.path),
+            *serial,
+            *args,
+            stdin=(
+                asyncio.subprocess.DEVNULL
+                if in_file is None
+                else asyncio.subprocess.PIPE
+            ),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        try:
+            if in_file is not None:
+                assert process.stdin is not None
+                try:
+                    while True:
+                        chunk = in_file.read(SYNC_DATA_MAX)
+                        if not chunk:
+                            break
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                process.stdin.close()
+            assert process.stdout is not None
+            output = await process.stdout.read()
+            return_code = await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        return return_code, output.decode("utf-8", errors="replace")
+
+    async def _open_service(
+        self, service: str
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Return a connection to device `service`."""
+        reader, writer = await asyncio.open_connection(*self._address)
+        try:
+            if self._serial:
+                await _send_request(reader, writer, f"host:transport:{self._serial}")
+            else:
+                await _send_request(reader, writer, "host:transport-any")
+            await _send_request(reader, writer, service)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _host_request(self, request: str) -> str:
+        reader, writer = await asyncio.open_connection(*self._address)
+        try:
+            await _send_request(reader, writer, request)
+            return await _recv_message(reader)
+        finally:
+            writer.close()
+
+    async def exec_command(
+        self,
+        cmd: str,
+        return_stdout: bool = False,
+        case_sensitive: bool = False,
+        silence_errors: bool = False,
+        timeout: Optional[float] = None,
+    ) -> Optional[str]:
+        """Run adb command `cmd`, return its output with `return_stdout`.
+
+        :raises AdbError if executed command returns non-zero exit code.
+        """
+        return_code, output = await self._call(
+            COMMANDS, cmd, timeout, self._exec_command, cmd
+        )
+        if return_code:
+            if silence_errors:
+                log.warning("Command %s returned %s >>>%s", cmd, return_code, output)
+                return ""
+            log.error("Command %s returned %s >>>%s", cmd, return_code, output)
+            raise AdbError(f"Command returned error code {cmd} {output}")
+
+        if return_stdout:
+            output = output.rstrip("\n")
+            return output.lower() if case_sensitive else output
+        return None
+
+    async def _exec_command(self, cmd: str) -> Tuple[int, str]:
+        with metrics.measure("exec_command", self.device_label):
+            return await self._run_process(shlex.split(cmd))
+
+    async def shell(
+        self, cmd: str, silence_errors: bool = False, timeout: Optional[float] = None
+    ) -> str:
+        """Run `cmd` in device shell and return its output.
+
+        :raises AdbError if executed command returns non-zero exit code.
+        """
+        return_code, output = await self._call(
+            COMMANDS, f"shell {cmd}", timeout, self._shell, cmd
+        )
+        if return_code:
+            if silence_errors:
+                log.warning("Command shell %s >>>%s", cmd, output)
+                return ""
+            log.error("Command shell %s returned %s", cmd, return_code)
+            raise AdbError(f"Command returned error code shell {cmd}")
+        return output
+
+    async def _shell(self, cmd: str) -> Tuple[int, str]:
+        with metrics.measure("shell", self.device_label):
+            if self._backend is Adb.Backend.PROCESS:
+                return_code, output = await self._run_process(["shell", cmd])
+                return return_code, "\n".join(output.splitlines())
+
+            # shell protocol v2 frames output and carries the exit code
+            reader, writer = await self._open_service(f"shell,v2,raw:{cmd}")
+            try:
+                output_bytes = bytearray()
+                while True:
+                    packet_id, size = struct.unpack("<BI", await reader.readexactly(5))
+                    data = await reader.readexactly(size)
+                    if packet_id in (SHELL_STDOUT, SHELL_STDERR):
+                        output_bytes += data
+                    elif packet_id == SHELL_EXIT:
+                        text = output_bytes.decode("utf-8", errors="replace")
+                        return (data[0] if data else 0), "\n".join(text.splitlines())
+            finally:
+                writer.close()
+
+    async def state(self, timeout: Optional[float] = None) -> Adb.ConnectionState:
+        """Return whether the device is connected and accepts commands."""
+        try:
+            output = await self._call(COMMANDS, "get-state", timeout, self._get_state)
+        except AdbTimeoutError:
+            raise
+        except AdbError as error:
+            log.warning("Get state failed %r", error)
+            output = ""
+        if output.strip() == "device":
+            return Adb.ConnectionState.CONNECTED
+        return Adb.ConnectionState.DISCONNECTED
+
+    async def _get_state(self) -> str:
+        if self._backend is Adb.Backend.PROCESS:
+            return_code, output = await self._run_process(["get-state"])
+            return "" if return_code else output
+        prefix = f"host-serial:{self._serial}" if self._serial else "host"
+        return await self._host_request(f"{prefix}:get-state")
+
+    async def devices(self, timeout: Optional[float] = None) -> List[str]:
+        """Return serials of attached devices ready to accept commands."""
+        if self._backend is Adb.Backend.PROCESS:
+            output = await self.exec_command(
+                "devices", return_stdout=True, timeout=timeout
+            )
+        else:
+            output = await self._call(
+                COMMANDS, "devices", timeout, self._host_request, "host:devices"
+            )
+        devices = parse_devices(output or "")
+        return [serial for serial, state in devices.items() if state == "device"]
+
+    async def list_device(
+        self, flag: str, timeout: Optional[float] = None
+    ) -> List[str]:
+        """Return installed packages, `flag` filters them like `Adb.list_device`."""
+        return parse_packages(
+            await self.shell(f"pm list packages -{flag}", timeout=timeout)
+        )
+
+    async def exec_in(
+        self, cmd: str, in_file: BinaryIO, timeout: Optional[float] = None
+    ) -> str:
+        """Run `cmd` on the device feeding file object `in_file` to its stdin.
+
+        :raises AdbError if the command can't be run.
+        """
+        return await self._call(
+            TRANSFERS, f"exec-in {cmd}", timeout, self._exec_in, cmd, in_file
+        )
+
+    async def _exec_in(self, cmd: str, in_file: BinaryIO) -> str:
+        with metrics.measure("exec_in", self.device_label):
+            if self._backend is Adb.Backend.PROCESS:
+                _, output = await self._run_process(["exec-in", cmd], in_file)
+                return output
+
+            reader, writer = await self._open_service(f"exec:{cmd}")
+            try:
+                while True:
+                    chunk = in_file.read(SYNC_DATA_MAX)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+                writer.write_eof()
+                return (await reader.read()).decode("utf-8", errors="replace")
+            finally:
+                writer.close()
+
+    async def push(
+        self, source_path, ignore_errors: bool = False, timeout: Optional[float] = None
+    ) -> None:
+        """Install apk `source_path` on the device, see `Adb.push`."""
+        try:
+            await self._call(
+                TRANSFERS, f"install {source_path}", timeout, self._push, source_path
+            )
+        except AdbError as error:
+            log.warning(repr(error))
+            if not ignore_errors:
+                raise error
+
+    async def _push(self, source_path) -> None:
+        with metrics.measure("install", self.device_label) as measurement:
+            measurement.bytes = size = os.path.getsize(source_path)
+            if self._backend is Adb.Backend.PROCESS:
+                return_code, output = await self._run_process(
+                    ["install", "-d", "-r", os.fspath(source_path)]
+                )
+            else:
+                with open(source_path, "rb") as apk:
+                    output = await self._exec_in(
+                        f"cmd package install -d -r -S {size}", apk
+                    )
+            if "Success" not in output:
+                raise AdbError(f"Install {source_path} failed {output.strip()}")
+
+    async def pull(
+        self,
+        apk_path: str,
+        dest: Optional[Union[str, os.PathLike]] = None,
+        timeout: Optional[float] = None,
+    ) -> int:
+        """Pull `apk_path` from the device into `dest`, see `Adb.pull`.
+
+        Return size of the pulled apk in bytes.
+        """
+        dest = os.path.basename(apk_path) if dest is None else os.fspath(dest)
+        tmp = os.path.join(
+            os.path.dirname(dest), f".{os.path.basename(dest)}.tmp-{uuid.uuid4().hex}"
+        )
+        try:
+            size = await self._call(
+                TRANSFERS, f"pull {apk_path}", timeout, self._pull, apk_path, tmp
+            )
+            os.replace(tmp, dest)
+            return size
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    async def _pull(self, apk_path: str, dest: str) -> int:
+        with metrics.measure("pull", self.device_label) as measurement:
+            if self._backend is Adb.Backend.PROCESS:
+                return_code, output = await self._run_process(["pull", apk_path, dest])
+                if return_code:
+                    raise AdbError(f"Pull {apk_path} failed {output.strip()}")
+                measurement.bytes = os.path.getsize(dest)
+                return measurement.bytes
+
+            reader, writer = await self._open_service("sync:")
+            try:
+                path = apk_path.encode("utf-8")
+                writer.write(b"RECV" + struct.pack("<I", len(path)) + path)
+                with open(dest, "wb") as out_file:
+                    while True:
+                        header = await reader.readexactly(8)
+                        packet_id, size = struct.unpack("<4sI", header)
+                        if packet_id == b"DATA":
+                            out_file.write(await reader.readexactly(size))
+                            measurement.bytes += size
+                        elif packet_id == b"DONE":
+                            break
+                        elif packet_id == b"FAIL":
+                            message = await reader.readexactly(size)
+                            raise AdbError(
+                                f"Pull {apk_path} failed "
+                                f"{message.decode('utf-8', errors='replace')}"
+                            )
+                        else:
+                            raise AdbError(f"sync pull unexpected reply {packet_id!r}")
+                writer.write(b"QUIT" + struct.pack("<I", 0))
+                return measurement.bytes
+            finally:
+                writer.close()
+
+    async def start_server(self, timeout: Optional[float] = None) -> None:
+        """Start adb-server process."""
+        log.info("Starting adb server...")
+        await self.exec_command("start-server", timeout=timeout)
+
+    async def stop_server(self, timeout: Optional[float] = None) -> None:
+        """Kill adb server."""
+        log.info("Killing adb server...")
+        await self.exec_command("kill-server", timeout=timeout)
@@ -1,14 +1,16 @@
-"""Common operation and manipulation for paths in android devices"""
+"""Common operation and manipulation for paths in android devices"""
 
-from typing import  List
+from typing import Dict, List, Optional
 import collections
 import logging
+import posixpath
 
 from mass_apk import adb
-from mass_apk.adb import AdbError
+from mass_apk.adb import Adb, AdbError
 from mass_apk.exceptions import MassApkError
+from mass_apk.metrics import metrics
 
-__all__ = ["ApkError", "map_apk_paths", "absolute_path", "ApkAbsPath"]
+__all__ = ["ApkError", "map_apk_paths", "absolute_path", "ApkAbsPath", "split_file"]
 
 log = logging.getLogger(__name__)
 
@@ -17,42 +19,109 @@ class ApkError(AdbError):
     """Base exception class for `apk` module."""
 
 
-ApkAbsPath = collections.namedtuple("ApkAbsPath", "name fullpath")
+ApkAbsPath = collections.namedtuple(
+    "ApkAbsPath", "name fullpath splits", defaults=((),)
+)
 
 
-def map_apk_paths(apks: List[str]) -> List[ApkAbsPath]:
+def split_file(package: str, split_path: str) -> str:
+    """Return back up file of split apk `split_path` of `package`.
+
+    Split apks are kept in a folder named after their package, e.g.
+    `com.a/split_config.en.apk`.
+    """
+    return f"{package}/{posixpath.basename(split_path)}"
+
+
+def map_apk_paths(
+    apks: List[str], flag: Optional[str] = None, server: Optional[Adb] = None
+) -> List[ApkAbsPath]:
     """Get mapping for a list of packages.
 
     Return a dict object with key package name and value absolute
     path package.
 
+    When `flag`, the `pm list packages` filter used to get `apks`, is given
+    paths are discovered in batch with a single shell invocation, packages
+    missing from the batch are resolved one by one.
+
+    Device is queried through `server`, by default the package wide `adb`.
     """
-    abs_paths = []
-    for pkg in apks:
-        try:
-            if pkg_abs_path := absolute_path(pkg):
-                abs_paths.append((pkg, pkg_abs_path))
-        except MassApkError as error:
-            log.error(error)
+    server = server or adb
+    with metrics.measure("discovery", server.device_label):
+        if flag is not None:
+            return _map_apk_paths_batched(apks, flag, server)
+
+        abs_paths = []
+        for pkg in apks:
+            try:
+                if pkg_abs_paths := _package_paths(pkg, server):
+                    abs_paths.append((pkg, pkg_abs_paths[0], tuple(pkg_abs_paths[1:])))
+            except MassApkError as error:
+                log.error(error)
     # pack apk name and apk full path  into an ApkAbsPath named tuple, makes more sense to carry
     # these two variables together from now on through the back up,  comes handy
     return [ApkAbsPath(*abs_path) for abs_path in abs_paths]
 
 
-def absolute_path(pkg_name: str) -> str:
+def _map_apk_paths_batched(apks: List[str], flag: str, server: Adb) -> List[ApkAbsPath]:
+    """Resolve paths of `apks` with one `Adb.list_device_paths` call."""
+    wanted = set(apks)
+    found: Dict[str, List[str]] = {}
+    try:
+        for pkg, path in server.list_device_paths(flag):
+            if pkg not in wanted:
+                continue
+            paths = found.setdefault(pkg, [])
+            if path.endswith("/base.apk"):
+                paths.insert(0, path)
+            else:
+                paths.append(path)
+    except AdbError as error:
+        log.warning("Batched path discovery failed, falling back: %r", error)
+
+    missing = [pkg for pkg in apks if pkg not in found]
+    resolved = (
+        {item.name: item for item in map_apk_paths(missing, server=server)}
+        if missing
+        else {}
+    )
+
+    abs_paths = []
+    for pkg in apks:
+        if pkg in found:
+            # base apk is listed first followed by split apks
+            paths = found[pkg]
+            abs_paths.append(ApkAbsPath(pkg, paths[0], tuple(paths[1:])))
+        elif pkg in resolved:
+            abs_paths.append(resolved[pkg])
+    return abs_paths
+
+
+def absolute_path(pkg_name: str, server: Optional[Adb] = None) -> str:
     """Return full path of a package in android device storage."""
+    return _package_paths(pkg_name, server)[0]
+
+
+def _package_paths(pkg_name: str, server: Optional[Adb] = None) -> List[str]:
+    """Return full paths of the base apk and split apks of a package."""
     try:
-        output = adb.exec_command(
-            f"shell pm path {pkg_name}", return_stdout=True, case_sensitive=True
-        )
+        output = (server or adb).shell(f"pm path {pkg_name}")
 
     except AdbError:
-        raise MassApkError("Path is not valid for {0}".format( pkg_name))
+        raise MassApkError("Path is not valid for {0}".format(pkg_name))
 
     # bin returns packages name in the form
     # package:/data/app/com.dog.raider-2/base.apk
     # we need to strip package: prefix in returned string
+    # split apks are listed on the following lines, base apk comes first
     if output and output.startswith("package:"):
-        return output.split(":", maxsplit=1)[1].strip()
+        paths = [
+            line.split(":", maxsplit=1)[1].strip()
+            for line in output.splitlines()
+            if line.startswith("package:")
+        ]
+        paths.sort(key=lambda path: not path.endswith("/base.apk"))
+        return paths
 
     raise MassApkError("Path is not valid for %s %s", pkg_name, output)
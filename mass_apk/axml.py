@@ -0,0 +1,168 @@
+"""Read package name and versionCode of an apk on the host.
+
+`AndroidManifest.xml` is stored in apks as Android binary XML, a stream
+of chunks: a string pool, the resource ids of attribute names and one
+chunk per element start and end. Only the attributes of the root
+`<manifest>` element are needed, parsing stops there.
+
+    ResChunk_header     type u16, header size u16, chunk size u32
+    ResStringPool       string count, style count, flags, strings start, ...
+    ResXMLTree_attrExt  ns, name, attribute start, size and count, ...
+    ResXMLTree_attribute ns, name, raw value, Res_value
+"""
+
+from typing import BinaryIO, List, Sequence, Union
+import collections
+import os
+import struct
+from zipfile import BadZipFile, ZipFile
+
+from mass_apk.exceptions import MassApkError
+
+__all__ = ["AxmlError", "ApkInfo", "parse_manifest", "read_apk_info"]
+
+MANIFEST_MEMBER = "AndroidManifest.xml"
+
+_XML_TYPE = 0x0003
+_STRING_POOL_TYPE = 0x0001
+_RESOURCE_MAP_TYPE = 0x0180
+_START_ELEMENT_TYPE = 0x0102
+
+_UTF8_FLAG = 0x100
+_NO_INDEX = 0xFFFFFFFF
+
+# Res_value data types
+_TYPE_STRING = 0x03
+_TYPE_INT_DEC = 0x10
+_TYPE_INT_HEX = 0x11
+
+# ids of android:versionCode and android:versionCodeMajor, attribute names
+# may be stripped by obfuscators but their resource ids can't
+_VERSION_CODE_ID = 0x0101021B
+_VERSION_CODE_MAJOR_ID = 0x01010576
+
+
+class AxmlError(MassApkError):
+    """Exception raised when an apk manifest can't be read."""
+
+
+ApkInfo = collections.namedtuple("ApkInfo", "package version_code")
+
+
+def read_apk_info(apk: Union[str, os.PathLike, BinaryIO]) -> ApkInfo:
+    """Return package and versionCode of apk file `apk`, a path or seekable file.
+
+    Only the zip central directory and the manifest member are read.
+
+    :raises AxmlError if `apk` isn't an apk or its manifest is malformed.
+    """
+    try:
+        with ZipFile(apk) as zip_file:
+            data = zip_file.read(MANIFEST_MEMBER)
+    except KeyError:
+        raise AxmlError(f"Apk has no {MANIFEST_MEMBER}")
+    except (BadZipFile, OSError) as error:
+        raise AxmlError(f"Can't read apk {error}")
+    return parse_manifest(data)
+
+
+def parse_manifest(data: bytes) -> ApkInfo:
+    """Return package and versionCode of binary `AndroidManifest.xml` `data`.
+
+    :raises AxmlError if `data` is malformed or lacks either attribute.
+    """
+    try:
+        return _parse_manifest(data)
+    except (struct.error, IndexError) as error:
+        raise AxmlError(f"Truncated binary xml {error}")
+
+
+def _parse_manifest(data: bytes) -> ApkInfo:
+    kind, header_size, size = struct.unpack_from("<HHI", data, 0)
+    if kind != _XML_TYPE:
+        raise AxmlError(f"Not a binary xml document, chunk type {kind:#x}")
+
+    strings: List[str] = []
+    resource_ids: Sequence[int] = ()
+    offset = header_size
+    end = min(size, len(data))
+    while offset + 8 <= end:
+        kind, header_size, chunk_size = struct.unpack_from("<HHI", data, offset)
+        if chunk_size < 8:
+            raise AxmlError(f"Malformed chunk size {chunk_size} at {offset}")
+        if kind == _STRING_POOL_TYPE:
+            strings = _string_pool(data, offset, header_size)
+        elif kind == _RESOURCE_MAP_TYPE:
+            count = (chunk_size - header_size) // 4
+            resource_ids = struct.unpack_from(f"<{count}I", data, offset + header_size)
+        elif kind == _START_ELEMENT_TYPE:
+            # the first element is the root, `<manifest>`
+            return _manifest_info(data, offset + header_size, strings, resource_ids)
+        offset += chunk_size
+    raise AxmlError("Binary xml has no manifest element")
+
+
+def _string_pool(data: bytes, pool: int, header_size: int) -> List[str]:
+    _, _, _, count, _, flags, strings_start, _ = struct.unpack_from(
+        "<HHIIIIII", data, pool
+    )
+    offsets = struct.unpack_from(f"<{count}I", data, pool + header_size)
+    decode = _utf8_string if flags & _UTF8_FLAG else _utf16_string
+    return [decode(data, pool + strings_start + offset) for offset in offsets]
+
+
+def _utf8_length(data: bytes, pos: int):
+    length = data[pos]
+    if length & 0x80:
+        return (length & 0x7F) << 8 | data[pos + 1], pos + 2
+    return length, pos + 1
+
+
+def _utf8_string(data: bytes, pos: int) -> str:
+    # length in utf-16 code units, then in bytes
+    _, pos = _utf8_length(data, pos)
+    length, pos = _utf8_length(data, pos)
+    return data[pos : pos + length].decode("utf-8", errors="replace")
+
+
+def _utf16_string(data: bytes, pos: int) -> str:
+    (length,) = struct.unpack_from("<H", data, pos)
+    pos += 2
+    if length & 0x8000:
+        (low,) = struct.unpack_from("<H", data, pos)
+        length = (length & 0x7FFF) << 16 | low
+        pos += 2
+    return data[pos : pos + 2 * length].decode("utf-16-le", errors="replace")
+
+
+def _string(strings: List[str], index: int) -> str:
+    return strings[index] if index < len(strings) else ""
+
+
+def _manifest_info(
+    data: bytes, ext: int, strings: List[str], resource_ids: Sequence[int]
+) -> ApkInfo:
+    _, name, start, attr_size, count = struct.unpack_from("<IIHHH", data, ext)
+    if _string(strings, name) != "manifest":
+        raise AxmlError(f"Root element is {_string(strings, name)!r}, not manifest")
+
+    package = None
+    version_code = None
+    major = 0
+    for index in range(count):
+        _, name, raw, _, _, kind, value = struct.unpack_from(
+            "<IIIHBBI", data, ext + start + index * attr_size
+        )
+        resource_id = resource_ids[name] if name < len(resource_ids) else None
+        attribute = _string(strings, name)
+        if attribute == "package" and resource_id is None:
+            package = _string(strings, value if kind == _TYPE_STRING else raw)
+        elif kind in (_TYPE_INT_DEC, _TYPE_INT_HEX):
+            if resource_id == _VERSION_CODE_ID or attribute == "versionCode":
+                version_code = value
+            elif resource_id == _VERSION_CODE_MAJOR_ID:
+                major = value
+
+    if not package or version_code is None:
+        raise AxmlError("Manifest lacks package or versionCode")
+    return ApkInfo(package, major << 32 | version_code)
@@ -1,22 +1,38 @@
 import os
-import shutil
 import sys
 import pathlib
-from typing import Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import click
 
 
-from mass_apk import logger as log
-from mass_apk.adb import Adb
-from mass_apk.apk import AdbError, map_apk_paths
-from mass_apk.exceptions import MassApkFileNotFoundError
+from mass_apk import init_logging, logger as log
+from mass_apk.adb import Adb, AdbError, Timeouts
+from mass_apk.exceptions import MassApkError, MassApkFileNotFoundError
 from mass_apk.helpers import MB
-from mass_apk.ziptools import unzipify, zipify
+
+if TYPE_CHECKING:
+    from mass_apk.daemon import DaemonClient
+    from mass_apk.fleet import DeviceResult
+    from mass_apk.sources import PackageFilter
+
+# modules doing the actual work are imported when a command runs, `--help`
+# and shell completion don't pay for them
 
 
 def main():
     """Invoke main entry point for mass apk."""
+    init_logging()
     try:
         cli()
     except KeyboardInterrupt:
@@ -24,25 +40,235 @@ def main():
         sys.exit(1)
 
 
+def _options() -> Dict[str, Any]:
+    """Return options of the `cli` group."""
+    ctx = click.get_current_context(silent=True)
+    return (ctx.find_object(dict) if ctx else None) or {}
+
+
+def _connect_server(auto_start: bool = True) -> Adb:
+    """Create adb interface using the backend selected on the command line."""
+    return Adb(
+        auto_start=auto_start,
+        backend=_options().get("backend", Adb.Backend.PROCESS),
+        timeouts=_options().get("timeouts"),
+    )
+
+
+def _daemon_client() -> Optional["DaemonClient"]:
+    """Return client of the running daemon, None if commands run in process."""
+    if _options().get("no_daemon"):
+        return None
+    from mass_apk.daemon import running_daemon
+
+    return running_daemon()
+
+
+def _run_in_daemon(
+    client: "DaemonClient",
+    command: str,
+    args_of: Callable[[Optional[str]], Dict[str, Any]],
+    all_devices: bool,
+) -> List["DeviceResult"]:
+    """Run `command` as daemon jobs, one per ready device with `all_devices`.
+
+    `args_of` returns job arguments for a device serial, None when the
+    daemon picks the only device. Exit if a job fails or is rejected.
+    """
+    from mass_apk.daemon import DaemonError
+    from mass_apk.fleet import DeviceResult, log_summary
+
+    # None lets the daemon pick the only device
+    serials: List[Optional[str]] = [None]
+    try:
+        if all_devices:
+            devices = client.devices()
+            serials = [s for s, state in devices.items() if state == "device"]
+            if not serials:
+                click.echo("Device not connected.")
+                sys.exit(0)
+        jobs = [client.submit(command, args_of(serial), serial) for serial in serials]
+        log.info("Running %s jobs in daemon at %s", len(jobs), client.address)
+        results = []
+        for job in jobs:
+            job = client.wait(job["id"])
+            results.append(DeviceResult(job["serial"], job["summary"], job["error"]))
+    except DaemonError as error:
+        click.echo("Daemon error\n{0}".format(str(error)), err=True)
+        sys.exit(-1)
+
+    log_summary(results)
+    if any(result.error is not None for result in results):
+        sys.exit(-1)
+    return results
+
+
 @click.group()
-def cli():
+@click.option(
+    "--backend",
+    type=click.Choice([backend.value for backend in Adb.Backend]),
+    default=Adb.Backend.PROCESS.value,
+    envvar="MASS_APK_BACKEND",
+    show_default=True,
+    help="Spawn adb executable per command or talk to adb-server over a socket",
+)
+@click.option(
+    "--report",
+    type=click.Path(dir_okay=False),
+    help="Write per operation metrics of the run as json into this file",
+)
+@click.option(
+    "--prometheus",
+    type=click.Path(dir_okay=False),
+    help="Write metrics into this Prometheus textfile collector file",
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False),
+    help="Profile the run with cProfile and save stats into this file",
+)
+@click.option(
+    "--no-daemon",
+    is_flag=True,
+    help="Run back up and restore in process even when a daemon is running",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0),
+    default=Timeouts().command,
+    envvar="MASS_APK_TIMEOUT",
+    show_default=True,
+    help="Seconds after which a hung adb command is killed, 0 waits forever",
+)
+@click.option(
+    "--transfer-timeout",
+    type=click.FloatRange(min=0),
+    default=Timeouts().transfer,
+    envvar="MASS_APK_TRANSFER_TIMEOUT",
+    show_default=True,
+    help="Seconds after which a hung pull or install is killed, 0 waits forever",
+)
+@click.pass_context
+def cli(
+    ctx,
+    backend: str,
+    report: Optional[str],
+    prometheus: Optional[str],
+    profile: Optional[str],
+    no_daemon: bool,
+    timeout: float,
+    transfer_timeout: float,
+):
     """
     Usage:\n
-        mass-apk (b | backup) [<path>] [-l <list_flag>] [-a | --archive]\n
-        mass-apk (r | restore) [<path>]  [-c | --clean]\n
+        mass-apk [--backend <backend>] [--report <file>] [--prometheus <file>] [--profile <file>] [--no-daemon] [--timeout <seconds>] [--transfer-timeout <seconds>] <command>\n
+        mass-apk (b | backup) [<path> | -] [-l <list_flag>] [-a | --archive] [-j <jobs>] [--all-devices] [-i <path>] [-s <store>] [--compression <type>] [--compression-level <level>] [--resume] [--keep-going]\n
+        mass-apk (r | restore) [<path> | -]  [-c | --clean] [--all-devices] [-n <name>] [-b <batch_size>] [-p <file>] [--include <pattern>]... [--exclude <pattern>]... [--force] [--resume]\n
+        mass-apk serve --restore <path> [-n <name>] [-b <batch_size>] [-j <jobs>] [-p <file>] [--include <pattern>]... [--exclude <pattern>]... [--force]\n
+        mass-apk daemon [--address <address>]\n
+        mass-apk gc <store> [--dry-run]\n
+        mass-apk compact <store> [--dry-run]\n
         mass-apk (-h | --help)\n
         mass-apk (-v | --version)\n
     Options:\n
+        --backend           process or socket, how to reach adb-server.\n
+        --report            Write json report of per operation metrics.\n
+        --prometheus        Write metrics for Prometheus textfile collector.\n
+        --profile           Save cProfile stats of the run.\n
+        --no-daemon         Don't hand back up and restore to a running daemon.\n
+        --timeout           Seconds before a hung adb command is killed.\n
+        --transfer-timeout  Seconds before a hung pull or install is killed.\n
         -a, --archive       Convert back folder into zip archive.\n
+        -j, --jobs          Number of concurrent pulls, adaptive by default.\n
+        --all-devices       Run on every attached device in parallel.\n
+        -i, --incremental   Pull only apks changed since an existing back up.\n
+        -s, --store         Keep apks in a content addressed store.\n
+        --compression       stored, deflated or auto compression of archived apks.\n
+        --compression-level zlib level 1 to 9 of deflated apks.\n
+        -n, --name          Back up to restore from a store.\n
+        -b, --batch-size    Apks committed per install session.\n
+        -p, --priority      File listing packages to install first.\n
+        --include           Restore only packages matching a glob or re: regex.\n
+        --exclude           Skip packages matching a glob or re: regex.\n
+        --force             Reinstall apks the device has at the same version.\n
+        --resume            Continue an interrupted back up or restore.\n
+        --keep-going        Save the back up without apks failing to pull.\n
+        --restore           Back up serve restores to every connected device.\n
+        --address           Unix socket path or host:port of the daemon job API.\n
         -h, --help          Show this help message.\n
         -v, --version       Display version.\n
     Commands:\n
         b, backup          Make Android backup.\n
         r, restore         Restore back to Android device.\n
+        serve              Restore every device as soon as it gets connected.\n
+        daemon             Keep adb-server running and serve back up and restore jobs.\n
+        gc                 Remove store blobs no back up references.\n
+        compact            Store older apk versions as deltas against the newest.\n
     Arguments:\n
-        <path>        File path .\n
+        <path>        File path, - streams a tar back up on stdout or from stdin.\n
     """
-    pass
+    from mass_apk.metrics import Profiler, metrics
+
+    init_logging()
+    options = ctx.ensure_object(dict)
+    options["backend"] = Adb.Backend(backend)
+    options["no_daemon"] = no_daemon
+    # 0 disables a timeout
+    options["timeouts"] = Timeouts(timeout or None, transfer_timeout or None)
+
+    metrics.reset()
+    profiler = None
+    if profile:
+        profiler = Profiler()
+        profiler.start()
+
+    def write_reports() -> None:
+        # runs when the command returns or exits, failed runs are reported too
+        if profiler is not None and profile:
+            profiler.stop(profile)
+            log.info("Profile saved into %s", profile)
+        if report:
+            metrics.write_json(
+                report, command=ctx.invoked_subcommand, argv=sys.argv[1:]
+            )
+            log.info("Run report saved into %s", report)
+        if prometheus:
+            metrics.write_prometheus(prometheus)
+
+    ctx.call_on_close(write_reports)
+
+
+def _package_filter(
+    include: Tuple[str, ...], exclude: Tuple[str, ...]
+) -> "PackageFilter":
+    """Create filter of `--include` and `--exclude` patterns, exit if invalid."""
+    from mass_apk.sources import PackageFilter
+
+    try:
+        return PackageFilter(include, exclude)
+    except MassApkError as error:
+        raise click.BadParameter(str(error))
+
+
+def _attached_devices(server: Adb) -> List[str]:
+    """Return serials of attached devices, exit if there is none."""
+    serials = server.devices()
+    if not serials:
+        click.echo("Device not connected.")
+        server.stop_server()
+        sys.exit(0)
+    log.info("Devices connected: %s", ", ".join(serials))
+    return serials
+
+
+def _exit_on_failures(server: Adb, results: List["DeviceResult"]) -> None:
+    """Log per device summary, exit with error if any device failed."""
+    from mass_apk.fleet import log_summary
+
+    log_summary(results)
+    if any(result.error is not None for result in results):
+        server.stop_server()
+        sys.exit(-1)
 
 
 @click.option(
@@ -59,17 +285,155 @@ def cli():
     is_flag=True,
     help="Store backup into a zip archive  instead of a directory",
 )
-@click.argument("path", metavar="PATH", type=click.Path())
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    help="Number of apks pulled concurrently, adapts to device and usb bus "
+    "throughput when not given",
+)
+@click.option(
+    "--all-devices",
+    is_flag=True,
+    help="Back up every attached device into PATH/<serial>",
+)
+@click.option(
+    "--incremental",
+    "-i",
+    type=click.Path(exists=True, file_okay=False),
+    help="Existing back up folder, pull only packages new or changed since it",
+)
+@click.option(
+    "--store",
+    "-s",
+    "store_path",
+    type=click.Path(file_okay=False),
+    help="Content addressed store keeping a single copy of each apk",
+)
+@click.option(
+    "--compression",
+    default="auto",
+    # same as `ziptools.COMPRESSION_CHOICES`, spelled out to keep zipfile
+    # out of `--help`
+    type=click.Choice(("stored", "deflated", "auto")),
+    show_default=True,
+    help="How apks are compressed in the archive, auto deflates only what shrinks",
+)
+@click.option(
+    "--compression-level",
+    "level",
+    # same as `ziptools.COMPRESSION_LEVELS`
+    type=click.IntRange(1, 9),
+    help="zlib level of deflated apks, 1 is fastest, 9 compresses most",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted run, skipping apks it already completed",
+)
+@click.option(
+    "--keep-going",
+    is_flag=True,
+    help="Pull the other apks when one fails, save the back up without it "
+    "and list failures at the end",
+)
+@click.argument("path", metavar="PATH", type=click.Path(allow_dash=True))
 @cli.command("backup")
-def backup(path: os.PathLike, list_flag: str, archive: bool):
-    """Back up android device."""
-    if isinstance(path, pathlib.Path) is False:
-        path = pathlib.Path(path)
-        if path.exists():
-            click.echo("Back up path already exists")
-            sys.exit(0)
+def backup(
+    path: str,
+    list_flag: str,
+    archive: bool,
+    jobs: Optional[int],
+    all_devices: bool,
+    incremental: Optional[str],
+    store_path: Optional[str],
+    compression: str,
+    level: Optional[int],
+    resume: bool,
+    keep_going: bool,
+):
+    """Back up android device, PATH - writes a tar stream on stdout."""
+    from mass_apk.commands import IncompleteBackupError, backup_device
+    from mass_apk.fleet import run_on_devices
+    from mass_apk.store import ApkStore
+
+    previous = pathlib.Path(incremental) if incremental else None
+    if os.fspath(path) == "-":
+        if archive or all_devices or store_path or resume:
+            raise click.UsageError(
+                "PATH - streams a single device, it can't be used with "
+                "--archive, --all-devices, --store or --resume"
+            )
+        _backup_stream(list_flag, jobs, previous, keep_going)
+        return
+
+    store = ApkStore(store_path).init() if store_path else None
+    backup_path = pathlib.Path(path)
+    # an incremental back up may update the previous back up in place
+    in_place = (
+        previous is not None and backup_path.exists() and backup_path.samefile(previous)
+    )
+    if backup_path.exists() and not (in_place or resume):
+        click.echo("Back up path already exists")
+        sys.exit(0)
 
-    server = Adb(auto_start=True)
+    client = _daemon_client()
+    if client is not None:
+
+        def backup_args(serial: Optional[str]) -> Dict[str, Any]:
+            device_path = (
+                backup_path / serial if all_devices and serial else backup_path
+            )
+            device_previous = previous
+            if all_devices and previous and serial:
+                device_previous = previous / serial
+            return {
+                "path": os.path.abspath(device_path),
+                "list_flag": list_flag,
+                "archive": archive,
+                "jobs": jobs or 0,
+                "incremental": (
+                    os.path.abspath(device_previous) if device_previous else ""
+                ),
+                "store": os.path.abspath(store_path) if store_path else "",
+                "store_name": f"{backup_path.name}-{serial}" if all_devices else "",
+                "compression": compression,
+                "level": level or 0,
+                "resume": resume,
+                "keep_going": keep_going,
+            }
+
+        _run_in_daemon(client, "backup", backup_args, all_devices)
+        log.info("Back up done.")
+        return
+
+    server = _connect_server()
+
+    if all_devices:
+        serials = _attached_devices(server)
+        os.makedirs(backup_path, exist_ok=previous is not None or resume)
+        results = run_on_devices(
+            server,
+            serials,
+            lambda device: backup_device(
+                device,
+                backup_path / device.device_label,
+                list_flag,
+                archive,
+                jobs,
+                previous / device.device_label if previous else None,
+                store,
+                f"{backup_path.name}-{device.device_label}",
+                compression,
+                resume,
+                level,
+                keep_going=keep_going,
+            ),
+        )
+        _exit_on_failures(server, results)
+        server.stop_server()
+        log.info("Back up done.")
+        return
 
     if server.state is not server.ConnectionState.CONNECTED:
         click.echo("Device not connected.")
@@ -77,41 +441,72 @@ def backup(path: os.PathLike, list_flag: str, archive: bool):
         sys.exit(0)
     log.info("Device connected")
 
-    # get user installed packages
-    apks = server.list_device(list_flag)
+    try:
+        backup_device(
+            server,
+            backup_path,
+            list_flag,
+            archive,
+            jobs,
+            previous,
+            store,
+            compression=compression,
+            resume=resume,
+            level=level,
+            keep_going=keep_going,
+        )
+    except IncompleteBackupError as error:
+        click.echo("Back up saved incomplete\n{0}".format(str(error)), err=True)
+        server.stop_server()
+        sys.exit(-1)
+    except MassApkError as error:
+        click.echo("Error during back up\n{0}".format(str(error)), err=True)
+        click.echo("Run again with --resume to continue it", err=True)
+        server.stop_server()
+        sys.exit(-1)
 
-    log.info("Discovering apk paths, this may take a while...")
-    # get full path on the android filesystem for each installed package
-    parsed_paths = map_apk_paths(apks)
+    server.stop_server()
+    log.info("Back up done.")
 
-    log.info("Found %s installed packages", len(apks))
 
-    try:
-        os.makedirs(path)
-    except FileExistsError:
-        click.echo("Back up destination already exists", err=True)
-        sys.exit(-1)
+def _backup_stream(
+    list_flag: str,
+    jobs: Optional[int],
+    previous: Optional[pathlib.Path],
+    keep_going: bool,
+) -> None:
+    """Back up the device as a tar stream on stdout, logging on stderr."""
+    import shutil
+    import tempfile
 
-    for progress, item in enumerate(parsed_paths, 1):
-        msg = f"[{progress:4}/{len(parsed_paths):4}] pulling ... {item.name}"
-        log.info(msg)
-        try:
-            server.pull(item.fullpath)  # get apk from device
-        except AdbError as error:
-            click.echo("Error during pulling {0}\n{1}".format(item, str(error)), err=True)
-            server.stop_server()
-            sys.exit(-1)
+    from mass_apk.commands import backup_device
 
-        # all apks retrieved with adb are saved under the same name,  `base.apk`
-        # time to use a handy AbsPath named tuple to set correct name to apk
-        # pulled with adb this is the correct name of the apk relative to the filesystem
-        dest = os.path.join(path, f"{item.name}.apk")
-        shutil.move("base.apk", dest)
+    init_logging(stream=sys.stderr)
+    server = _connect_server()
+    if server.state is not server.ConnectionState.CONNECTED:
+        click.echo("Device not connected.", err=True)
+        server.stop_server()
+        sys.exit(-1)
 
-    if archive:
-        log.info(f"Creating zip archive: {path}.zip, this may take a while")
-        zipify(path, path.parent / (path.name + ".zip"))
-        shutil.rmtree(path)
+    # apks being pulled land here before they are written to the stream
+    work_dir = tempfile.mkdtemp(prefix="mass-apk-")
+    try:
+        backup_device(
+            server,
+            pathlib.Path(work_dir) / "stream",
+            list_flag,
+            False,
+            jobs,
+            previous,
+            stream=click.get_binary_stream("stdout"),
+            keep_going=keep_going,
+        )
+    except MassApkError as error:
+        click.echo("Error during back up\n{0}".format(str(error)), err=True)
+        server.stop_server()
+        sys.exit(-1)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
     server.stop_server()
     log.info("Back up done.")
@@ -120,18 +515,99 @@ def backup(path: os.PathLike, list_flag: str, archive: bool):
 @click.option(
     "--clean", is_flag=True, help="Remove files after finish restoring the backup"
 )
-@click.argument("path", type=click.Path(exists=True))
+@click.option(
+    "--all-devices",
+    is_flag=True,
+    help="Restore the back up to every attached device",
+)
+@click.option(
+    "--name",
+    "-n",
+    help="Back up to restore when PATH is a store, defaults to the latest one",
+)
+@click.option(
+    "--batch-size",
+    "-b",
+    default=16,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help="Apks committed per install session, 1 installs them one by one",
+)
+@click.option(
+    "--priority",
+    "-p",
+    "priority_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="File listing packages to install first, one per line",
+)
+@click.option(
+    "--include",
+    multiple=True,
+    help="Restore only packages matching this glob, or regex after `re:`",
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    help="Skip packages matching this glob, or regex after `re:`",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Install apks even when the device has the same or a newer version",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted run, skipping apks it already completed",
+)
+@click.argument("path", type=click.Path(exists=True, allow_dash=True))
 @cli.command("restore")
-def restore(path: Union["os.PathLike[str]", str], clean: bool):
+def restore(
+    path: Union["os.PathLike[str]", str],
+    clean: bool,
+    all_devices: bool,
+    name: Optional[str],
+    batch_size: int,
+    priority_path: Optional[str],
+    include: Tuple[str, ...],
+    exclude: Tuple[str, ...],
+    force: bool,
+    resume: bool,
+):
     """
     Restore command for mass apk installer
 
     :param path:
     :param clean:bool delete folder or files used by restore command before function returns
+    :param all_devices:bool restore to every attached device in parallel
+    :param name: back up name when path is a store
+    :param batch_size: apks committed per install session
+    :param priority_path: file listing packages installed first
+    :param include: patterns of packages to restore, all when empty
+    :param exclude: patterns of packages not to restore
+    :param force: install apks the device has at the same or a newer version
+    :param resume: skip apks an interrupted restore installed
     :return: None
 
     :raises MassApkFileNotFoundError
     """
+    from mass_apk.commands import IncompleteRestoreError, restore_journaled
+    from mass_apk.fleet import run_on_devices
+    from mass_apk.schedule import read_priority
+    from mass_apk.sources import open_sources
+
+    priority = read_priority(priority_path) if priority_path else None
+    select = _package_filter(include, exclude)
+
+    if os.fspath(path) == "-":
+        if clean or all_devices or name or priority or resume:
+            raise click.UsageError(
+                "PATH - restores a stream to a single device, it can't be used "
+                "with --clean, --all-devices, --name, --priority or --resume"
+            )
+        _restore_stream(select, force)
+        return
+
     try:
         os.path.exists(path)
     except FileNotFoundError:
@@ -139,56 +615,284 @@ def restore(path: Union["os.PathLike[str]", str], clean: bool):
             f"Oups, the path for back file or folder ` {path}` is missing !"
         )
 
-    server = Adb(auto_start=True)
+    client = _daemon_client()
+    if client is not None:
+
+        def restore_args(serial: Optional[str]) -> Dict[str, Any]:
+            return {
+                "path": os.path.abspath(path),
+                "name": name or "",
+                "batch_size": batch_size,
+                "priority": priority or [],
+                "include": list(include),
+                "exclude": list(exclude),
+                "force": force,
+                "resume": resume,
+            }
+
+        results = _run_in_daemon(client, "restore", restore_args, all_devices)
+        if clean:
+            _remove_restored_archive(path, [result.serial for result in results])
+        log.info("Restore  done")
+        return
+
+    server = _connect_server()
+
+    if all_devices:
+        serials = _attached_devices(server)
+    else:
+        # wait for adb-server to detect phone
+        if server.state is not server.ConnectionState.CONNECTED:
+            click.echo("Device not connected.")
+            server.stop_server()
+            sys.exit(0)
+        log.info("Device connected")
 
-    # wait for adb-server to detect phone
+    # back up source is opened once even when restoring to many devices,
+    # zip archives are streamed to the device without extracting them
+    try:
+        with open_sources(path, name, select) as apks:
+            log.info(
+                "Total Installation Size: {0:.2f} MB".format(
+                    sum(apk.size for apk in apks) / MB
+                )
+            )
+
+            if all_devices:
+                results = run_on_devices(
+                    server,
+                    serials,
+                    lambda device: restore_journaled(
+                        device, path, apks, batch_size, resume, priority, force
+                    ),
+                )
+                _exit_on_failures(server, results)
+            else:
+                try:
+                    log.info(
+                        restore_journaled(
+                            server, path, apks, batch_size, resume, priority, force
+                        )
+                    )
+                except IncompleteRestoreError as error:
+                    click.echo("Restore incomplete\n{0}".format(str(error)), err=True)
+                    click.echo("Run again with --resume to retry them", err=True)
+                    server.stop_server()
+                    sys.exit(-1)
+                except AdbError as error:
+                    click.echo(
+                        "Error during installing\n{0}".format(str(error)), err=True
+                    )
+                    click.echo("Run again with --resume to continue it", err=True)
+                    server.stop_server()
+                    sys.exit(-1)
+    except MassApkError as error:
+        click.echo("Error reading back up\n{0}".format(str(error)), err=True)
+        server.stop_server()
+        sys.exit(-1)
+
+    if clean:
+        _remove_restored_archive(path, serials if all_devices else [server.serial])
+
+    server.stop_server()
+    log.info("Restore  done")
+
+
+def _restore_stream(select: "PackageFilter", force: bool) -> None:
+    """Restore a back up tar stream read from stdin, installing apks as they arrive."""
+    from mass_apk.commands import IncompleteRestoreError, restore_stream
+
+    server = _connect_server()
     if server.state is not server.ConnectionState.CONNECTED:
         click.echo("Device not connected.")
         server.stop_server()
-        sys.exit(0)
+        sys.exit(-1)
     log.info("Device connected")
 
-    cleanup_todo = []  # keep track of files/dir to delete before returning
+    try:
+        stdin = click.get_binary_stream("stdin")
+        log.info(restore_stream(server, stdin, select, force))
+    except IncompleteRestoreError as error:
+        click.echo("Restore incomplete\n{0}".format(str(error)), err=True)
+        server.stop_server()
+        sys.exit(-1)
+    except MassApkError as error:
+        click.echo("Error reading back up stream\n{0}".format(str(error)), err=True)
+        server.stop_server()
+        sys.exit(-1)
 
-    if os.path.isdir(path):  # restore a folder back up
-        log.info(f"Restoring back up from path `{path}` *  *Folder*")
-        root_dir_back_up = path
+    server.stop_server()
+    log.info("Restore  done")
 
-    elif (
-        os.path.isfile(path) and os.path.splitext(path)[1] == ".zip"
-    ):  # restore a zip archive back up
-        log.info(f"Restoring back up from path {path} *  *Zip*")
-        extract_to = os.path.splitext(path)[0]
-        unzipify(file=path, dest_dir=extract_to)
-        root_dir_back_up = extract_to  # set as path root the folder with apk extracted from zip file
-        cleanup_todo = [extract_to, path]
 
-    apks = [file for file in os.listdir(root_dir_back_up) if file.endswith(".apk")]
+def _remove_restored_archive(
+    path: Union["os.PathLike[str]", str], serials: Sequence[Optional[str]]
+) -> None:
+    """Remove back up `path` restored to `serials` if it is a zip archive.
 
-    # calculate total installation size
-    size = [os.path.getsize(os.path.join(root_dir_back_up, apk)) for apk in apks]
+    Back up folders and stores are kept, an archive is also kept while a
+    restore journal needs it to resume.
+    """
+    from mass_apk.commands import restore_journal_path
 
-    log.info(
-        "Total Installation Size: {0:.2f} MB".format(sum(size) / (MB))
+    unfinished = any(
+        os.path.exists(restore_journal_path(path, serial)) for serial in serials
     )
+    if os.path.isfile(path) and not unfinished:
+        os.remove(path)
 
-    for progress, apk in enumerate(apks, 1):
-        msg = f"[{progress}/{len(apks)}] Installing {apk}"
-        log.info(msg
-                 )
-        try:
-            server.push(os.path.join(root_dir_back_up, apk))
-        except AdbError as error:
-            click.echo("Error during pulling {0}\n{1}".format(apk, str(error)), err=True)
-            server.stop_server()
-            sys.exit(-1)
 
-    if clean:
-        for item in cleanup_todo:
-            if os.path.isdir(item):
-                shutil.rmtree(item)
-            else:
-                os.remove(item)
+@click.option(
+    "--restore",
+    "restore_path",
+    required=True,
+    type=click.Path(exists=True),
+    help="Back up restored to every device once it is connected",
+)
+@click.option(
+    "--name",
+    "-n",
+    help="Back up to restore when the path is a store, defaults to the latest one",
+)
+@click.option(
+    "--batch-size",
+    "-b",
+    default=16,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help="Apks committed per install session, 1 installs them one by one",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    help="Devices restored at once, defaults to a few per cpu",
+)
+@click.option(
+    "--priority",
+    "-p",
+    "priority_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="File listing packages to install first, one per line",
+)
+@click.option(
+    "--include",
+    multiple=True,
+    help="Restore only packages matching this glob, or regex after `re:`",
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    help="Skip packages matching this glob, or regex after `re:`",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Install apks even when the device has the same or a newer version",
+)
+@cli.command("serve")
+def serve(
+    restore_path: str,
+    name: Optional[str],
+    batch_size: int,
+    jobs: Optional[int],
+    priority_path: Optional[str],
+    include: Tuple[str, ...],
+    exclude: Tuple[str, ...],
+    force: bool,
+):
+    """Restore a back up to every device as soon as it gets connected.
+
+    Runs until interrupted with Ctrl+C, restores in progress are finished.
+    """
+    from mass_apk.commands import serve_restore
+    from mass_apk.schedule import read_priority
+    from mass_apk.sources import open_sources
+
+    priority = read_priority(priority_path) if priority_path else None
+    select = _package_filter(include, exclude)
+
+    server = _connect_server()
+    try:
+        with open_sources(restore_path, name, select) as apks:
+            log.info(
+                "Total Installation Size: {0:.2f} MB".format(
+                    sum(apk.size for apk in apks) / MB
+                )
+            )
+            results = serve_restore(
+                server,
+                restore_path,
+                apks,
+                batch_size,
+                jobs,
+                priority=priority,
+                force=force,
+            )
+    except MassApkError as error:
+        click.echo("Error reading back up\n{0}".format(str(error)), err=True)
+        server.stop_server()
+        sys.exit(-1)
 
+    _exit_on_failures(server, results)
     server.stop_server()
-    log.info("Restore  done")
+    log.info("Serve done")
+
+
+@click.option(
+    "--address",
+    help="Unix socket path or host:port to serve jobs on, defaults to a user socket",
+)
+@cli.command("daemon")
+def daemon(address: Optional[str]):
+    """Keep adb-server running and serve back up and restore jobs.
+
+    Runs until interrupted with Ctrl+C or asked to shut down, running jobs
+    are finished. backup and restore hand their work to the daemon.
+    """
+    from mass_apk.daemon import Daemon, DaemonError
+
+    # adb-server belongs to another daemon if the address is taken
+    server = _connect_server(auto_start=False)
+    try:
+        jobs_daemon = Daemon(server, address)
+    except (DaemonError, OSError) as error:
+        click.echo("Can't start daemon\n{0}".format(str(error)), err=True)
+        sys.exit(-1)
+
+    server.start_server()
+    try:
+        jobs_daemon.serve_forever()
+    finally:
+        server.stop_server()
+    log.info("Daemon stopped")
+
+
+@click.option("--dry-run", is_flag=True, help="Only report blobs that would be removed")
+@click.argument("store_path", metavar="STORE", type=click.Path(exists=True))
+@cli.command("gc")
+def gc(store_path: str, dry_run: bool):
+    """Remove apks no back up of the store references."""
+    from mass_apk.store import ApkStore
+
+    if not ApkStore.is_store(store_path):
+        click.echo(f"Not a store {store_path}", err=True)
+        sys.exit(-1)
+
+    removed, freed = ApkStore(store_path).gc(dry_run=dry_run)
+    log.info("Removed %s blobs, %.2f MB", removed, freed / MB)
+
+
+@click.option("--dry-run", is_flag=True, help="Only report the space deltas would save")
+@click.argument("store_path", metavar="STORE", type=click.Path(exists=True))
+@cli.command("compact")
+def compact(store_path: str, dry_run: bool):
+    """Store older apk versions of the store as deltas against the newest."""
+    from mass_apk.store import ApkStore
+
+    if not ApkStore.is_store(store_path):
+        click.echo(f"Not a store {store_path}", err=True)
+        sys.exit(-1)
+
+    encoded, saved = ApkStore(store_path).compact(dry_run=dry_run)
+    log.info("Stored %s apks as deltas, saved %.2f MB", encoded, saved / MB)
@@ -0,0 +1,625 @@
+"""Back up and restore of devices, the work behind cli commands."""
+
+from typing import BinaryIO, Callable, Dict, List, Optional, Set, Tuple, Union
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import tempfile
+import threading
+
+from mass_apk.adb import Adb, AdbError
+from mass_apk.axml import AxmlError, read_apk_info
+from mass_apk.apk import ApkAbsPath, map_apk_paths, split_file
+from mass_apk.exceptions import MassApkError
+from mass_apk.fleet import DeviceResult, run_on_device
+from mass_apk.helpers import MB, link_or_copy
+from mass_apk.installer import InstallPackage, install_packages
+from mass_apk.journal import JOURNAL_NAME, Journal
+from mass_apk.manifest import (
+    MANIFEST_NAME,
+    Manifest,
+    ManifestEntry,
+    PackageInfo,
+    SplitEntry,
+    entry_files,
+    entry_from_dict,
+    entry_to_dict,
+    query_package_info,
+    sha256_file,
+)
+from mass_apk.schedule import estimator, format_eta, schedule_apks
+from mass_apk.sources import (
+    ApkSource,
+    PackageFilter,
+    package_name,
+    package_size,
+    stream_sources,
+)
+from mass_apk.store import ApkStore, device_sha256
+from mass_apk.transfer import Progress, pull_apks
+from mass_apk.versions import installed_versions, split_up_to_date
+from mass_apk.watcher import READY, DeviceWatcher
+from mass_apk.ziptools import TarSink, ZipSink, zipify
+
+__all__ = [
+    "IncompleteBackupError",
+    "IncompleteRestoreError",
+    "backup_device",
+    "restore_device",
+    "restore_journaled",
+    "restore_journal_path",
+    "restore_stream",
+    "serve_restore",
+]
+
+log = logging.getLogger(__name__)
+
+
+class IncompleteBackupError(MassApkError):
+    """Exception raised when a back up is saved without apks that failed to pull."""
+
+
+class IncompleteRestoreError(MassApkError):
+    """Exception raised when a restore is over but some apks failed to install."""
+
+
+def backup_device(
+    server: Adb,
+    path: pathlib.Path,
+    list_flag: str,
+    archive: bool,
+    jobs: Optional[int],
+    incremental: Optional[pathlib.Path] = None,
+    store: Optional[ApkStore] = None,
+    store_name: Optional[str] = None,
+    compression: str = "auto",
+    resume: bool = False,
+    level: Optional[int] = None,
+    stream: Optional[BinaryIO] = None,
+    keep_going: bool = False,
+) -> str:
+    """Back up apks of the device behind `server` into `path`.
+
+    With `incremental`, an existing back up folder, only packages new or
+    changed since that back up are pulled, the rest are carried forward.
+
+    With `store` apks already in the store are linked instead of pulled and
+    the back up is recorded in the store as `store_name`, by default the
+    name of `path`.
+
+    With `archive` apks are appended to `<path>.zip` as soon as they are
+    pulled, `path` only holds the apks being transferred. Deflated apks
+    are compressed with zlib `level`.
+
+    With `stream` apks are written to it as a tar stream as soon as they
+    are pulled, the manifest last, `path` only holds the apks being
+    transferred and is removed once done.
+
+    Progress is journaled in `path`, with `resume` apks an interrupted run
+    completed are kept and only the others are pulled.
+
+    A failed pull aborts the back up, with `keep_going` the back up is
+    saved without the apks that failed to pull.
+
+    :raises IncompleteBackupError listing apks left out with `keep_going`.
+    :raises MassApkError if the backup can't be completed.
+    """
+    previous = Manifest.load(incremental) if incremental is not None else None
+
+    # get user installed packages
+    apks = server.list_device(list_flag)
+
+    log.info("Discovering apk paths, this may take a while...")
+    # get full path on the android filesystem for each installed package
+    parsed_paths = map_apk_paths(apks, list_flag, server=server)
+
+    log.info("Found %s installed packages", len(apks))
+
+    in_place = (
+        incremental is not None
+        and os.path.isdir(path)
+        and os.path.samefile(incremental, path)
+    )
+    try:
+        os.makedirs(path, exist_ok=in_place or resume)
+    except FileExistsError:
+        raise MassApkError(f"Back up destination already exists {path}")
+
+    # store ingestion needs the folder layout, archive it once complete
+    sink: Union[TarSink, ZipSink, None] = None
+    if stream is not None:
+        sink = TarSink(stream)
+    elif archive and store is None:
+        sink = ZipSink(path.parent / (path.name + ".zip"), compression, resume, level)
+    journal = Journal(path / JOURNAL_NAME, resume)
+    # one dumpsys pass provides versionCode and lastUpdateTime of all packages
+    writer = _BackupWriter(path, query_package_info(server), sink, journal)
+
+    to_pull = parsed_paths
+    if previous is not None and incremental is not None:
+        to_pull = _carry_forward(writer, previous, incremental, parsed_paths)
+    if resume:
+        to_pull = _reconcile_resumed(writer, journal, to_pull)
+    if store is not None:
+        to_pull = _link_stored(writer, server, store, to_pull, in_place)
+
+    try:
+        pulled = pull_apks(
+            server,
+            to_pull,
+            path,
+            jobs=jobs,
+            on_pulled=lambda item, dest, size: writer.record(item, dest),
+            journal=journal,
+            keep_going=keep_going,
+        )
+    except BaseException:
+        # keep what was transferred so far for a resumed run
+        if sink is not None:
+            sink.abort(keep=True)
+        journal.close()
+        raise
+    log.info("Pulled %s apks, %.2f MB", pulled.files, pulled.bytes / MB)
+    journal.close(remove=True)
+
+    manifest = writer.manifest
+    if sink is not None:
+        sink.writestr(MANIFEST_NAME, manifest.to_json())
+        sink.close()
+        shutil.rmtree(path)
+    else:
+        if in_place and previous is not None:
+            _remove_stale(
+                path, previous, manifest, {item.name for item in parsed_paths}
+            )
+        manifest.save(path)
+        if store is not None:
+            store.ingest(path, store_name or path.name)
+        if archive:
+            log.info(f"Creating zip archive: {path}.zip, this may take a while")
+            zipify(path, path.parent / (path.name + ".zip"), compression, level)
+            shutil.rmtree(path)
+
+    carried = len(manifest) - pulled.files
+    summary = f"{pulled.files} apks {pulled.bytes / MB:.2f} MB, {carried} unchanged"
+    if pulled.failed:
+        names = ", ".join(name for name, _ in pulled.failed)
+        raise IncompleteBackupError(f"{summary}, {len(pulled.failed)} failed: {names}")
+    return summary
+
+
+class _BackupWriter(object):
+    """Destination of a back up, its folder or `sink`, and the manifest of it.
+
+    With a sink apks are moved from the folder into the sink once recorded.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        infos: Dict[str, PackageInfo],
+        sink: Union[TarSink, ZipSink, None],
+        journal: Journal,
+    ):
+        self.path = path
+        self.infos = infos
+        self.manifest = Manifest()
+        self._sink = sink
+        # archived by an interrupted run, possibly after its journal was written
+        self.archived = sink.names() if sink is not None else set()
+        self._journal = journal
+
+    def carry(self, src_dir: Union[str, os.PathLike], entry: ManifestEntry) -> None:
+        """Add `entry`, its apks taken from back up `src_dir`, unchanged."""
+        for file, _ in entry_files(entry):
+            src = os.path.join(src_dir, file)
+            dest = os.path.join(self.path, file)
+            if self._sink is not None:
+                if file not in self.archived:
+                    self._sink.add_file(src, file)
+            elif not os.path.exists(dest):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                link_or_copy(src, dest)
+        self.manifest.add(entry)
+
+    def record(self, item: ApkAbsPath, dest: str, sha256: str = "") -> None:
+        """Add apk `dest` and split apks of `item`, pulled into the folder."""
+        info = self.infos.get(item.name)
+        entry = ManifestEntry(
+            item.name,
+            info.version_code if info else None,
+            info.last_update_time if info else None,
+            os.path.getsize(dest),
+            sha256 or sha256_file(dest),
+            os.path.basename(dest),
+            _split_entries(self.path, item),
+        )
+        self.manifest.add(entry)
+        if self._sink is not None:
+            for file, _ in entry_files(entry):
+                if file not in self.archived:
+                    self._sink.add_file(os.path.join(self.path, file), file)
+                os.remove(os.path.join(self.path, file))
+        self._journal.done(item.name, **entry_to_dict(entry))
+
+
+def _split_entries(path: pathlib.Path, item: ApkAbsPath) -> Tuple[SplitEntry, ...]:
+    """Return manifest entries of split apks of `item` pulled into `path`."""
+    splits = []
+    for split in item.splits:
+        file = split_file(item.name, split)
+        split_path = os.path.join(path, file)
+        splits.append(
+            SplitEntry(file, os.path.getsize(split_path), sha256_file(split_path))
+        )
+    return tuple(splits)
+
+
+def _carry_forward(
+    writer: _BackupWriter,
+    previous: Manifest,
+    incremental: pathlib.Path,
+    items: List[ApkAbsPath],
+) -> List[ApkAbsPath]:
+    """Carry forward packages unchanged since back up `incremental`.
+
+    Return items still to pull, new or updated packages and those whose
+    apks are missing from `incremental`.
+    """
+    to_pull = []
+    for item in items:
+        entry = previous.get(item.name)
+        if (
+            entry is not None
+            and previous.is_current(writer.infos.get(item.name))
+            and all(
+                os.path.isfile(os.path.join(incremental, file))
+                for file, _ in entry_files(entry)
+            )
+        ):
+            writer.carry(incremental, entry)
+        else:
+            to_pull.append(item)
+    log.info(
+        "%s packages unchanged, %s new or updated", len(writer.manifest), len(to_pull)
+    )
+    return to_pull
+
+
+def _reconcile_resumed(
+    writer: _BackupWriter, journal: Journal, items: List[ApkAbsPath]
+) -> List[ApkAbsPath]:
+    """Keep apks of `items` an interrupted run completed, return those to pull."""
+    pending = []
+    for item in items:
+        done = journal.record(item.name)
+        dest = os.path.join(writer.path, f"{item.name}.apk")
+        if done is not None and done.get("file") in writer.archived:
+            fields = {f: done[f] for f in ManifestEntry._fields if f in done}
+            writer.manifest.add(entry_from_dict(fields))
+        elif done is not None and _is_complete(dest, done.get("size")):
+            # pulled before the interruption but not archived yet
+            writer.record(item, dest, done["sha256"])
+        else:
+            # in flight or failed when interrupted, pull it again
+            if os.path.exists(dest):
+                os.remove(dest)
+            pending.append(item)
+    log.info("%s apks pulled by the interrupted run", len(items) - len(pending))
+    return pending
+
+
+def _link_stored(
+    writer: _BackupWriter,
+    server: Adb,
+    store: ApkStore,
+    items: List[ApkAbsPath],
+    in_place: bool,
+) -> List[ApkAbsPath]:
+    """Copy apks of `items` already in `store` out of it, return those to pull."""
+    # hash apks on the device, those already stored don't need a transfer
+    apk_paths = {item: [p for p, _ in _item_files(item)] for item in items}
+    hashes = device_sha256(server, itertools.chain(*apk_paths.values()))
+    stored = [
+        item
+        for item in items
+        if all(store.has(hashes.get(p, "")) for p in apk_paths[item])
+    ]
+    for item in stored:
+        for apk_path, file in _item_files(item):
+            dest = os.path.join(writer.path, file)
+            if in_place and os.path.exists(dest):
+                # may be linked from an older back up, don't copy into it
+                os.remove(dest)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            store.copy_blob(hashes[apk_path], dest)
+        writer.record(
+            item, os.path.join(writer.path, f"{item.name}.apk"), hashes[item.fullpath]
+        )
+    log.info("%s apks found in store %s", len(stored), store.root)
+    return [item for item in items if item not in stored]
+
+
+def _item_files(item: ApkAbsPath) -> List[Tuple[str, str]]:
+    """Return device path and back up file of the apk and split apks of `item`."""
+    return [(item.fullpath, f"{item.name}.apk")] + [
+        (split, split_file(item.name, split)) for split in item.splits
+    ]
+
+
+def _remove_stale(
+    path: pathlib.Path, previous: Manifest, manifest: Manifest, listed: Set[str]
+) -> None:
+    """Remove apks of `previous` back up in `path` that `manifest` replaces.
+
+    Apks of packages no longer `listed` on the device and split apks an
+    update dropped are removed, those of packages that failed to pull are
+    kept.
+    """
+    kept = {file for entry in manifest for file, _ in entry_files(entry)}
+    for entry in previous:
+        if entry.package in listed and entry.package not in manifest:
+            continue
+        for file, _ in entry_files(entry):
+            if file not in kept and os.path.isfile(path / file):
+                log.info("Removing %s, no longer installed", file)
+                os.remove(path / file)
+        if entry.splits and os.path.isdir(path / entry.package):
+            with contextlib.suppress(OSError):
+                # only once it's empty
+                os.rmdir(path / entry.package)
+
+
+def _is_complete(path: str, size: Optional[int]) -> bool:
+    """Check if file `path` exists with the expected `size`."""
+    return os.path.isfile(path) and os.path.getsize(path) == size
+
+
+def restore_device(
+    server: Adb,
+    apks: List[ApkSource],
+    batch_size: int = 1,
+    journal: Optional[Journal] = None,
+    priority: Optional[List[str]] = None,
+    force: bool = False,
+) -> str:
+    """Install `apks` to the device behind `server`.
+
+    Apks are committed `batch_size` at a time through package manager
+    sessions, one by one with `adb install` when `batch_size` is 1.
+    Packages of `priority` are installed first, then the largest apks.
+    Apks the device has at the same or a newer version are skipped unless
+    `force` is set.
+
+    With `journal` apks it records as installed are skipped and every
+    install outcome is journaled.
+
+    :raises IncompleteRestoreError listing apks that failed to install once
+        the others are installed.
+    """
+    if journal is not None:
+        pending = [apk for apk in apks if not _is_installed(journal, apk)]
+        if len(pending) < len(apks):
+            log.info(
+                "%s apks installed by the interrupted run", len(apks) - len(pending)
+            )
+        apks = pending
+
+    up_to_date: List[ApkSource] = []
+    if not force:
+        apks, up_to_date = split_up_to_date(server, apks)
+        log.info(
+            "%s apks already installed at the same or newer version", len(up_to_date)
+        )
+    if journal is not None:
+        for apk in up_to_date:
+            journal.done(apk.name, size=package_size(apk))
+        journal.start(*(apk.name for apk in apks))
+
+    apks = schedule_apks(apks, priority)
+    total = sum(package_size(apk) for apk in apks)
+    log.info(
+        "%s apks %.2f MB to install, %s",
+        len(apks),
+        total / MB,
+        format_eta(estimator.estimate(total)),
+    )
+    progress = Progress(
+        len(apks),
+        verb="installed",
+        label=server.serial or "",
+        total_bytes=total,
+        estimator=estimator,
+    )
+
+    def installed(package: InstallPackage) -> None:
+        size = sum(apk.size for apk in package.apks)
+        if journal is not None:
+            journal.done(package.name, size=size)
+        progress.advance(package.name, size)
+
+    results = install_packages(server, apks, batch_size, installed)
+
+    failed = [result for result in results if result.error is not None]
+    if journal is not None:
+        for result in failed:
+            journal.fail(result.name, result.error)
+    summary = f"{progress.files} apks {progress.bytes / MB:.2f} MB"
+    if up_to_date:
+        summary += f", {len(up_to_date)} up to date"
+    if failed:
+        summary += f", {len(failed)} failed: "
+        summary += ", ".join(result.name for result in failed)
+        raise IncompleteRestoreError(summary)
+    return summary
+
+
+def _is_installed(journal: Journal, apk: ApkSource) -> bool:
+    """Check if `journal` records `apk` as installed."""
+    done = journal.record(apk.name)
+    return done is not None and done.get("size") == package_size(apk)
+
+
+def restore_journal_path(path: Union[str, os.PathLike], serial: Optional[str]) -> str:
+    """Return journal path of restoring back up `path` to device `serial`."""
+    return f"{os.path.normpath(path)}.{serial or 'device'}.restore{JOURNAL_NAME}"
+
+
+def restore_journaled(
+    server: Adb,
+    path: Union[str, os.PathLike],
+    apks: List[ApkSource],
+    batch_size: int,
+    resume: bool,
+    priority: Optional[List[str]] = None,
+    force: bool = False,
+) -> str:
+    """Restore `apks` journaling progress next to back up `path`.
+
+    The journal is removed once every apk is installed, it is kept for a
+    resumed run otherwise.
+    """
+    journal = Journal(restore_journal_path(path, server.serial), resume)
+    try:
+        summary = restore_device(server, apks, batch_size, journal, priority, force)
+    except BaseException:
+        journal.close()
+        raise
+    complete = all(_is_installed(journal, apk) for apk in apks)
+    journal.close(remove=complete)
+    return summary
+
+
+def _is_up_to_date(in_file: BinaryIO, installed: Optional[int]) -> bool:
+    """Check if the apk of seekable `in_file` is at most `installed` version."""
+    try:
+        version = read_apk_info(in_file).version_code
+    except AxmlError as error:
+        log.debug("Can't read version of streamed apk %s", error)
+        return False
+    return installed is not None and installed >= version
+
+
+def restore_stream(
+    server: Adb,
+    in_file: BinaryIO,
+    select: Optional[PackageFilter] = None,
+    force: bool = False,
+) -> str:
+    """Install apks of back up tar stream `in_file` as they arrive.
+
+    Apks are streamed to the package manager one at a time, memory use
+    doesn't grow with the back up. Only apks of packages the device has
+    are spooled to a temporary file, their version is read to skip those
+    up to date unless `force` is set. Packages with split apks are spooled
+    too and installed through a session. Failed installs are logged and
+    the rest of the stream is restored.
+
+    :raises IncompleteRestoreError listing apks that failed to install.
+    :raises MassApkError if the stream is malformed or truncated.
+    """
+    installed = {} if force else installed_versions(server)
+    progress = Progress(None, verb="installed", label=server.serial or "")
+    up_to_date, failed = 0, []
+    for apk in stream_sources(in_file, select):
+        package = package_name(apk.name)
+        try:
+            with contextlib.ExitStack() as stack:
+                data = stack.enter_context(apk.open())
+                if package in installed:
+                    spooled = stack.enter_context(tempfile.TemporaryFile())
+                    shutil.copyfileobj(data, spooled)
+                    if _is_up_to_date(spooled, installed[package]):
+                        up_to_date += 1
+                        continue
+                    data = spooled
+                    data.seek(0)
+                if apk.splits:
+                    spool_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                    path = os.path.join(spool_dir, os.path.basename(apk.name))
+                    with open(path, "wb") as out_file:
+                        shutil.copyfileobj(data, out_file)
+                    opener = functools.partial(open, path, "rb")
+                    source = apk._replace(path=path, open=opener)
+                    (result,) = install_packages(server, [source], 1)
+                    if result.error is not None:
+                        raise AdbError(result.error)
+                else:
+                    server.push_stream(data, apk.size, apk.name, ignore_errors=False)
+        except AdbError:
+            failed.append(package)
+        else:
+            progress.advance(apk.name, package_size(apk))
+
+    summary = f"{progress.files} apks {progress.bytes / MB:.2f} MB"
+    if up_to_date:
+        summary += f", {up_to_date} up to date"
+    if failed:
+        summary += f", {len(failed)} failed: " + ", ".join(failed)
+        raise IncompleteRestoreError(summary)
+    return summary
+
+
+def serve_restore(
+    server: Adb,
+    path: Union[str, os.PathLike],
+    apks: List[ApkSource],
+    batch_size: int,
+    jobs: Optional[int] = None,
+    stop: Optional[threading.Event] = None,
+    on_result: Optional[Callable[[DeviceResult], None]] = None,
+    priority: Optional[List[str]] = None,
+    force: bool = False,
+) -> List[DeviceResult]:
+    """Restore `apks` to every device as soon as it is ready to accept commands.
+
+    Runs until `stop` is set or the user interrupts it, at most `jobs`
+    devices are restored at once. Devices are noticed through adb-server
+    `track-devices`, there is no polling. A device detached during its
+    restore resumes it when attached again. Return results of every
+    restore, `on_result` is called with each one as it completes.
+    """
+    stop = stop or threading.Event()
+    results: List[DeviceResult] = []
+    busy: Set[str] = set()
+    lock = threading.Lock()
+
+    def restore(device: Adb) -> str:
+        return restore_journaled(device, path, apks, batch_size, True, priority, force)
+
+    def finished(future: "concurrent.futures.Future[DeviceResult]") -> None:
+        result = future.result()
+        with lock:
+            busy.discard(result.serial)
+            results.append(result)
+        if result.error is None:
+            log.info("%s restored %s", result.serial, result.summary)
+        if on_result is not None:
+            on_result(result)
+
+    with DeviceWatcher(server) as watcher, concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs
+    ) as pool:
+        log.info("Waiting for devices, press Ctrl+C to stop")
+        try:
+            while not stop.is_set():
+                try:
+                    event = watcher.events.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                with lock:
+                    if event.kind != READY or event.serial in busy:
+                        continue
+                    busy.add(event.serial)
+                log.info("Restoring %s", event.serial)
+                future = pool.submit(run_on_device, server, event.serial, restore)
+                future.add_done_callback(finished)
+        except KeyboardInterrupt:
+            log.info("Stopping, waiting for %s restores to finish", len(busy))
+    return results
@@ -0,0 +1,591 @@
+"""Long running daemon keeping adb-server and device sessions warm.
+
+Every cli run used to start adb-server and kill it on exit, paying server
+start up, usb re-enumeration and device authorization each time, runs
+overlapping in time killed each other's server. The daemon owns
+adb-server for as long as it runs, `Adb` instances of devices, their
+shell sessions and socket connections stay open between jobs and so do
+process wide caches like apk versions and install speed.
+
+Jobs are submitted over a small json HTTP API served on a Unix socket,
+or a localhost TCP port given as `host:port`,
+
+    POST /jobs          {"command": "restore", "serial": ..., "args": {...}}
+    GET  /jobs          every job
+    GET  /jobs/<id>     one job, `?wait=<seconds>` blocks until it ends
+    GET  /devices       attached devices and their states
+    POST /shutdown      stop once running jobs finish
+
+Jobs of a device run one at a time in submission order, devices run in
+parallel. `backup` and `restore` commands submit their work to a running
+daemon instead of starting adb-server themselves.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import http.client
+import http.server
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from mass_apk.adb import Adb
+from mass_apk.exceptions import MassApkError
+from mass_apk.watcher import DETACHED, READY, DeviceWatcher
+
+__all__ = [
+    "DaemonError",
+    "Job",
+    "Daemon",
+    "DaemonClient",
+    "JOB_ARGS",
+    "default_address",
+    "running_daemon",
+]
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# longest a single `wait` request blocks, clients ask again
+MAX_WAIT = 30.0
+# largest request body accepted
+MAX_BODY = 1024 * 1024
+
+# arguments of each job command and their defaults, None means required
+JOB_ARGS: Dict[str, Dict[str, Any]] = {
+    "backup": {
+        "path": None,
+        "list_flag": "3",
+        "archive": False,
+        "jobs": 0,
+        "incremental": "",
+        "store": "",
+        "store_name": "",
+        "compression": "auto",
+        "level": 0,
+        "resume": False,
+        "keep_going": False,
+    },
+    "restore": {
+        "path": None,
+        "name": "",
+        "batch_size": 16,
+        "priority": [],
+        "include": [],
+        "exclude": [],
+        "force": False,
+        "resume": False,
+    },
+}
+
+
+class DaemonError(MassApkError):
+    """Exception raised for invalid daemon requests or when it can't be reached."""
+
+
+def default_address() -> str:
+    """Return address of the daemon, `MASS_APK_DAEMON` overrides it.
+
+    A Unix socket of the user in the temporary folder, a localhost port
+    where Unix sockets are not available.
+    """
+    address = os.environ.get("MASS_APK_DAEMON")
+    if address:
+        return address
+    if not hasattr(socket, "AF_UNIX"):
+        return "127.0.0.1:5038"
+    return os.path.join(tempfile.gettempdir(), f"mass-apk-{os.getuid()}.sock")
+
+
+def _parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """Return `(host, port)` of a `host:port` address, a socket path otherwise."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and os.sep not in address and "/" not in address:
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+class Job(object):
+    """Back up or restore of a device submitted to the daemon."""
+
+    def __init__(self, job_id: str, command: str, serial: str, args: Dict[str, Any]):
+        self.id = job_id
+        self.command = command
+        self.serial = serial
+        self.args = args
+        self.state = QUEUED
+        self.summary: Optional[str] = None
+        self.error: Optional[str] = None
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.ended = threading.Event()
+
+    def start(self) -> None:
+        """Mark the job as running."""
+        self.state = RUNNING
+        self.started = time.time()
+
+    def finish(self, summary: Optional[str] = None, error: Optional[str] = None):
+        """Mark the job done with `summary` or failed with `error`."""
+        self.summary, self.error = summary, error
+        self.state = FAILED if error is not None else DONE
+        self.finished = time.time()
+        self.ended.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return json serializable state of the job."""
+        return {
+            "id": self.id,
+            "command": self.command,
+            "serial": self.serial,
+            "args": self.args,
+            "state": self.state,
+            "summary": self.summary,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+def _job_args(command: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    """Return `args` of `command` completed with defaults.
+
+    :raises DaemonError if the command is unknown, an argument unknown,
+        missing or of the wrong type.
+    """
+    if command not in JOB_ARGS:
+        raise DaemonError(f"Unknown job command {command!r}")
+    defaults = JOB_ARGS[command]
+    unknown = args.keys() - defaults.keys()
+    if unknown:
+        raise DaemonError(f"Unknown {command} arguments {', '.join(sorted(unknown))}")
+    completed = {}
+    for key, default in defaults.items():
+        value = args.get(key, default)
+        if value is None:
+            raise DaemonError(f"Missing {command} argument {key}")
+        if default is not None and not isinstance(value, type(default)):
+            raise DaemonError(
+                f"{command} argument {key} must be {type(default).__name__}"
+            )
+        completed[key] = value
+    return completed
+
+
+def _run_backup(device: Adb, args: Dict[str, Any]) -> str:
+    import pathlib
+
+    from mass_apk.commands import backup_device
+    from mass_apk.store import ApkStore
+
+    path = pathlib.Path(args["path"])
+    previous = pathlib.Path(args["incremental"]) if args["incremental"] else None
+    in_place = previous is not None and path.exists() and path.samefile(previous)
+    if path.exists() and not (in_place or args["resume"]):
+        raise MassApkError(f"Back up path already exists {path}")
+    store = ApkStore(args["store"]).init() if args["store"] else None
+    return backup_device(
+        device,
+        path,
+        args["list_flag"],
+        args["archive"],
+        args["jobs"] or None,
+        previous,
+        store,
+        args["store_name"] or None,
+        compression=args["compression"],
+        resume=args["resume"],
+        level=args["level"] or None,
+        keep_going=args["keep_going"],
+    )
+
+
+def _run_restore(device: Adb, args: Dict[str, Any]) -> str:
+    from mass_apk.commands import restore_journaled
+    from mass_apk.sources import PackageFilter, open_sources
+
+    select = PackageFilter(args["include"], args["exclude"])
+    with open_sources(args["path"], args["name"] or None, select) as apks:
+        return restore_journaled(
+            device,
+            args["path"],
+            apks,
+            args["batch_size"],
+            args["resume"],
+            args["priority"] or None,
+            args["force"],
+        )
+
+
+_JOB_RUNNERS: Dict[str, Callable[[Adb, Dict[str, Any]], str]] = {
+    "backup": _run_backup,
+    "restore": _run_restore,
+}
+
+
+class Daemon(object):
+    """Serve the job API on `address` running jobs through `server`.
+
+    `server` is expected to be started, it is left running when the
+    daemon stops.
+    """
+
+    def __init__(self, server: Adb, address: Optional[str] = None):
+        self.address = address or default_address()
+        self._server = server
+        self._jobs: Dict[str, Job] = {}
+        self._ids = itertools.count(1)
+        self._devices: Dict[str, Adb] = {}
+        self._queues: Dict[str, "queue.Queue[Optional[Job]]"] = {}
+        self._workers: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._watcher = DeviceWatcher(server)
+        self._http = self._bind()
+
+    def _bind(self) -> socketserver.BaseServer:
+        """Create the HTTP server listening on the daemon address.
+
+        :raises DaemonError if another daemon serves the address.
+        """
+        address = _parse_address(self.address)
+        if isinstance(address, tuple):
+            http_server: socketserver.BaseServer = _TCPServer(address, _Handler)
+        else:
+            if os.path.exists(address):
+                if DaemonClient(self.address).is_running():
+                    raise DaemonError(f"A daemon already serves {address}")
+                # left behind by a daemon which didn't exit cleanly
+                os.remove(address)
+            http_server = _UnixServer(address, _Handler)
+        http_server.owner = self  # type: ignore
+        return http_server
+
+    def serve_forever(self) -> None:
+        """Serve jobs until `shutdown` or a keyboard interrupt.
+
+        Running jobs finish before it returns, queued jobs are failed.
+        """
+        log.info("Daemon listening on %s", self.address)
+        self._watcher.start()
+        events = threading.Thread(target=self._watch, name="daemon-events", daemon=True)
+        events.start()
+        try:
+            self._http.serve_forever(poll_interval=0.5)
+        except KeyboardInterrupt:
+            log.info("Stopping daemon")
+        finally:
+            self._stopping.set()
+            self._http.server_close()
+            if not isinstance(_parse_address(self.address), tuple):
+                os.remove(self.address)
+            with self._lock:
+                for jobs in self._queues.values():
+                    jobs.put(None)
+                workers = list(self._workers)
+            for worker in workers:
+                worker.join()
+            self._watcher.stop()
+            events.join()
+            with self._lock:
+                for device in self._devices.values():
+                    device.close()
+                self._devices.clear()
+
+    def shutdown(self) -> None:
+        """Stop serving, returns at once, `serve_forever` waits for jobs."""
+        self._stopping.set()
+        threading.Thread(target=self._http.shutdown, daemon=True).start()
+
+    def devices(self) -> Dict[str, str]:
+        """Return attached devices mapped to their states."""
+        return self._watcher.devices
+
+    def jobs(self) -> List[Job]:
+        """Return every job submitted, oldest first."""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def job(self, job_id: str) -> Optional[Job]:
+        """Return job `job_id` or None."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def submit(
+        self, command: str, args: Dict[str, Any], serial: Optional[str] = None
+    ) -> Job:
+        """Queue job `command` on device `serial`.
+
+        Without `serial` the job runs on the only device ready.
+
+        :raises DaemonError if arguments are invalid, the device isn't
+            attached or the daemon is stopping.
+        """
+        args = _job_args(command, args)
+        ready = [s for s, state in self.devices().items() if state == "device"]
+        if serial is None:
+            if len(ready) != 1:
+                raise DaemonError(f"{len(ready)} devices ready, select one by serial")
+            serial = ready[0]
+        elif serial not in ready:
+            raise DaemonError(f"Device {serial} is not ready")
+        if self._stopping.is_set():
+            raise DaemonError("Daemon is stopping")
+
+        with self._lock:
+            job = Job(str(next(self._ids)), command, serial, args)
+            self._jobs[job.id] = job
+            jobs = self._queues.get(serial)
+            if jobs is None:
+                jobs = self._queues[serial] = queue.Queue()
+                worker = threading.Thread(
+                    target=self._work, args=(jobs,), name=f"jobs-{serial}"
+                )
+                self._workers.append(worker)
+                worker.start()
+            jobs.put(job)
+        log.info("Job %s %s queued on %s", job.id, command, serial)
+        return job
+
+    def _device(self, serial: str) -> Adb:
+        """Return the warm `Adb` instance of device `serial`."""
+        with self._lock:
+            device = self._devices.get(serial)
+            if device is None:
+                device = self._devices[serial] = self._server.for_device(serial)
+            return device
+
+    def _work(self, jobs: "queue.Queue[Optional[Job]]") -> None:
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if self._stopping.is_set():
+                job.finish(error="Daemon stopped before the job started")
+                continue
+            job.start()
+            log.info("Job %s %s started on %s", job.id, job.command, job.serial)
+            try:
+                summary = _JOB_RUNNERS[job.command](self._device(job.serial), job.args)
+            except (MassApkError, OSError) as error:
+                log.error("Job %s failed: %s", job.id, error)
+                job.finish(error=str(error))
+            except Exception as error:
+                # the worker must outlive the job, later jobs of the device
+                # are queued to it
+                log.exception("Job %s failed unexpectedly", job.id)
+                job.finish(error=repr(error))
+            else:
+                log.info("Job %s done %s", job.id, summary)
+                job.finish(summary)
+
+    def _watch(self) -> None:
+        """Close sessions of detached devices, they reopen on the next job."""
+        while not self._stopping.is_set():
+            try:
+                event = self._watcher.events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if event.kind == DETACHED:
+                with self._lock:
+                    device = self._devices.pop(event.serial, None)
+                if device is not None:
+                    device.close()
+            elif event.kind == READY:
+                log.info("Device %s ready", event.serial)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = "mass-apk"
+
+    @property
+    def _daemon(self) -> Daemon:
+        return self.server.owner  # type: ignore
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return "local"
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(self, status: int, body: Any) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self) -> Dict[str, Any]:
+        size = int(self.headers.get("Content-Length") or 0)
+        if size > MAX_BODY:
+            raise DaemonError("Request body too large")
+        try:
+            body = json.loads(self.rfile.read(size) or b"{}")
+        except ValueError as error:
+            raise DaemonError(f"Malformed json {error}")
+        if not isinstance(body, dict):
+            raise DaemonError("Request body must be a json object")
+        return body
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["devices"]:
+            self._reply(200, self._daemon.devices())
+        elif parts == ["jobs"]:
+            self._reply(200, [job.to_dict() for job in self._daemon.jobs()])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self._daemon.job(parts[1])
+            if job is None:
+                self._reply(404, {"error": f"No job {parts[1]}"})
+                return
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                wait = min(float(query.get("wait", ["0"])[0]), MAX_WAIT)
+            except ValueError:
+                self._reply(400, {"error": "wait must be a number of seconds"})
+                return
+            if wait > 0:
+                job.ended.wait(wait)
+            self._reply(200, job.to_dict())
+        else:
+            self._reply(404, {"error": f"No resource {url.path}"})
+
+    def do_POST(self) -> None:
+        path = urllib.parse.urlsplit(self.path).path.strip("/")
+        try:
+            if path == "jobs":
+                body = self._read_json()
+                job = self._daemon.submit(
+                    body.get("command", ""), body.get("args") or {}, body.get("serial")
+                )
+                self._reply(202, job.to_dict())
+            elif path == "shutdown":
+                self._reply(202, {"state": "stopping"})
+                self._daemon.shutdown()
+            else:
+                self._reply(404, {"error": f"No resource {path}"})
+        except DaemonError as error:
+            self._reply(400, {"error": str(error)})
+
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    """HTTP connection over the Unix socket `path`."""
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class DaemonClient(object):
+    """Client of the daemon job API at `address`."""
+
+    def __init__(self, address: Optional[str] = None):
+        self.address = address or default_address()
+
+    def _request(
+        self, method: str, path: str, body: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        """Send a request and return the decoded json reply.
+
+        :raises DaemonError if the daemon can't be reached or rejects it.
+        """
+        address = _parse_address(self.address)
+        timeout = MAX_WAIT + 10
+        if isinstance(address, tuple):
+            conn: http.client.HTTPConnection = http.client.HTTPConnection(
+                *address, timeout=timeout
+            )
+        else:
+            conn = _UnixConnection(address, timeout)
+        try:
+            data = json.dumps(body).encode() if body is not None else None
+            headers = {"Content-Type": "application/json"} if data else {}
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+            reply = json.loads(response.read() or b"null")
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            raise DaemonError(f"Can't reach daemon at {self.address} {error}")
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise DaemonError(reply.get("error") if isinstance(reply, dict) else reply)
+        return reply
+
+    def is_running(self) -> bool:
+        """Check if a daemon answers at the address."""
+        try:
+            self._request("GET", "/devices")
+        except DaemonError:
+            return False
+        return True
+
+    def devices(self) -> Dict[str, str]:
+        """Return devices attached to the daemon mapped to their states."""
+        return self._request("GET", "/devices")
+
+    def jobs(self) -> List[Dict[str, Any]]:
+        """Return states of every job submitted, oldest first."""
+        return self._request("GET", "/jobs")
+
+    def submit(
+        self, command: str, args: Dict[str, Any], serial: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Submit job `command` and return its state."""
+        body = {"command": command, "args": args, "serial": serial}
+        return self._request("POST", "/jobs", body)
+
+    def job(self, job_id: str, wait: float = 0) -> Dict[str, Any]:
+        """Return state of job `job_id`, waiting up to `wait` seconds for its end."""
+        return self._request("GET", f"/jobs/{job_id}?wait={wait}")
+
+    def wait(self, job_id: str) -> Dict[str, Any]:
+        """Block until job `job_id` ends and return its final state."""
+        while True:
+            job = self.job(job_id, wait=MAX_WAIT)
+            if job["state"] in (DONE, FAILED):
+                return job
+
+    def shutdown(self) -> None:
+        """Ask the daemon to stop once running jobs finish."""
+        self._request("POST", "/shutdown", {})
+
+
+def running_daemon(address: Optional[str] = None) -> Optional[DaemonClient]:
+    """Return a client of the daemon at `address` if one is running."""
+    client = DaemonClient(address)
+    if isinstance(_parse_address(client.address), str) and not os.path.exists(
+        client.address
+    ):
+        return None
+    return client if client.is_running() else None
@@ -0,0 +1,229 @@
+"""Binary deltas between two versions of an apk.
+
+An app update usually changes `classes.dex` and a few resources while
+native libraries, assets and most resources keep the same bytes. A delta
+copies the zip entries found unchanged in the base apk by offset and
+keeps everything else, local headers, changed entries, the signing block
+and the central directory, as zlib compressed literals. Reconstruction is
+byte exact, apk signatures cover the whole file.
+
+    b"mass-apk delta 1\\n" base sha256 b"\\n" target size u64
+    b"C" base offset u64, length u64        copy from the base
+    b"D" length u32, compressed length u32  literal bytes
+    b"E"                                    end
+"""
+
+from typing import BinaryIO, Dict, Iterable, List, Optional, Protocol, Tuple
+import collections
+import struct
+import zlib
+from zipfile import BadZipFile, ZipFile
+
+from mass_apk.exceptions import MassApkError
+
+__all__ = ["DeltaError", "apply_delta", "encode_delta", "read_delta_header"]
+
+MAGIC = b"mass-apk delta 1\n"
+
+_COPY = b"C"
+_DATA = b"D"
+_END = b"E"
+_COPY_ARGS = struct.Struct("<QQ")
+_DATA_ARGS = struct.Struct("<II")
+_SIZE = struct.Struct("<Q")
+_SHA256_SIZE = 64
+
+# literal bytes compressed per op and bytes compared or copied per read
+CHUNK_SIZE = 1024 * 1024
+
+_LOCAL_HEADER_SIZE = 30
+
+
+class _Writer(Protocol):
+    """Anything rebuilt apks can be written to, a file or a wrapper of one."""
+
+    def write(self, data: bytes) -> int:
+        """Write `data`, return the number of bytes written."""
+
+
+class DeltaError(MassApkError):
+    """Exception raised when a delta is malformed or doesn't fit its base."""
+
+
+# zip entry located by its local header and compressed data, `key` is crc
+# and sizes, equal for the same content
+_Entry = collections.namedtuple("_Entry", "key header data size")
+
+
+def _entries(in_file: BinaryIO) -> List[_Entry]:
+    """Return entries of zip `in_file` in file order, none if it isn't a zip."""
+    try:
+        with ZipFile(in_file) as zip_file:
+            infos = zip_file.infolist()
+    except BadZipFile:
+        return []
+    entries = []
+    for info in sorted(infos, key=lambda info: info.header_offset):
+        # local extra fields differ from the central ones, zipalign pads them
+        in_file.seek(info.header_offset + 26)
+        name_size, extra_size = struct.unpack("<HH", in_file.read(4))
+        data = info.header_offset + _LOCAL_HEADER_SIZE + name_size + extra_size
+        key = (info.CRC, info.compress_size, info.file_size)
+        entries.append(_Entry(key, info.header_offset, data, info.compress_size))
+    return entries
+
+
+def _same(a: BinaryIO, a_offset: int, b: BinaryIO, b_offset: int, size: int) -> bool:
+    """Check if `size` bytes at `a_offset` of `a` and `b_offset` of `b` are equal."""
+    a.seek(a_offset)
+    b.seek(b_offset)
+    while size > 0:
+        chunk = min(size, CHUNK_SIZE)
+        if a.read(chunk) != b.read(chunk):
+            return False
+        size -= chunk
+    return True
+
+
+def _find(
+    base: BinaryIO, candidates: Iterable[_Entry], target: BinaryIO, entry: _Entry
+) -> Optional[_Entry]:
+    """Return the base entry whose data equals data of target `entry`."""
+    for candidate in candidates:
+        if _same(base, candidate.data, target, entry.data, entry.size):
+            return candidate
+    return None
+
+
+class _DeltaWriter(object):
+    """Write delta ops into `out_file`, adjacent copies are merged."""
+
+    def __init__(self, out_file: BinaryIO):
+        self._out = out_file
+        self._copy: Optional[List[int]] = None
+
+    def copy(self, offset: int, size: int) -> None:
+        if size <= 0:
+            return
+        if self._copy is not None and sum(self._copy) == offset:
+            self._copy[1] += size
+            return
+        self._flush()
+        self._copy = [offset, size]
+
+    def literal(self, in_file: BinaryIO, offset: int, size: int) -> None:
+        if size <= 0:
+            return
+        self._flush()
+        in_file.seek(offset)
+        while size > 0:
+            data = in_file.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise DeltaError(f"Target ends {size} bytes early")
+            packed = zlib.compress(data, 6)
+            self._out.write(_DATA + _DATA_ARGS.pack(len(data), len(packed)) + packed)
+            size -= len(data)
+
+    def _flush(self) -> None:
+        if self._copy is not None:
+            self._out.write(_COPY + _COPY_ARGS.pack(*self._copy))
+            self._copy = None
+
+    def close(self) -> None:
+        self._flush()
+        self._out.write(_END)
+
+
+def encode_delta(
+    base: BinaryIO, target: BinaryIO, out_file: BinaryIO, base_sha256: str
+) -> None:
+    """Write into `out_file` a delta rebuilding `target` out of `base`.
+
+    Both files must be seekable, `base_sha256` names the base the delta
+    applies to. A target sharing no zip entry with the base is stored as
+    literals only.
+    """
+    by_key: Dict[tuple, List[_Entry]] = {}
+    for entry in _entries(base):
+        by_key.setdefault(entry.key, []).append(entry)
+    target.seek(0, 2)
+    size = target.tell()
+
+    out_file.write(MAGIC + base_sha256.encode("ascii") + b"\n" + _SIZE.pack(size))
+    writer = _DeltaWriter(out_file)
+    position = 0
+    for entry in _entries(target):
+        match = _find(base, by_key.get(entry.key, ()), target, entry)
+        if match is None:
+            continue
+        writer.literal(target, position, entry.header - position)
+        header_size = entry.data - entry.header
+        if match.data - match.header == header_size and _same(
+            base, match.header, target, entry.header, header_size
+        ):
+            writer.copy(match.header, header_size)
+        else:
+            writer.literal(target, entry.header, header_size)
+        writer.copy(match.data, entry.size)
+        position = entry.data + entry.size
+    writer.literal(target, position, size - position)
+    writer.close()
+
+
+def _read(in_file: BinaryIO, size: int) -> bytes:
+    data = in_file.read(size)
+    if len(data) != size:
+        raise DeltaError("Truncated delta")
+    return data
+
+
+def read_delta_header(delta: BinaryIO) -> Tuple[str, int]:
+    """Return sha256 of the base and size of the target of `delta`.
+
+    :raises DeltaError if `delta` isn't a delta.
+    """
+    if delta.read(len(MAGIC)) != MAGIC:
+        raise DeltaError("Not an apk delta")
+    base_sha256 = _read(delta, _SHA256_SIZE + 1)[:-1].decode("ascii", "replace")
+    (size,) = _SIZE.unpack(_read(delta, _SIZE.size))
+    return base_sha256, size
+
+
+def apply_delta(base: BinaryIO, delta: BinaryIO, out_file: _Writer) -> int:
+    """Write the target `delta` rebuilds out of `base` into `out_file`.
+
+    Return the number of bytes written.
+
+    :raises DeltaError if `delta` is malformed or doesn't fit `base`.
+    """
+    _, size = read_delta_header(delta)
+    written = 0
+    while True:
+        op = _read(delta, 1)
+        if op == _END:
+            break
+        if op == _COPY:
+            offset, length = _COPY_ARGS.unpack(_read(delta, _COPY_ARGS.size))
+            base.seek(offset)
+            while length > 0:
+                data = base.read(min(length, CHUNK_SIZE))
+                if not data:
+                    raise DeltaError(f"Base ends before offset {offset + length}")
+                out_file.write(data)
+                written += len(data)
+                length -= len(data)
+        elif op == _DATA:
+            length, packed = _DATA_ARGS.unpack(_read(delta, _DATA_ARGS.size))
+            try:
+                data = zlib.decompress(_read(delta, packed))
+            except zlib.error as error:
+                raise DeltaError(f"Corrupt delta literal {error}")
+            if len(data) != length:
+                raise DeltaError("Corrupt delta literal length")
+            out_file.write(data)
+            written += length
+        else:
+            raise DeltaError(f"Unknown delta op {op!r}")
+    if written != size:
+        raise DeltaError(f"Delta rebuilt {written} bytes instead of {size}")
+    return written
@@ -7,3 +7,7 @@ class MassApkError(BaseException):
 
 class MassApkFileNotFoundError(MassApkError):
     """Exception raised when apk file not found in device."""
+
+
+class TransportError(MassApkError):
+    """Exception raised when talking to adb-server over a socket."""
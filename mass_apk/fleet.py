@@ -0,0 +1,66 @@
+"""Run the same job on many android devices in parallel."""
+
+from typing import Callable, List, Optional
+import collections
+import concurrent.futures
+import logging
+
+from mass_apk.adb import Adb
+from mass_apk.exceptions import MassApkError
+
+__all__ = ["DeviceResult", "run_on_devices", "run_on_device", "log_summary"]
+
+log = logging.getLogger(__name__)
+
+
+DeviceResult = collections.namedtuple("DeviceResult", "serial summary error")
+
+
+def run_on_devices(
+    server: Adb,
+    serials: List[str],
+    job: Callable[[Adb], str],
+    max_workers: Optional[int] = None,
+) -> List[DeviceResult]:
+    """Run `job` once per device in `serials`, each one in its own thread.
+
+    `job` receives an `Adb` instance targeting the device and returns a short
+    summary. A failing device doesn't affect the others, its error is
+    recorded in the returned `DeviceResult` list, ordered like `serials`.
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers or max(len(serials), 1)
+    ) as pool:
+        futures = [
+            pool.submit(run_on_device, server, serial, job) for serial in serials
+        ]
+        return [future.result() for future in futures]
+
+
+def run_on_device(server: Adb, serial: str, job: Callable[[Adb], str]) -> DeviceResult:
+    """Run `job` on device `serial`, its error is recorded, not raised.
+
+    Any error of the job is recorded, one device failing unexpectedly
+    doesn't stop the others, only an interrupt does.
+    """
+    device = server.for_device(serial)
+    try:
+        return DeviceResult(serial, job(device), None)
+    except (MassApkError, OSError) as error:
+        log.error("%s failed: %s", serial, error)
+        return DeviceResult(serial, None, str(error))
+    except Exception as error:
+        log.exception("%s failed unexpectedly", serial)
+        return DeviceResult(serial, None, repr(error))
+    finally:
+        device.close()
+
+
+def log_summary(results: List[DeviceResult]) -> None:
+    """Log one line per device with its job outcome."""
+    log.info("Device summary:")
+    for result in results:
+        if result.error is None:
+            log.info("  %-20s ok      %s", result.serial, result.summary)
+        else:
+            log.info("  %-20s failed  %s", result.serial, result.error)
@@ -1,19 +1,33 @@
 """Mass apk helper functions module."""
 
+from typing import Callable, List, Optional, Sequence, TypeVar
 import functools
 import logging
 import os
-import platform
+import threading
 from enum import Enum, unique
 from timeit import default_timer as timer
 
-__all__ = ["Platform", "detect_platform", "human_time", "elapsed_time", "MB"]
+__all__ = [
+    "Platform",
+    "detect_platform",
+    "human_time",
+    "elapsed_time",
+    "link_or_copy",
+    "reflink",
+    "balance",
+    "Watchdog",
+    "MB",
+]
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 MB = 1024 * 1024
 
+
 @unique
 class Platform(Enum):
     """Platform enum used to detected running operating system."""
@@ -23,11 +37,14 @@ class Platform(Enum):
     WIN = "win"
 
 
+@functools.lru_cache(maxsize=None)
 def detect_platform() -> Platform:
     """Detect running operating system.
 
     raises RuntimeError if operating system can't be detected.
     """
+    import platform
+
     detected_system = platform.system()
 
     if os.name == "posix" and detected_system == "Darwin":
@@ -65,3 +82,98 @@ def elapsed_time(func):
         return result
 
     return wrapper
+
+
+def reflink(src: str, dest: str) -> None:
+    """Clone file `src` into `dest` sharing its data blocks.
+
+    Only supported on Linux filesystems with copy on write support e.g.
+    btrfs or xfs.
+
+    :raises OSError if the filesystem can't clone files.
+    """
+    import platform
+
+    if platform.system() != "Linux":
+        raise OSError("reflink is only supported on Linux")
+
+    import fcntl
+
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+        except OSError:
+            dest_file.close()
+            os.remove(dest)
+            raise
+
+
+# ioctl request number of FICLONE from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def link_or_copy(src: str, dest: str, clone: bool = False) -> None:
+    """Make file `src` available at `dest` without duplicating its data.
+
+    Hard link `src` to `dest`, fall back to copying when linking is not
+    possible e.g. `src` and `dest` are on different filesystems. With
+    `clone` a reflink, an independent copy sharing data blocks, is tried
+    first.
+    """
+    if clone:
+        try:
+            reflink(src, dest)
+            return
+        except OSError:
+            pass
+    try:
+        os.link(src, dest)
+    except OSError:
+        import shutil
+
+        shutil.copy2(src, dest)
+
+
+def balance(
+    items: Sequence[T], workers: int, size: Callable[[T], int]
+) -> List[List[T]]:
+    """Split `items` into at most `workers` groups of about the same total size.
+
+    Items are handed out longest first, each to the group with the least
+    work so far, so no worker ends up with a long tail.
+    """
+    groups: List[List[T]] = [[] for _ in range(max(min(workers, len(items)), 1))]
+    totals = [0] * len(groups)
+    for item in sorted(items, key=size, reverse=True):
+        index = totals.index(min(totals))
+        groups[index].append(item)
+        totals[index] += size(item)
+    return [group for group in groups if group]
+
+
+class Watchdog(object):
+    """Call `kill` unless the `with` block completes within `timeout` seconds.
+
+    A None or zero `timeout` never fires, `fired` tells if it did.
+    """
+
+    def __init__(self, timeout: Optional[float], kill: Callable[[], None]):
+        self.fired = False
+        self._kill = kill
+        self._timer: Optional[threading.Timer] = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._fire)
+            self._timer.daemon = True
+
+    def _fire(self) -> None:
+        self.fired = True
+        self._kill()
+
+    def __enter__(self) -> "Watchdog":
+        if self._timer is not None:
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
@@ -0,0 +1,239 @@
+"""Batched apk installs over package manager sessions.
+
+`adb install` pays package manager session setup and verification for
+every apk. `SessionInstaller` groups packages into multi-package sessions,
+
+    cmd package install-create --multi-package
+    cmd package install-create                      (one per package)
+    cmd package install-write -S <size> <id> <name> - (one per apk)
+    cmd package install-add-session <parent> <child>...
+    cmd package install-commit <parent>
+
+and commits a batch in the background while apks of the next batch are
+written. A failed batch is retried one package at a time.
+"""
+
+from typing import Callable, List, Optional
+import collections
+import logging
+import queue
+import re
+import threading
+
+from mass_apk.adaptive import limits
+from mass_apk.adb import Adb, AdbError
+from mass_apk.metrics import metrics
+from mass_apk.retry import call_with_retry
+from mass_apk.sources import ApkSource, install
+
+__all__ = ["InstallPackage", "InstallResult", "SessionInstaller", "install_packages"]
+
+log = logging.getLogger(__name__)
+
+
+# a package made of one base apk and optionally its split apks
+InstallPackage = collections.namedtuple("InstallPackage", "name apks")
+
+# `error` is None when the package got installed
+InstallResult = collections.namedtuple("InstallResult", "name error")
+
+_SESSION_ID = re.compile(r"\[(\d+)\]")
+
+
+class SessionInstaller(object):
+    """Install packages in batches of `batch_size` per commit."""
+
+    def __init__(
+        self,
+        server: Adb,
+        batch_size: int = 16,
+        on_installed: Optional[Callable[[InstallPackage], None]] = None,
+    ):
+        self._server = server
+        self._batch_size = max(batch_size, 1)
+        self._on_installed = on_installed
+        self._results: List[InstallResult] = []
+        self._worker_error: Optional[BaseException] = None
+
+    def _pm(self, args: str, timeout: Optional[float] = None) -> str:
+        """Run a package manager command, raise unless it reports success."""
+        output = self._server.shell(f"cmd package {args}", timeout=timeout)
+        if "Success" not in output:
+            raise AdbError(f"cmd package {args} failed {output.strip()}")
+        return output
+
+    def _create(self, multi_package: bool = False) -> str:
+        flags = "--multi-package -r -d" if multi_package else "-r -d"
+        output = self._pm(f"install-create {flags}")
+        match = _SESSION_ID.search(output)
+        if match is None:
+            raise AdbError(f"Can't parse install session id {output.strip()}")
+        return match.group(1)
+
+    def _abandon(self, session: str) -> None:
+        try:
+            self._server.shell(f"cmd package install-abandon {session}")
+        except AdbError as error:
+            log.debug("Abandon session %s failed %r", session, error)
+
+    def _write(self, session: str, package: InstallPackage) -> None:
+        for index, apk in enumerate(package.apks):
+            with limits.slot(
+                self._server, "install", device=False
+            ) as measurement, apk.open() as in_file:
+                output = self._server.exec_in(
+                    f"cmd package install-write -S {apk.size} {session} {index}.apk -",
+                    in_file,
+                )
+                measurement.bytes = apk.size
+            if "Success" not in output:
+                raise AdbError(f"Writing {apk.name} failed {output.strip()}")
+
+    def _stage(self, batch: List[InstallPackage]) -> str:
+        """Create sessions for `batch` and write its apks, return session to commit.
+
+        :raises AdbError if a session can't be created or written, sessions
+        created so far are abandoned.
+        """
+        sessions: List[str] = []
+        size = sum(apk.size for package in batch for apk in package.apks)
+        label = self._server.device_label
+        try:
+            with metrics.measure("install_stage", label) as measurement:
+                measurement.bytes = size
+                for package in batch:
+                    sessions.append(self._create())
+                    self._write(sessions[-1], package)
+                if len(sessions) == 1:
+                    return sessions[0]
+
+                parent = self._create(multi_package=True)
+                sessions.append(parent)
+                self._pm(f"install-add-session {parent} {' '.join(sessions[:-1])}")
+                return parent
+        except AdbError:
+            for session in sessions:
+                self._abandon(session)
+            raise
+
+    def _installed(self, package: InstallPackage, error: Optional[str]) -> None:
+        self._results.append(InstallResult(package.name, error))
+        if error is not None:
+            log.warning("Installing %s failed %s", package.name, error)
+        elif self._on_installed is not None:
+            self._on_installed(package)
+
+    def _commit(self, session: str) -> None:
+        # verifying the apks of a session takes longer the more they weigh
+        self._pm(f"install-commit {session}", self._server.timeouts.transfer)
+
+    def _install_one(self, package: InstallPackage) -> None:
+        """Install `package` on its own, the fallback of a failed batch."""
+        label = self._server.device_label
+        try:
+            if len(package.apks) == 1:
+                install(self._server, package.apks[0])
+            else:
+                call_with_retry(
+                    lambda: self._commit(self._stage([package])), "install", label
+                )
+        except AdbError as error:
+            self._installed(package, str(error))
+        else:
+            self._installed(package, None)
+
+    def _commit_worker(self, commits: "queue.Queue") -> None:
+        while True:
+            item = commits.get()
+            if item is None:
+                return
+            session, batch = item
+            if self._worker_error is not None:
+                # the main thread stops staging, drop what it staged meanwhile
+                self._abandon(session)
+                continue
+            try:
+                self._commit_batch(session, batch)
+            except BaseException as error:
+                self._worker_error = error
+
+    def _commit_batch(self, session: str, batch: List[InstallPackage]) -> None:
+        try:
+            with metrics.measure("install_commit", self._server.device_label):
+                self._commit(session)
+        except AdbError as error:
+            log.warning("Batch commit failed, installing one by one %r", error)
+            for package in batch:
+                metrics.retry("install", self._server.device_label)
+                self._install_one(package)
+        else:
+            for package in batch:
+                self._installed(package, None)
+
+    def install(self, packages: List[InstallPackage]) -> List[InstallResult]:
+        """Install `packages` and return the outcome of each one.
+
+        Failed packages are reported in the results instead of raising.
+
+        :raises the first unexpected error of a commit, e.g. raised by
+        `on_installed`, batches not committed yet are abandoned.
+        """
+        self._results = []
+        # a single pending commit lets writes run ahead by one batch
+        commits: "queue.Queue" = queue.Queue(maxsize=1)
+        worker = threading.Thread(target=self._commit_worker, args=(commits,))
+        worker.start()
+        try:
+            for start in range(0, len(packages), self._batch_size):
+                if self._worker_error is not None:
+                    break
+                batch = packages[start : start + self._batch_size]
+                try:
+                    session = self._stage(batch)
+                except AdbError as error:
+                    log.warning("Staging batch failed, installing one by one %r", error)
+                    for package in batch:
+                        self._install_one(package)
+                    continue
+                commits.put((session, batch))
+        finally:
+            commits.put(None)
+            worker.join()
+        if self._worker_error is not None:
+            worker_error, self._worker_error = self._worker_error, None
+            raise worker_error
+        return list(self._results)
+
+
+def install_packages(
+    server: Adb,
+    apks: List[ApkSource],
+    batch_size: int,
+    on_installed: Optional[Callable[[InstallPackage], None]] = None,
+) -> List[InstallResult]:
+    """Install each apk of `apks` and its split apks as one package.
+
+    With `batch_size` of one apks are installed one by one with
+    `adb install`, otherwise they go through a `SessionInstaller`. Packages
+    with split apks always go through a session. Failed packages are
+    reported in the results instead of raising.
+    """
+    packages = [InstallPackage(apk.name, [apk, *apk.splits]) for apk in apks]
+    if batch_size <= 1:
+        results = []
+        for package in packages:
+            if len(package.apks) > 1:
+                installer = SessionInstaller(server, 1, on_installed)
+                results.extend(installer.install([package]))
+                continue
+            try:
+                install(server, package.apks[0])
+            except AdbError as error:
+                log.warning("Installing %s failed %s", package.name, error)
+                results.append(InstallResult(package.name, str(error)))
+                continue
+            results.append(InstallResult(package.name, None))
+            if on_installed is not None:
+                on_installed(package)
+        return results
+    return SessionInstaller(server, batch_size, on_installed).install(packages)
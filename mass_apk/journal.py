@@ -0,0 +1,112 @@
+"""Crash safe progress journal of back up and restore runs.
+
+The journal is an append only file of json lines, one line per state
+change of an item,
+
+    {"item": "com.skype.raider", "state": "started"}
+    {"item": "com.skype.raider", "state": "done", "size": 1234, ...}
+    {"item": "com.whatsapp", "state": "failed", "error": "..."}
+
+each line is fsync'd before the item is considered in that state. A run
+resumed from the journal skips items already done and redoes the others.
+"""
+
+from typing import Any, Dict, Iterable, Optional, Set, Union
+import json
+import logging
+import os
+import threading
+
+__all__ = ["Journal", "JOURNAL_NAME", "STARTED", "DONE", "FAILED"]
+
+log = logging.getLogger(__name__)
+
+# journal file name inside a back up folder
+JOURNAL_NAME = ".journal"
+
+STARTED = "started"
+DONE = "done"
+FAILED = "failed"
+
+
+class Journal(object):
+    """Append only record of item states, safe to use from many threads."""
+
+    def __init__(self, path: Union[str, os.PathLike], resume: bool = False):
+        """Open journal `path`.
+
+        With `resume` states recorded by a previous run are loaded and new
+        ones appended, otherwise the journal starts empty.
+        """
+        self.path = os.fspath(path)
+        self.states: Dict[str, Dict[str, Any]] = {}
+        if resume:
+            self._replay()
+        self._out_file = open(self.path, "a" if resume else "w")
+        self._lock = threading.Lock()
+
+    def _replay(self) -> None:
+        try:
+            with open(self.path, "r") as in_file:
+                lines = in_file.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+                self.states[record["item"]] = record
+            except (ValueError, KeyError, TypeError):
+                # the last line is truncated when a crash interrupted a write
+                log.debug("Skipping malformed journal line %r", line)
+        log.info(
+            "Resuming from journal %s, %s items done",
+            self.path,
+            len(self.done_items()),
+        )
+
+    def _append(self, records: Iterable[Dict[str, Any]]) -> None:
+        with self._lock:
+            for record in records:
+                self.states[record["item"]] = record
+                self._out_file.write(json.dumps(record) + "\n")
+            self._out_file.flush()
+            os.fsync(self._out_file.fileno())
+
+    def start(self, *items: str) -> None:
+        """Record `items` as in flight."""
+        self._append({"item": item, "state": STARTED} for item in items)
+
+    def done(self, item: str, **data: Any) -> None:
+        """Record `item` as completed along with `data` needed to resume."""
+        self._append([dict(data, item=item, state=DONE)])
+
+    def fail(self, item: str, error: object) -> None:
+        """Record `item` as failed."""
+        self._append([{"item": item, "state": FAILED, "error": str(error)}])
+
+    def state(self, item: str) -> Optional[str]:
+        """Return last recorded state of `item` or None."""
+        record = self.states.get(item)
+        return record["state"] if record is not None else None
+
+    def record(self, item: str) -> Optional[Dict[str, Any]]:
+        """Return data recorded with `item` completion or None if not done."""
+        record = self.states.get(item)
+        return record if record is not None and record["state"] == DONE else None
+
+    def done_items(self) -> Set[str]:
+        """Return names of completed items."""
+        return {item for item, record in self.states.items() if record["state"] == DONE}
+
+    def close(self, remove: bool = False) -> None:
+        """Close the journal, with `remove` delete it as the run completed."""
+        with self._lock:
+            self._out_file.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
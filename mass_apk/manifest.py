@@ -0,0 +1,263 @@
+"""Back up manifest, metadata of every apk stored in a back up.
+
+The manifest is a json file saved next to the apks of a back up folder,
+it records package name, versionCode, lastUpdateTime, size and sha256
+for each apk. It lets later back ups detect which packages changed.
+
+Split apks of a package are recorded with its base apk, they are stored
+in a folder named after the package, e.g. `com.a/split_config.en.apk`.
+"""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import collections
+import hashlib
+import json
+import logging
+import os
+
+from mass_apk.adb import Adb, AdbError
+from mass_apk.exceptions import MassApkError
+from mass_apk.metrics import metrics
+
+__all__ = [
+    "ManifestError",
+    "Manifest",
+    "ManifestEntry",
+    "PackageInfo",
+    "SplitEntry",
+    "MANIFEST_NAME",
+    "parse_dumpsys_packages",
+    "entry_files",
+    "entry_from_dict",
+    "entry_to_dict",
+    "query_package_info",
+    "sha256_file",
+]
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+class ManifestError(MassApkError):
+    """Exception raised when a manifest can't be read."""
+
+
+PackageInfo = collections.namedtuple(
+    "PackageInfo", "package version_code last_update_time code_path"
+)
+
+# `splits` lists a `SplitEntry` for each split apk of the package
+ManifestEntry = collections.namedtuple(
+    "ManifestEntry",
+    "package version_code last_update_time size sha256 file splits",
+    defaults=((),),
+)
+
+SplitEntry = collections.namedtuple("SplitEntry", "file size sha256")
+
+
+def entry_files(entry: ManifestEntry) -> List[Tuple[str, str]]:
+    """Return file and sha256 of the split apks and base apk of `entry`.
+
+    Split apks come first, read from a back up stream they are at hand
+    once their base apk arrives.
+    """
+    return [(split.file, split.sha256) for split in entry.splits] + [
+        (entry.file, entry.sha256)
+    ]
+
+
+def entry_to_dict(entry: ManifestEntry) -> Dict[str, Any]:
+    """Return `entry` as a dict json can serialize."""
+    return dict(entry._asdict(), splits=[split._asdict() for split in entry.splits])
+
+
+def entry_from_dict(item: Dict[str, Any]) -> ManifestEntry:
+    """Return the entry `entry_to_dict` returned `item` for.
+
+    :raises TypeError if `item` lacks or has unknown fields.
+    """
+    splits = tuple(SplitEntry(**split) for split in item.get("splits", ()))
+    return ManifestEntry(**dict(item, splits=splits))
+
+
+def sha256_file(path: Union[str, os.PathLike], block_size: int = 1024 * 1024) -> str:
+    """Return hex sha256 digest of file content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as in_file:
+        for block in iter(lambda: in_file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_dumpsys_packages(lines: Iterable[str]) -> Iterator[PackageInfo]:
+    """Parse output of `dumpsys package packages`.
+
+    Only the `Packages:` section is parsed, packages are reported in the form
+
+        Package [com.skype.raider] (5a2bc31):
+          codePath=/data/app/com.skype.raider-2
+          versionCode=1234 minSdk=21 targetSdk=30
+          lastUpdateTime=2021-02-13 10:21:07
+    """
+    in_packages = False
+    current: Optional[Dict[str, str]] = None
+
+    for line in lines:
+        stripped = line.strip()
+        if not line.startswith(" ") and stripped:
+            # a new top level section starts, e.g. `Hidden system packages:`
+            if current is not None:
+                yield _package_info(current)
+                current = None
+            in_packages = stripped == "Packages:"
+            continue
+        if not in_packages:
+            continue
+
+        if stripped.startswith("Package [") and "]" in stripped:
+            if current is not None:
+                yield _package_info(current)
+            current = {"package": stripped[len("Package [") : stripped.index("]")]}
+        elif current is not None:
+            for field in stripped.split():
+                key, sep, value = field.partition("=")
+                if sep and key in ("codePath", "versionCode") and key not in current:
+                    current[key] = value
+            if stripped.startswith("lastUpdateTime="):
+                current.setdefault("lastUpdateTime", stripped.partition("=")[2])
+
+    if current is not None:
+        yield _package_info(current)
+
+
+def _package_info(fields: Dict[str, str]) -> PackageInfo:
+    version_code = fields.get("versionCode")
+    return PackageInfo(
+        fields["package"],
+        int(version_code) if version_code and version_code.isdigit() else None,
+        fields.get("lastUpdateTime"),
+        fields.get("codePath"),
+    )
+
+
+def query_package_info(server: Adb) -> Dict[str, PackageInfo]:
+    """Fetch metadata of all installed packages with one `dumpsys` pass.
+
+    Return an empty dict if `dumpsys` isn't available on the device.
+    """
+    log.info("Fetching installed packages metadata...")
+    try:
+        with metrics.measure("package_info", server.device_label):
+            return {
+                info.package: info
+                for info in parse_dumpsys_packages(
+                    server.iter_shell("dumpsys package packages")
+                )
+            }
+    except AdbError as error:
+        log.warning("Can't fetch packages metadata %r", error)
+        return {}
+
+
+class Manifest(object):
+    """Collection of `ManifestEntry` keyed by package name."""
+
+    def __init__(self, entries: Optional[Iterable[ManifestEntry]] = None):
+        self.entries: Dict[str, ManifestEntry] = {
+            entry.package: entry for entry in entries or ()
+        }
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, package: object) -> bool:
+        return package in self.entries
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+        return iter(self.entries.values())
+
+    def get(self, package: str) -> Optional[ManifestEntry]:
+        """Return entry of `package` or None."""
+        return self.entries.get(package)
+
+    def add(self, entry: ManifestEntry) -> None:
+        """Add or replace entry of a package."""
+        self.entries[entry.package] = entry
+
+    def is_current(self, info: Optional[PackageInfo]) -> bool:
+        """Check if the entry of a package matches its installed version.
+
+        Packages without a known versionCode and lastUpdateTime are never
+        considered current.
+        """
+        if info is None or info.version_code is None or info.last_update_time is None:
+            return False
+        entry = self.entries.get(info.package)
+        return (
+            entry is not None
+            and entry.version_code == info.version_code
+            and entry.last_update_time == info.last_update_time
+        )
+
+    @classmethod
+    def load(cls, backup_dir: Union[str, os.PathLike]) -> "Manifest":
+        """Load manifest of back up folder `backup_dir`.
+
+        :raises ManifestError if manifest is missing or malformed.
+        """
+        return cls.read(os.path.join(backup_dir, MANIFEST_NAME))
+
+    def save(self, backup_dir: Union[str, os.PathLike]) -> None:
+        """Save manifest into back up folder `backup_dir`."""
+        self.write(os.path.join(backup_dir, MANIFEST_NAME))
+
+    def to_json(self) -> str:
+        """Serialize manifest to a json document."""
+        data = {
+            "version": MANIFEST_VERSION,
+            "packages": [
+                entry_to_dict(entry)
+                for entry in sorted(self.entries.values(), key=lambda e: e.package)
+            ],
+        }
+        return json.dumps(data, indent=2)
+
+    @classmethod
+    def from_json(cls, document: Union[str, bytes]) -> "Manifest":
+        """Load manifest from a json document.
+
+        :raises ManifestError if the document is malformed.
+        """
+        try:
+            data = json.loads(document)
+            return cls(entry_from_dict(item) for item in data["packages"])
+        except (ValueError, KeyError, TypeError) as error:
+            raise ManifestError(f"Malformed manifest {error!r}")
+
+    @classmethod
+    def read(cls, path: Union[str, os.PathLike]) -> "Manifest":
+        """Load manifest from json file `path`.
+
+        :raises ManifestError if manifest is missing or malformed.
+        """
+        try:
+            with open(path, "r") as in_file:
+                document = in_file.read()
+        except OSError as error:
+            raise ManifestError(f"Can't read manifest {path} {error!r}")
+        return cls.from_json(document)
+
+    def write(self, path: Union[str, os.PathLike]) -> None:
+        """Save manifest into json file `path`.
+
+        Manifest is written to a temporary file first and renamed, a crash
+        can't leave a truncated manifest behind.
+        """
+        with open(f"{path}.tmp", "w") as out_file:
+            out_file.write(self.to_json())
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(f"{path}.tmp", path)
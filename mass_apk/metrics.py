@@ -0,0 +1,365 @@
+"""Per operation metrics of a run.
+
+Operations are grouped by phase, e.g. `pull` or `zip`, and device. For
+each group the count, errors, retries, bytes and a latency histogram are
+kept. At the end of a run metrics are written as a json report and
+optionally as a Prometheus textfile collector file.
+
+    with metrics.measure("pull", device) as measurement:
+        measurement.bytes = server.pull(path, dest)
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+import contextlib
+import functools
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+__all__ = [
+    "Metrics",
+    "Measurement",
+    "PhaseStats",
+    "Profiler",
+    "LATENCY_BUCKETS",
+    "metrics",
+]
+
+log = logging.getLogger(__name__)
+
+# upper bounds in seconds of latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    math.inf,
+)
+
+# device label of operations not bound to a device, e.g. zipping on the host
+LOCAL = "local"
+
+
+class PhaseStats(object):
+    """Counters and latency histogram of one phase on one device."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float, size: int = 0, error: bool = False) -> None:
+        """Account an operation which took `seconds`."""
+        self.count += 1
+        self.errors += int(error)
+        self.bytes += size
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Estimate latency quantile `q` as the upper bound of its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max_seconds), 6)
+        return round(self.max_seconds, 6)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return stats as a json serializable dict."""
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "seconds_total": round(self.seconds, 6),
+            "latency": {
+                "mean": round(self.seconds / self.count, 6) if self.count else 0.0,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "max": round(self.max_seconds, 6),
+            },
+            "buckets": {
+                _format_bound(bound): count
+                for bound, count in zip(LATENCY_BUCKETS, self._cumulative())
+            },
+        }
+
+    def _cumulative(self) -> List[int]:
+        total, cumulative = 0, []
+        for count in self.buckets:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else repr(bound)
+
+
+class Measurement(object):
+    """Handle of an operation being measured, set `bytes` it transferred."""
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class Metrics(object):
+    """Thread safe registry of `PhaseStats` keyed by phase and device."""
+
+    def __init__(self):
+        self._stats: Dict[Tuple[str, str], PhaseStats] = {}
+        self._gauges: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def reset(self) -> None:
+        """Forget every recorded operation and restart the run clock."""
+        with self._lock:
+            self._stats.clear()
+            self._gauges.clear()
+            self.started = time.time()
+
+    def _get(self, phase: str, device: Optional[str]) -> PhaseStats:
+        key = (phase, device or LOCAL)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = PhaseStats()
+        return stats
+
+    def observe(
+        self,
+        phase: str,
+        device: Optional[str],
+        seconds: float,
+        size: int = 0,
+        error: bool = False,
+    ) -> None:
+        """Record an operation of `phase` on `device` which took `seconds`."""
+        with self._lock:
+            self._get(phase, device).observe(seconds, size, error)
+
+    def set_gauge(self, name: str, target: str, value: float) -> None:
+        """Record current `value` of gauge `name` of `target`, e.g. a device."""
+        with self._lock:
+            self._gauges[(name, target)] = value
+
+    def gauges(self) -> Dict[Tuple[str, str], float]:
+        """Return current value of every gauge keyed by name and target."""
+        with self._lock:
+            return dict(self._gauges)
+
+    def retry(self, phase: str, device: Optional[str] = None) -> None:
+        """Record an operation of `phase` being retried."""
+        with self._lock:
+            self._get(phase, device).retries += 1
+
+    @contextlib.contextmanager
+    def measure(
+        self, phase: str, device: Optional[str] = None
+    ) -> Iterator[Measurement]:
+        """Measure the operation run in the `with` block.
+
+        An exception leaving the block counts as an error, except a
+        generator being closed early.
+        """
+        measurement = Measurement()
+        error = False
+        start = time.perf_counter()
+        try:
+            yield measurement
+        except GeneratorExit:
+            raise
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(
+                phase, device, time.perf_counter() - start, measurement.bytes, error
+            )
+
+    def timed(self, phase: str) -> Callable:
+        """Decorate a function to measure each of its calls as `phase`."""
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.measure(phase):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """Return stats of every phase and device as dicts."""
+        with self._lock:
+            return {key: stats.to_dict() for key, stats in self._stats.items()}
+
+    def report(self, **extra: Any) -> Dict[str, Any]:
+        """Return the run report, `extra` items are added to it."""
+        phases = [
+            dict(stats, phase=phase, device=device)
+            for (phase, device), stats in sorted(self.snapshot().items())
+        ]
+        return dict(
+            extra,
+            started=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            duration=round(time.time() - self.started, 3),
+            phases=phases,
+            gauges=[
+                {"name": name, "target": target, "value": value}
+                for (name, target), value in sorted(self.gauges().items())
+            ],
+        )
+
+    def write_json(self, path: Union[str, os.PathLike], **extra: Any) -> None:
+        """Write the run report as json into `path`."""
+        import json
+
+        _atomic_write(path, json.dumps(self.report(**extra), indent=2))
+
+    def write_prometheus(self, path: Union[str, os.PathLike]) -> None:
+        """Write metrics in Prometheus text format for the textfile collector.
+
+        The file is written under a temporary name and renamed, as the
+        collector requires, so it never reads a partial file.
+        """
+        snapshot = sorted(self.snapshot().items())
+        lines = [
+            "# HELP mass_apk_operation_seconds Latency of mass apk operations.",
+            "# TYPE mass_apk_operation_seconds histogram",
+        ]
+        for (phase, device), stats in snapshot:
+            labels = f'phase="{_escape(phase)}",device="{_escape(device)}"'
+            for bound, count in stats["buckets"].items():
+                lines.append(
+                    f'mass_apk_operation_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                )
+            lines.append(
+                f"mass_apk_operation_seconds_sum{{{labels}}} {stats['seconds_total']}"
+            )
+            lines.append(
+                f"mass_apk_operation_seconds_count{{{labels}}} {stats['count']}"
+            )
+
+        counters = (
+            ("errors", "Failed mass apk operations."),
+            ("retries", "Retried mass apk operations."),
+            ("bytes", "Bytes transferred by mass apk operations."),
+        )
+        for name, help_text in counters:
+            lines.append(f"# HELP mass_apk_operation_{name}_total {help_text}")
+            lines.append(f"# TYPE mass_apk_operation_{name}_total counter")
+            for (phase, device), stats in snapshot:
+                labels = f'phase="{_escape(phase)}",device="{_escape(device)}"'
+                lines.append(
+                    f"mass_apk_operation_{name}_total{{{labels}}} {stats[name]}"
+                )
+
+        gauges = sorted(self.gauges().items())
+        for name in sorted({name for (name, _), _ in gauges}):
+            lines.append(f"# TYPE mass_apk_{name} gauge")
+            for (gauge, target), value in gauges:
+                if gauge == name:
+                    lines.append(
+                        f'mass_apk_{name}{{target="{_escape(target)}"}} {value}'
+                    )
+
+        lines += [
+            "# HELP mass_apk_run_duration_seconds Duration of the last mass apk run.",
+            "# TYPE mass_apk_run_duration_seconds gauge",
+            f"mass_apk_run_duration_seconds {time.time() - self.started:.3f}",
+            "# HELP mass_apk_run_timestamp_seconds Start time of the last mass apk run.",
+            "# TYPE mass_apk_run_timestamp_seconds gauge",
+            f"mass_apk_run_timestamp_seconds {self.started:.3f}",
+        ]
+        _atomic_write(path, "\n".join(lines) + "\n")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _atomic_write(path: Union[str, os.PathLike], content: str) -> None:
+    with open(f"{path}.tmp", "w") as out_file:
+        out_file.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+class Profiler(object):
+    """cProfile of the calling thread and of threads started while running.
+
+    Transfers run in worker threads, profiling only the main thread would
+    show it waiting on them.
+    """
+
+    def __init__(self):
+        self._profiles: List[Any] = []
+        self._lock = threading.Lock()
+
+    def _enable(self) -> None:
+        # profiling modules load only when profiling is asked for
+        import cProfile
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as error:
+            # only one profiler may be active at a time on python 3.12+
+            log.debug("Can't profile thread %r", error)
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def _thread_hook(self, *args: Any) -> None:
+        sys.setprofile(None)
+        self._enable()
+
+    def start(self) -> None:
+        """Start profiling."""
+        self._enable()
+        threading.setprofile(self._thread_hook)
+
+    def stop(self, path: Union[str, os.PathLike]) -> None:
+        """Stop profiling and save merged stats of all threads into `path`."""
+        threading.setprofile(None)
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        if not profiles:
+            return
+        import pstats
+
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(os.fspath(path))
+
+
+# registry of the running process
+metrics = Metrics()
@@ -0,0 +1,112 @@
+"""Retry adb operations failing for reasons that go away.
+
+A loose cable, a device rebooting adbd or a hung transfer killed by its
+timeout fail an operation which succeeds when tried again. An apk the
+package manager rejects or a path missing on the device fails the same
+way every time. Errors are told apart by their message, adb reports both
+kinds with the same exit code.
+
+Attempts are spaced by exponential backoff with full jitter, devices
+sharing a usb hub don't all come back at once.
+
+    size = call_with_retry(lambda: server.pull(path, dest), "pull", label)
+"""
+
+from typing import Callable, TypeVar
+import collections
+import logging
+import random
+import time
+
+from mass_apk.adb import AdbError, AdbTimeoutError
+from mass_apk.metrics import metrics
+
+__all__ = ["RetryPolicy", "DEFAULT_POLICY", "call_with_retry", "is_transient"]
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# at most `attempts` tries, the n-th retry waits up to
+# `min(max_delay, base_delay * 2 ** n)` seconds
+RetryPolicy = collections.namedtuple(
+    "RetryPolicy", "attempts base_delay max_delay", defaults=(3, 1.0, 30.0)
+)
+
+DEFAULT_POLICY = RetryPolicy()
+
+# failures of the apk or the device storage, trying again won't help
+PERMANENT_ERRORS = (
+    "INSTALL_FAILED_",
+    "INSTALL_PARSE_FAILED_",
+    "No such file",
+    "does not exist",
+    "Permission denied",
+    "unauthorized",
+)
+
+# failures of the connection to the device
+TRANSIENT_ERRORS = (
+    "device offline",
+    "not found",
+    "no devices",
+    "closed",
+    "Connection reset",
+    "Connection refused",
+    "Broken pipe",
+    "protocol fault",
+    "Can't connect",
+    "failed to connect",
+    "failed to copy",
+    "interrupted",
+    "terminated",
+)
+
+
+def is_transient(error: BaseException) -> bool:
+    """Check if operation failing with `error` may succeed when tried again."""
+    if isinstance(error, AdbTimeoutError):
+        return True
+    if not isinstance(error, AdbError):
+        return False
+    message = str(error)
+    if any(marker in message for marker in PERMANENT_ERRORS):
+        return False
+    return any(marker in message for marker in TRANSIENT_ERRORS)
+
+
+def call_with_retry(
+    func: Callable[[], T],
+    phase: str,
+    device: str,
+    policy: RetryPolicy = DEFAULT_POLICY,
+    sleep: Callable[[float], None] = time.sleep,
+) -> T:
+    """Return `func()`, calling it again while it fails with a transient error.
+
+    Retries are counted in metrics of `phase` and `device`.
+
+    :raises AdbError of the last attempt, or the first permanent one.
+    """
+    attempt = 1
+    while True:
+        try:
+            return func()
+        except AdbError as error:
+            if attempt >= policy.attempts or not is_transient(error):
+                raise
+            delay = random.uniform(
+                0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1))
+            )
+            log.warning(
+                "%s %s failed, attempt %s of %s in %.1fs %r",
+                device,
+                phase,
+                attempt + 1,
+                policy.attempts,
+                delay,
+                error,
+            )
+            metrics.retry(phase, device)
+            sleep(delay)
+            attempt += 1
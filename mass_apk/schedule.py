@@ -0,0 +1,116 @@
+"""Order apks to restore and estimate how long restoring takes.
+
+Apks are installed longest first, so a large apk doesn't start last and
+hold the whole restore up, packages of a priority list go before any
+other. Install speed is learned while restoring, seconds per MB observed
+on every device refine the estimate all devices use for their ETA.
+"""
+
+from typing import Iterable, List, Optional, Sequence, Union
+import logging
+import os
+import threading
+
+from mass_apk.helpers import MB
+from mass_apk.sources import ApkSource, package_name, package_size
+
+__all__ = [
+    "InstallEstimator",
+    "read_priority",
+    "schedule_apks",
+    "format_eta",
+    "estimator",
+]
+
+log = logging.getLogger(__name__)
+
+# install speed assumed before anything got installed
+DEFAULT_SECONDS_PER_MB = 0.1
+# MB of observations the default is worth, it fades once that much is installed
+PRIOR_MB = 64.0
+
+
+def read_priority(path: Union[str, os.PathLike]) -> List[str]:
+    """Read packages of priority list `path`, one per line, `#` comments."""
+    packages = []
+    with open(path) as in_file:
+        for line in in_file:
+            package = line.split("#", 1)[0].strip()
+            if package:
+                packages.append(package_name(package))
+    return packages
+
+
+def schedule_apks(
+    apks: Iterable[ApkSource], priority: Optional[Sequence[str]] = None
+) -> List[ApkSource]:
+    """Return `apks` in install order.
+
+    Packages of `priority` come first in the listed order, the rest
+    longest first, split apks counted in. Ties keep their name order so schedules are stable.
+    """
+    rank = {package: index for index, package in enumerate(priority or [])}
+    apks = sorted(apks, key=lambda apk: apk.name)
+    first = [apk for apk in apks if package_name(apk.name) in rank]
+    first.sort(key=lambda apk: rank[package_name(apk.name)])
+    rest = [apk for apk in apks if package_name(apk.name) not in rank]
+    rest.sort(key=package_size, reverse=True)
+    missing = rank.keys() - {package_name(apk.name) for apk in first}
+    if missing:
+        log.warning("Priority packages not in back up: %s", ", ".join(sorted(missing)))
+    return first + rest
+
+
+class InstallEstimator(object):
+    """Learned install seconds per MB, shared by the devices of a run.
+
+    The estimate is the observed install time over observed MB, with the
+    default counted as `PRIOR_MB` of observations so a few small apks
+    don't swing it.
+    """
+
+    def __init__(self, seconds_per_mb: float = DEFAULT_SECONDS_PER_MB):
+        self._prior = seconds_per_mb
+        self._seconds = 0.0
+        self._mb = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def seconds_per_mb(self) -> float:
+        """Get current install time estimate per MB."""
+        with self._lock:
+            return (self._prior * PRIOR_MB + self._seconds) / (PRIOR_MB + self._mb)
+
+    def observe(self, size: int, seconds: float) -> None:
+        """Account `size` bytes installed in `seconds`."""
+        with self._lock:
+            self._seconds += seconds
+            self._mb += size / MB
+
+    def estimate(self, size: int) -> float:
+        """Return seconds `size` bytes are expected to take to install."""
+        return size / MB * self.seconds_per_mb
+
+    def remaining(self, size: int, done: int, elapsed: float) -> float:
+        """Return seconds a device needs for `size` bytes left to install.
+
+        The device installed `done` bytes in `elapsed` seconds so far, its
+        own speed takes over from the shared estimate as it installs more.
+        """
+        seconds_per_mb = (self.seconds_per_mb * PRIOR_MB + elapsed) / (
+            PRIOR_MB + done / MB
+        )
+        return size / MB * seconds_per_mb
+
+
+def format_eta(seconds: float) -> str:
+    """Format `seconds` left like `ETA 1:05:09` or `ETA 2:07`."""
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"ETA {hours}:{minutes:02d}:{seconds:02d}"
+    return f"ETA {minutes}:{seconds:02d}"
+
+
+# estimator of the running process
+estimator = InstallEstimator()
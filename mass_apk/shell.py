@@ -0,0 +1,231 @@
+"""Long lived adb shell sessions.
+
+Every `adb shell <cmd>` spawns a new adb client process which opens a new
+connection to adb-server and a new shell on the device. A `ShellSession`
+keeps one `adb shell` open and frames many commands over its stdin/stdout,
+each command output is terminated by a sentinel line carrying the exit code.
+"""
+
+from typing import Callable, Generator, Iterator, List, Optional, Sequence, Tuple
+import contextlib
+import logging
+import os
+import subprocess
+import threading
+
+from mass_apk.exceptions import MassApkError
+from mass_apk.helpers import Watchdog
+
+__all__ = ["ShellError", "ShellTimeoutError", "ShellSession", "ShellPool"]
+
+log = logging.getLogger(__name__)
+
+
+class ShellError(MassApkError):
+    """Exception raised when a shell session is not usable."""
+
+
+class ShellTimeoutError(ShellError):
+    """Exception raised when a command doesn't complete in time.
+
+    The session is killed, its output can't be told apart from the next one.
+    """
+
+
+class ShellSession(object):
+    """A single `adb shell` process executing commands one after another."""
+
+    def __init__(self, args: Sequence[str], timeout: Optional[float] = None):
+        """Open shell session, `args` is the adb command line to run.
+
+        Commands not given a timeout are killed after `timeout` seconds,
+        None waits for them forever.
+        """
+        self._timeout = timeout
+        # random marker, uuid would import platform at startup
+        self._marker = f"__MASSAPK_{os.urandom(16).hex()}__"
+        self._busy = False
+        try:
+            self._process = subprocess.Popen(
+                list(args),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                bufsize=1,
+            )
+        except OSError as error:
+            raise ShellError(f"Can't start shell session {error}")
+
+        # a device shell allocating a pty echoes input and prints prompts,
+        # make sure output of a well known command comes back untouched
+        try:
+            return_code, output = self.run("echo ready")
+        except ShellError:
+            self.close()
+            raise
+        if return_code or output != "ready":
+            self.close()
+            raise ShellError(f"Unexpected shell session handshake {output!r}")
+
+    @property
+    def alive(self) -> bool:
+        """Check if shell process is still running."""
+        return self._process.poll() is None
+
+    @property
+    def busy(self) -> bool:
+        """Check if output of a command is still pending to be read."""
+        return self._busy
+
+    def iter_lines(
+        self, cmd: str, timeout: Optional[float] = None
+    ) -> Generator[str, None, int]:
+        """Execute `cmd` and yield its output line by line.
+
+        Exit code of `cmd` is returned as the generator return value.
+
+        :raises ShellTimeoutError if `cmd` runs over `timeout` seconds.
+        :raises ShellError if the session terminated while reading output.
+        """
+        if not self.alive or self._busy:
+            raise ShellError("Shell session is closed or busy")
+
+        assert self._process.stdin is not None and self._process.stdout is not None
+        # run in a subshell so `exit` or reading stdin can't break the session,
+        # newline before the sentinel terminates output without trailing newline
+        try:
+            self._process.stdin.write(
+                f"( {cmd}\n) </dev/null 2>&1; printf '\\n{self._marker} %d\\n' $?\n"
+            )
+            self._process.stdin.flush()
+        except OSError as error:
+            self.close()
+            raise ShellError(f"Shell session closed {error}")
+        self._busy = True
+
+        pending: Optional[str] = None
+        timeout = self._timeout if timeout is None else timeout
+        with Watchdog(timeout, self._process.kill) as watchdog:
+            for raw in self._process.stdout:
+                line = raw.rstrip("\r\n")
+                if line.startswith(self._marker):
+                    # drop the empty line produced by the newline before sentinel
+                    if pending:
+                        yield pending
+                    self._busy = False
+                    return int(line[len(self._marker) :].strip() or 1)
+                if pending is not None:
+                    yield pending
+                pending = line
+
+        self.close()
+        if watchdog.fired:
+            raise ShellTimeoutError(f"Command {cmd} timed out after {timeout}s")
+        raise ShellError(f"Shell session terminated while running {cmd}")
+
+    def run(self, cmd: str) -> Tuple[int, str]:
+        """Execute `cmd` and return exit code and output."""
+        lines: List[str] = []
+        stream = self.iter_lines(cmd)
+        while True:
+            try:
+                lines.append(next(stream))
+            except StopIteration as result:
+                return result.value, "\n".join(lines)
+
+    def close(self) -> None:
+        """Terminate shell process."""
+        if self.alive and self._busy:
+            self._process.kill()
+            self._process.wait()
+        if self.alive:
+            try:
+                assert self._process.stdin is not None
+                self._process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self._process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        for stream in (self._process.stdin, self._process.stdout):
+            if stream is not None and not stream.closed:
+                with contextlib.suppress(OSError):
+                    stream.close()
+
+
+class ShellPool(object):
+    """Pool of shell sessions shared between threads.
+
+    Each caller gets a session for its own exclusive use, at most `size`
+    sessions are opened, extra callers wait for a session to be released.
+    """
+
+    def __init__(self, factory: Callable[[], ShellSession], size: int = 4):
+        self._factory = factory
+        self._size = size
+        self._idle: List[ShellSession] = []
+        self._opened = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        """Get maximum number of sessions opened by the pool."""
+        return self._size
+
+    @contextlib.contextmanager
+    def session(self) -> Iterator[ShellSession]:
+        """Borrow a shell session from the pool.
+
+        Broken sessions are discarded instead of returned to the pool.
+
+        :raises ShellError if a new session can't be opened.
+        """
+        shell = self._acquire()
+        try:
+            yield shell
+        finally:
+            self._release(shell)
+
+    def _acquire(self) -> ShellSession:
+        with self._cond:
+            while True:
+                while self._idle:
+                    shell = self._idle.pop()
+                    if shell.alive:
+                        return shell
+                    self._opened -= 1
+                if self._opened < self._size:
+                    self._opened += 1
+                    break
+                self._cond.wait()
+
+        try:
+            return self._factory()
+        except BaseException:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, shell: ShellSession) -> None:
+        # a session with unread output, e.g. an abandoned `iter_lines`
+        # generator, would leak it into the next command
+        if shell.busy:
+            shell.close()
+        with self._cond:
+            if shell.alive:
+                self._idle.append(shell)
+            else:
+                self._opened -= 1
+            self._cond.notify()
+
+    def close(self) -> None:
+        """Close all idle sessions."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for shell in idle:
+            shell.close()
@@ -0,0 +1,456 @@
+"""Apks to restore, read from a back up folder, zip archive or store.
+
+The manifest of a back up is its index, apks are looked up through it so
+restoring a few packages of a large archive only reads their members.
+Back ups without a manifest are listed instead, apks in a folder named
+after a listed apk, e.g. `com.a/` for `com.a.apk`, are its split apks.
+"""
+
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+import collections
+import contextlib
+import fnmatch
+import functools
+import io
+import logging
+import os
+import posixpath
+import re
+import shutil
+import tarfile
+import tempfile
+from zipfile import ZipFile, ZipInfo, is_zipfile
+
+from mass_apk.adaptive import limits
+from mass_apk.adb import Adb
+from mass_apk.exceptions import MassApkError
+from mass_apk.manifest import MANIFEST_NAME, Manifest, ManifestError, entry_files
+from mass_apk.retry import call_with_retry
+from mass_apk.store import ApkStore
+
+__all__ = [
+    "ApkSource",
+    "PackageFilter",
+    "open_sources",
+    "stream_sources",
+    "install",
+    "package_name",
+    "package_size",
+]
+
+log = logging.getLogger(__name__)
+
+
+# `path` is the apk location on local disk or None when the apk is only
+# readable as a stream, `open` is a callable returning a binary file object,
+# `digest` identifies the content, sha256 from the back up index or the zip
+# crc32, None when unknown, `splits` are sources of the split apks installed
+# together with this base apk
+ApkSource = collections.namedtuple(
+    "ApkSource", "name size path open digest splits", defaults=(None, ())
+)
+
+
+def package_name(apk_name: str) -> str:
+    """Return package of apk file `apk_name`, e.g. `com.a` for `com.a.apk`."""
+    name = os.path.basename(apk_name)
+    return name[: -len(".apk")] if name.endswith(".apk") else name
+
+
+def package_size(apk: ApkSource) -> int:
+    """Return size of `apk` and its split apks."""
+    return apk.size + sum(split.size for split in apk.splits)
+
+
+class PackageFilter(object):
+    """Select packages matching any `include` pattern and no `exclude` one.
+
+    Patterns are globs like `com.google.*`, or regular expressions when
+    prefixed with `re:`, e.g. `re:^org\\.(fdroid|mozilla)\\.`. Without
+    `include` patterns every package not excluded is selected.
+
+    :raises MassApkError if a regular expression is invalid.
+    """
+
+    def __init__(self, include: Iterable[str] = (), exclude: Iterable[str] = ()):
+        self._include = [self._compile(pattern) for pattern in include]
+        self._exclude = [self._compile(pattern) for pattern in exclude]
+
+    @staticmethod
+    def _compile(pattern: str) -> "re.Pattern[str]":
+        if not pattern.startswith("re:"):
+            return re.compile(fnmatch.translate(pattern))
+        try:
+            return re.compile(pattern[len("re:") :])
+        except re.error as error:
+            raise MassApkError(f"Invalid package pattern {pattern!r} {error}")
+
+    def __bool__(self) -> bool:
+        return bool(self._include or self._exclude)
+
+    def matches(self, package: str) -> bool:
+        """Check if `package` is selected."""
+        if self._include and not any(p.search(package) for p in self._include):
+            return False
+        return not any(p.search(package) for p in self._exclude)
+
+
+def _file_source(
+    name: str, path: str, digest: Optional[str] = None, splits: Tuple = ()
+) -> ApkSource:
+    opener = functools.partial(open, path, "rb")
+    return ApkSource(name, os.path.getsize(path), path, opener, digest, splits)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as in_file:
+        return in_file.read()
+
+
+def _read_index(read: Callable[[], bytes]) -> Optional[Manifest]:
+    """Return the manifest `read` returns, None if the back up has none."""
+    try:
+        return Manifest.from_json(read())
+    except (KeyError, OSError):
+        return None
+    except ManifestError as error:
+        log.warning("Ignoring back up index %s", error)
+        return None
+
+
+def folder_sources(
+    path: Union[str, os.PathLike], select: Optional[PackageFilter] = None
+) -> List[ApkSource]:
+    """Return apks of back up folder `path`, those `select` matches."""
+    index = _read_index(
+        functools.partial(_read_file, os.path.join(path, MANIFEST_NAME))
+    )
+    if index is not None:
+        listed = [
+            (
+                entry.file,
+                entry.sha256 or None,
+                [(split.file, split.sha256 or None) for split in entry.splits],
+            )
+            for entry in index
+        ]
+        indexed = {entry.file for entry in index}
+        unlisted = [
+            file
+            for file in sorted(os.listdir(path))
+            if file.endswith(".apk") and file not in indexed
+        ]
+        if unlisted:
+            log.warning(
+                "Skipping apks the back up manifest doesn't list %s",
+                ", ".join(unlisted),
+            )
+    else:
+        listed = [
+            (file, None, [(split, None) for split in _split_files(path, file)])
+            for file in os.listdir(path)
+            if file.endswith(".apk")
+        ]
+    if select is not None:
+        listed = [item for item in listed if select.matches(package_name(item[0]))]
+    return [
+        _file_source(
+            file,
+            os.path.join(path, file),
+            digest,
+            tuple(
+                _file_source(split, os.path.join(path, split), split_digest)
+                for split, split_digest in splits
+            ),
+        )
+        for file, digest, splits in sorted(listed)
+    ]
+
+
+def _split_files(path: Union[str, os.PathLike], file: str) -> List[str]:
+    """Return split apks of apk `file` of back up folder `path`."""
+    split_dir = os.path.join(path, package_name(file))
+    if not os.path.isdir(split_dir):
+        return []
+    return [
+        f"{package_name(file)}/{split}"
+        for split in sorted(os.listdir(split_dir))
+        if split.endswith(".apk")
+    ]
+
+
+def zip_sources(
+    zip_file: ZipFile, select: Optional[PackageFilter] = None
+) -> List[ApkSource]:
+    """Return apks of an open back up archive, those `select` matches.
+
+    Apks are looked up in the archive manifest and the zip central
+    directory, members are decompressed while being read, nothing is
+    extracted on disk.
+    """
+    index = _read_index(functools.partial(zip_file.read, MANIFEST_NAME))
+    if index is not None:
+        listed = [
+            (
+                entry.file,
+                entry.sha256,
+                [(split.file, split.sha256) for split in entry.splits],
+            )
+            for entry in index
+        ]
+    else:
+        names = {
+            info.filename
+            for info in zip_file.infolist()
+            if info.filename.endswith(".apk") and not info.is_dir()
+        }
+        splits: Dict[str, List[str]] = collections.defaultdict(list)
+        for name in sorted(names):
+            parent = posixpath.dirname(name)
+            if parent and f"{parent}.apk" in names:
+                splits[f"{parent}.apk"].append(name)
+        grouped = {split for package in splits.values() for split in package}
+        listed = [
+            (name, None, [(split, None) for split in splits[name]])
+            for name in names
+            if name not in grouped
+        ]
+    if select is not None:
+        # members of packages left out are never looked up
+        listed = [item for item in listed if select.matches(package_name(item[0]))]
+    return [
+        _zip_source(
+            zip_file,
+            zip_file.getinfo(file),
+            digest,
+            tuple(
+                _zip_source(zip_file, zip_file.getinfo(split), split_digest)
+                for split, split_digest in split_digests
+            ),
+        )
+        for file, digest, split_digests in sorted(listed)
+    ]
+
+
+def _zip_source(
+    zip_file: ZipFile, info: ZipInfo, digest: Optional[str], splits: Tuple = ()
+) -> ApkSource:
+    return ApkSource(
+        info.filename,
+        info.file_size,
+        None,
+        lambda: zip_file.open(info),
+        digest or f"crc32:{info.CRC:08x}:{info.file_size}",
+        splits,
+    )
+
+
+def store_sources(
+    store: ApkStore, name: str, select: Optional[PackageFilter] = None
+) -> List[ApkSource]:
+    """Return apks of back up `name` of `store`, those `select` matches.
+
+    Apks stored as deltas are rebuilt into a temporary file when opened.
+    """
+    sources = []
+    for entry in store.load_backup(name):
+        if select is not None and not select.matches(entry.package):
+            continue
+        splits = tuple(
+            _store_source(store, split.file, split.sha256) for split in entry.splits
+        )
+        sources.append(_store_source(store, entry.file, entry.sha256, splits))
+    return sources
+
+
+def _store_source(
+    store: ApkStore, file: str, sha256: str, splits: Tuple = ()
+) -> ApkSource:
+    if store.has_full(sha256):
+        return _file_source(file, store.object_path(sha256), sha256, splits)
+    return ApkSource(
+        file,
+        store.blob_size(sha256),
+        None,
+        functools.partial(store.open_blob, sha256),
+        sha256,
+        splits,
+    )
+
+
+@contextlib.contextmanager
+def open_sources(
+    path: Union[str, os.PathLike],
+    name: Optional[str] = None,
+    select: Optional[PackageFilter] = None,
+) -> Iterator[List[ApkSource]]:
+    """Open back up `path`, a folder, zip archive or store, and list its apks.
+
+    For a store `name` selects the back up, by default the latest one.
+    With `select` only apks of the packages it matches are listed.
+    Sources are readable until the context exits.
+
+    :raises MassApkError if `path` is not a back up or an apk of its
+        manifest is missing.
+    """
+    select = select or None
+    with contextlib.ExitStack() as stack:
+        try:
+            if ApkStore.is_store(path):
+                store = ApkStore(path)
+                name = name or (store.backups() or [""])[-1]
+                log.info(f"Restoring back up `{name}` from store `{path}` *  *Store*")
+                sources = store_sources(store, name, select)
+
+            elif os.path.isdir(path):
+                log.info(f"Restoring back up from path `{path}` *  *Folder*")
+                sources = folder_sources(path, select)
+
+            elif os.path.isfile(path) and is_zipfile(path):
+                log.info(f"Restoring back up from path {path} *  *Zip*")
+                zip_file = stack.enter_context(ZipFile(path, "r"))
+                sources = zip_sources(zip_file, select)
+
+            else:
+                raise MassApkError(f"Not a back up folder, zip archive or store {path}")
+        except (KeyError, FileNotFoundError) as error:
+            raise MassApkError(
+                f"Back up {path} is missing an apk of its manifest {error}"
+            )
+        if select is not None:
+            log.info("%s apks match the package filters", len(sources))
+        yield sources
+
+
+class _StreamMember(io.RawIOBase):
+    """Apk of a tar stream, a stream ending within it raises MassApkError."""
+
+    def __init__(self, tar_file: tarfile.TarFile, member: tarfile.TarInfo):
+        super().__init__()
+        data = tar_file.extractfile(member)
+        # members are read through `tarfile.ExFileObject`, a buffered reader
+        assert isinstance(data, io.BufferedReader)
+        self._data = data
+        self._name = member.name
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        try:
+            return self._data.readinto(buffer)
+        except tarfile.ReadError:
+            raise MassApkError(f"Back up stream ends within {self._name}, truncated")
+
+    def close(self) -> None:
+        self._data.close()
+        super().close()
+
+
+def stream_sources(
+    in_file: BinaryIO, select: Optional[PackageFilter] = None
+) -> Iterator[ApkSource]:
+    """Yield apks of back up tar stream `in_file` as they arrive.
+
+    Only apks `select` matches are yielded, each one is readable until the
+    next is asked for, `in_file` is read once and never seeked. Compressed
+    streams, e.g. gzip, are decompressed. The manifest comes last in a
+    stream, it tells whether the stream is complete. Split apks come before
+    their base apk, they are spooled to temporary files until it arrives,
+    those whose base apk never arrives are skipped.
+
+    :raises MassApkError if the stream is malformed, truncated or lacks apks
+    its manifest lists.
+    """
+    index = None
+    names = set()
+    pending: Dict[str, List[ApkSource]] = collections.defaultdict(list)
+    try:
+        with tempfile.TemporaryDirectory() as spool_dir, tarfile.open(
+            fileobj=in_file, mode="r|*"
+        ) as tar_file:
+            for member in tar_file:
+                if member.name == MANIFEST_NAME:
+                    data = tar_file.extractfile(member)
+                    assert data is not None
+                    index = Manifest.from_json(data.read())
+                    continue
+                if not member.isfile() or not member.name.endswith(".apk"):
+                    continue
+                names.add(member.name)
+                package = package_name(member.name)
+                parent = posixpath.dirname(member.name)
+                if parent:
+                    if select is None or select.matches(package_name(parent)):
+                        pending[parent].append(_spool(tar_file, member, spool_dir))
+                    continue
+                splits = tuple(pending.pop(package, ()))
+                if select is None or select.matches(package):
+                    yield ApkSource(
+                        member.name,
+                        member.size,
+                        None,
+                        functools.partial(_StreamMember, tar_file, member),
+                        None,
+                        splits,
+                    )
+                for split in splits:
+                    os.remove(split.path)
+            # split apks don't install without their base apk
+            orphans = [apk.name for apks in pending.values() for apk in apks]
+            if orphans:
+                log.warning(
+                    "Skipping split apks without a base apk %s", ", ".join(orphans)
+                )
+    except tarfile.TarError as error:
+        raise MassApkError(f"Can't read back up stream {error}")
+    except ManifestError as error:
+        raise MassApkError(f"Malformed back up stream manifest {error}")
+    if index is None:
+        raise MassApkError("Back up stream ends before its manifest, truncated")
+    missing = [
+        file for entry in index for file, _ in entry_files(entry) if file not in names
+    ]
+    if missing:
+        raise MassApkError(f"Back up stream lacks apks {', '.join(missing)}")
+
+
+def _spool(
+    tar_file: tarfile.TarFile, member: tarfile.TarInfo, spool_dir: str
+) -> ApkSource:
+    """Copy apk `member` of a tar stream into a file of `spool_dir`."""
+    handle, path = tempfile.mkstemp(".apk", dir=spool_dir)
+    with os.fdopen(handle, "wb") as out_file, _StreamMember(tar_file, member) as data:
+        shutil.copyfileobj(data, out_file)
+    return _file_source(member.name, path)
+
+
+def install(server: Adb, source: ApkSource) -> None:
+    """Install apk `source` on the device behind `server`.
+
+    Apks on disk are installed from their path, others are streamed.
+    Installs failing for transient reasons are retried.
+
+    :raises AdbError if the apk fails to install.
+    """
+
+    def attempt() -> None:
+        with limits.slot(server, "install", device=False) as measurement:
+            if source.path is not None:
+                server.push(source.path)
+            else:
+                with source.open() as in_file:
+                    server.push_stream(in_file, source.size, source.name)
+            measurement.bytes = source.size
+
+    call_with_retry(attempt, "install", server.device_label)
@@ -0,0 +1,438 @@
+"""Content addressed apk store.
+
+Apks are stored once under `objects/<sha256>` whatever the number of
+back ups or devices they come from, each back up is a manifest under
+`backups/<name>.json` referencing the blobs by sha256. `compact` keeps
+the newest version of each package in full and older ones as deltas
+against it, `objects/<sha256>.delta`, rebuilt when they are read.
+
+    store/
+        objects/3a7bd3e2360a3d29eea436fcfb7e44c735d117c42d1c1835420b6b9942dd4f1b
+        objects/9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08.delta
+        backups/2021-02-13.json
+"""
+
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+import collections
+import hashlib
+import logging
+import os
+import shlex
+import tempfile
+import uuid
+
+from mass_apk.adb import Adb, AdbError
+from mass_apk.delta import DeltaError, apply_delta, encode_delta, read_delta_header
+from mass_apk.exceptions import MassApkError
+from mass_apk.helpers import link_or_copy
+from mass_apk.manifest import Manifest, ManifestEntry, entry_files, sha256_file
+from mass_apk.metrics import metrics
+
+__all__ = ["StoreError", "ApkStore", "device_sha256"]
+
+log = logging.getLogger(__name__)
+
+DELTA_SUFFIX = ".delta"
+# largest delta kept, relative to the size of the apk it rebuilds
+MAX_DELTA_RATIO = 0.5
+
+
+class _VerifyingWriter(object):
+    """File object writing into `out_file` and hashing what it writes."""
+
+    def __init__(self, out_file: BinaryIO):
+        self._out = out_file
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        return self._out.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class StoreError(MassApkError):
+    """Exception raised for invalid store operations."""
+
+
+class ApkStore(object):
+    """Apk blobs addressed by sha256 plus back up manifests referencing them."""
+
+    def __init__(self, root: Union[str, os.PathLike]):
+        self.root = os.fspath(root)
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.backups_dir = os.path.join(self.root, "backups")
+
+    @classmethod
+    def is_store(cls, path: Union[str, os.PathLike]) -> bool:
+        """Check if `path` is the root folder of a store."""
+        return os.path.isdir(os.path.join(path, "objects")) and os.path.isdir(
+            os.path.join(path, "backups")
+        )
+
+    def init(self) -> "ApkStore":
+        """Create store folders if missing."""
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.backups_dir, exist_ok=True)
+        return self
+
+    def object_path(self, sha256: str) -> str:
+        """Return path of blob `sha256`."""
+        return os.path.join(self.objects_dir, sha256)
+
+    def delta_path(self, sha256: str) -> str:
+        """Return path of the delta rebuilding blob `sha256`."""
+        return self.object_path(sha256) + DELTA_SUFFIX
+
+    def has_full(self, sha256: str) -> bool:
+        """Check if blob `sha256` is stored in full, not as a delta."""
+        return os.path.isfile(self.object_path(sha256))
+
+    def has(self, sha256: str) -> bool:
+        """Check if blob `sha256` is already stored, in full or as a delta."""
+        return self.has_full(sha256) or os.path.isfile(self.delta_path(sha256))
+
+    def blob_size(self, sha256: str) -> int:
+        """Return size of blob `sha256`.
+
+        :raises StoreError if the blob is missing.
+        """
+        try:
+            return os.path.getsize(self.object_path(sha256))
+        except FileNotFoundError:
+            return self._delta_header(sha256)[1]
+
+    def _delta_header(self, sha256: str) -> Tuple[str, int]:
+        try:
+            with open(self.delta_path(sha256), "rb") as delta:
+                return read_delta_header(delta)
+        except FileNotFoundError:
+            raise StoreError(f"Blob {sha256} is missing")
+        except DeltaError as error:
+            raise StoreError(f"Delta of blob {sha256} is corrupt {error}")
+
+    def _rebuild(self, sha256: str, out_file: BinaryIO) -> None:
+        """Write blob `sha256`, stored as a delta, into `out_file`.
+
+        :raises StoreError if its base is missing or it doesn't match `sha256`.
+        """
+        base_sha256, _ = self._delta_header(sha256)
+        writer = _VerifyingWriter(out_file)
+        try:
+            with open(self.object_path(base_sha256), "rb") as base, open(
+                self.delta_path(sha256), "rb"
+            ) as delta:
+                with metrics.measure("delta_rebuild") as measurement:
+                    measurement.bytes = apply_delta(base, delta, writer)
+        except FileNotFoundError:
+            raise StoreError(f"Base {base_sha256} of blob {sha256} is missing")
+        except DeltaError as error:
+            raise StoreError(f"Can't rebuild blob {sha256} {error}")
+        if writer.hexdigest() != sha256:
+            raise StoreError(f"Blob {sha256} rebuilt as {writer.hexdigest()}")
+
+    def open_blob(self, sha256: str) -> BinaryIO:
+        """Open blob `sha256` for reading, a delta is rebuilt into a temp file.
+
+        :raises StoreError if the blob is missing or can't be rebuilt.
+        """
+        try:
+            return open(self.object_path(sha256), "rb")
+        except FileNotFoundError:
+            pass
+        out_file = tempfile.TemporaryFile()
+        try:
+            self._rebuild(sha256, out_file)
+        except BaseException:
+            out_file.close()
+            raise
+        out_file.seek(0)
+        return out_file
+
+    def copy_blob(
+        self, sha256: str, dest: Union[str, os.PathLike], clone: bool = False
+    ) -> None:
+        """Lay out blob `sha256` as file `dest`, linked when stored in full.
+
+        :raises StoreError if the blob is missing or can't be rebuilt.
+        """
+        path = self.object_path(sha256)
+        if os.path.isfile(path):
+            link_or_copy(path, os.fspath(dest), clone=clone)
+            return
+        tmp = f"{os.fspath(dest)}.tmp-{uuid.uuid4().hex}"
+        try:
+            with open(tmp, "wb") as out_file:
+                self._rebuild(sha256, out_file)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def add_file(
+        self, path: str, sha256: Optional[str] = None, move: bool = False
+    ) -> str:
+        """Store content of file `path` and return its sha256.
+
+        With `move` the file is moved into the store when its content is
+        not stored yet, otherwise it's left untouched and only linked or
+        copied.
+        """
+        sha256 = sha256 or sha256_file(path)
+        dest = self.object_path(sha256)
+        if os.path.isfile(dest):
+            return sha256
+
+        # write under a temporary name and rename so a blob is never partial
+        tmp = os.path.join(self.objects_dir, f".tmp-{uuid.uuid4().hex}")
+        if move:
+            os.replace(path, tmp)
+        else:
+            link_or_copy(path, tmp)
+        os.replace(tmp, dest)
+        return sha256
+
+    def ingest(self, backup_dir: Union[str, os.PathLike], name: str) -> Manifest:
+        """Move apks of back up folder `backup_dir` into the store.
+
+        Apks are replaced by links to their blob so `backup_dir` keeps the
+        legacy layout and the manifest is recorded as back up `name`.
+
+        :raises ManifestError if `backup_dir` has no manifest.
+        """
+        manifest = Manifest.load(backup_dir)
+        for file, sha256 in (item for entry in manifest for item in entry_files(entry)):
+            path = os.path.join(backup_dir, file)
+            blob = self.object_path(sha256)
+            if os.path.isfile(blob) and os.path.samefile(path, blob):
+                continue
+            self.add_file(path, sha256, move=True)
+            if os.path.exists(path):
+                os.remove(path)
+            link_or_copy(blob, path)
+        self.save_backup(name, manifest)
+        return manifest
+
+    def materialize(
+        self, name: str, dest_dir: Union[str, os.PathLike], clone: bool = True
+    ) -> Manifest:
+        """Lay out back up `name` as a legacy back up folder in `dest_dir`.
+
+        Apks are reflinked when the filesystem supports it, hard linked or
+        copied otherwise.
+        """
+        manifest = self.load_backup(name)
+        os.makedirs(dest_dir, exist_ok=True)
+        for file, sha256 in (item for entry in manifest for item in entry_files(entry)):
+            dest = os.path.join(dest_dir, file)
+            if not os.path.exists(dest):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                self.copy_blob(sha256, dest, clone=clone)
+        manifest.save(dest_dir)
+        return manifest
+
+    def blob(self, entry: ManifestEntry) -> str:
+        """Return path of the blob referenced by manifest `entry`.
+
+        :raises StoreError if the blob is missing or stored as a delta.
+        """
+        path = self.object_path(entry.sha256)
+        if not os.path.isfile(path):
+            kind = "stored as a delta" if self.has(entry.sha256) else "missing"
+            raise StoreError(f"Blob {entry.sha256} of {entry.package} is {kind}")
+        return path
+
+    def _manifest_path(self, name: str) -> str:
+        if not name or os.sep in name or "/" in name or name.startswith("."):
+            raise StoreError(f"Invalid back up name {name!r}")
+        return os.path.join(self.backups_dir, f"{name}.json")
+
+    def save_backup(self, name: str, manifest: Manifest) -> None:
+        """Record `manifest` as back up `name`."""
+        self.init()
+        manifest.write(self._manifest_path(name))
+
+    def load_backup(self, name: str) -> Manifest:
+        """Return manifest of back up `name`."""
+        return Manifest.read(self._manifest_path(name))
+
+    def backups(self) -> List[str]:
+        """Return names of stored back ups, oldest first."""
+        if not os.path.isdir(self.backups_dir):
+            return []
+        paths = [
+            os.path.join(self.backups_dir, item)
+            for item in os.listdir(self.backups_dir)
+            if item.endswith(".json")
+        ]
+        paths.sort(key=os.path.getmtime)
+        return [os.path.basename(path)[: -len(".json")] for path in paths]
+
+    def _object_files(self) -> Iterator[Tuple[str, str]]:
+        """Yield sha256 and path of every stored blob and delta."""
+        if not os.path.isdir(self.objects_dir):
+            return
+        for item in os.listdir(self.objects_dir):
+            if not item.startswith("."):
+                sha256 = item
+                if item.endswith(DELTA_SUFFIX):
+                    sha256 = item[: -len(DELTA_SUFFIX)]
+                yield sha256, os.path.join(self.objects_dir, item)
+
+    def iter_objects(self) -> Iterator[Tuple[str, int]]:
+        """Yield sha256 and size on disk of every stored blob and delta."""
+        for sha256, path in self._object_files():
+            yield sha256, os.path.getsize(path)
+
+    def _versions(self) -> Dict[str, List[str]]:
+        """Map packages to the blobs of their versions, the newest last."""
+        versions: Dict[str, List[str]] = collections.defaultdict(list)
+        for name in self.backups():
+            for entry in self.load_backup(name):
+                if entry.sha256 in versions[entry.package]:
+                    versions[entry.package].remove(entry.sha256)
+                versions[entry.package].append(entry.sha256)
+        return versions
+
+    def gc(self, dry_run: bool = False) -> Tuple[int, int]:
+        """Remove blobs no back up references.
+
+        Return number of blobs and bytes removed. Bases of referenced
+        deltas are kept. Blobs of a back up still running are not
+        referenced yet, don't collect while backing up.
+        """
+        referenced: Set[str] = set()
+        for name in self.backups():
+            for entry in self.load_backup(name):
+                referenced.update(sha256 for _, sha256 in entry_files(entry))
+        for sha256 in list(referenced):
+            if os.path.isfile(self.delta_path(sha256)):
+                referenced.add(self._delta_header(sha256)[0])
+
+        removed, freed = 0, 0
+        for sha256, path in list(self._object_files()):
+            if sha256 in referenced:
+                continue
+            log.info("Removing unreferenced blob %s", os.path.basename(path))
+            size = os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+            removed += 1
+            freed += size
+        return removed, freed
+
+    def compact(self, dry_run: bool = False) -> Tuple[int, int]:
+        """Store older versions of each package as deltas against the newest.
+
+        The newest version of a package stays in full so restoring the
+        latest back up reads no delta, older versions are encoded against
+        it and kept as deltas when at most `MAX_DELTA_RATIO` of their size.
+        Deltas against a version no longer the newest are encoded again.
+
+        Return number of blobs encoded and bytes saved. Blobs still linked
+        from back up folders keep their space until those are removed,
+        don't compact while backing up.
+        """
+        versions = self._versions()
+        newest = {shas[-1] for shas in versions.values()}
+        encoded, saved = 0, 0
+        for package, shas in sorted(versions.items()):
+            base = shas[-1]
+            if not dry_run:
+                self._keep_full(base)
+            if not self.has_full(base):
+                continue
+            # deltas against an older base are rebuilt before that base is
+            # encoded itself
+            older = sorted(shas[:-1], key=lambda sha: self.has_full(sha))
+            for sha256 in older:
+                if sha256 in newest or not self.has(sha256):
+                    continue
+                if not self.has_full(sha256) and self._delta_header(sha256)[0] == base:
+                    continue
+                saving = self._encode(sha256, base, dry_run)
+                if saving is not None:
+                    log.info("Stored %s %s as a delta", package, sha256)
+                    encoded += 1
+                    saved += saving
+        return encoded, saved
+
+    def _keep_full(self, sha256: str) -> None:
+        """Rebuild blob `sha256` in full if stored as a delta."""
+        path, delta = self.object_path(sha256), self.delta_path(sha256)
+        if not os.path.isfile(path) and os.path.isfile(delta):
+            tmp = os.path.join(self.objects_dir, f".tmp-{uuid.uuid4().hex}")
+            try:
+                with open(tmp, "wb") as out_file:
+                    self._rebuild(sha256, out_file)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        if os.path.isfile(delta):
+            os.remove(delta)
+
+    def _encode(self, sha256: str, base: str, dry_run: bool) -> Optional[int]:
+        """Store blob `sha256` as a delta against blob `base` if worth it.
+
+        Return bytes saved, None when the delta isn't kept.
+        """
+        path, delta = self.object_path(sha256), self.delta_path(sha256)
+        stored = sum(os.path.getsize(p) for p in (path, delta) if os.path.isfile(p))
+        tmp = os.path.join(self.objects_dir, f".tmp-{uuid.uuid4().hex}")
+        try:
+            with self.open_blob(sha256) as target, open(
+                self.object_path(base), "rb"
+            ) as base_file, open(tmp, "wb") as out_file:
+                with metrics.measure("delta_encode"):
+                    encode_delta(base_file, target, out_file, base)
+                size = target.seek(0, 2)
+            delta_size = os.path.getsize(tmp)
+            if delta_size > size * MAX_DELTA_RATIO:
+                log.debug("Delta of %s is %s of %s bytes", sha256, delta_size, size)
+                if not dry_run:
+                    # its old base may get encoded next, a delta against it
+                    # would make a chain
+                    self._keep_full(sha256)
+                return None
+            if not dry_run:
+                os.replace(tmp, delta)
+                if os.path.isfile(path):
+                    os.remove(path)
+            return stored - delta_size
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def device_sha256(
+    server: Adb, paths: Iterable[str], batch_size: int = 64
+) -> Dict[str, str]:
+    """Hash apks on the device with `sha256sum`, a few shell calls for all paths.
+
+    Return a dict mapping device path to sha256, paths which failed to hash
+    are left out. Empty dict is returned if the device has no `sha256sum`.
+    """
+    paths = list(paths)
+    hashes: Dict[str, str] = {}
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start : start + batch_size]
+        # unreadable paths must not fail the whole batch
+        cmd = "sha256sum {0} 2>/dev/null; true".format(
+            " ".join(shlex.quote(path) for path in batch)
+        )
+        try:
+            with metrics.measure("device_hash", server.device_label):
+                # hashing takes as long as reading the apks
+                output = server.shell(cmd, timeout=server.timeouts.transfer)
+        except AdbError as error:
+            log.warning("Hashing apks on device failed %r", error)
+            return hashes
+        # sha256sum prints lines in the form
+        # 3a7bd3e2360a3d29eea436fcfb7e44c735d117c42d1c1835420b6b9942dd4f1b  /data/app/...
+        for line in output.splitlines():
+            digest, sep, path = line.partition("  ")
+            if sep and len(digest) == 64:
+                hashes[path.strip()] = digest
+    return hashes
@@ -0,0 +1,165 @@
+"""Concurrent apk transfers between host and android device."""
+
+from typing import Callable, List, Optional, Tuple, Union
+import concurrent.futures
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from mass_apk.adaptive import DEFAULT_MAXIMUM, limits
+from mass_apk.adb import Adb, AdbError
+from mass_apk.apk import ApkAbsPath, split_file
+from mass_apk.helpers import MB
+from mass_apk.journal import Journal
+from mass_apk.metrics import Measurement
+from mass_apk.retry import call_with_retry
+from mass_apk.schedule import InstallEstimator, format_eta
+
+__all__ = ["Progress", "pull_apks"]
+
+log = logging.getLogger(__name__)
+
+
+class Progress(object):
+    """Thread safe counter of completed files and bytes.
+
+    Given the `total_bytes` to transfer and an `estimator` progress lines
+    show the time left, install speed is learned from each advance.
+    `total_files` is None when unknown, e.g. reading a stream. Files given
+    up on are listed in `failed` with their error.
+    """
+
+    def __init__(
+        self,
+        total_files: Optional[int],
+        verb: str = "pulled",
+        label: str = "",
+        total_bytes: Optional[int] = None,
+        estimator: Optional[InstallEstimator] = None,
+    ):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.failed: List[Tuple[str, str]] = []
+        self._verb = verb
+        self._label = f"{label} " if label else ""
+        self._estimator = estimator
+        self._lock = threading.Lock()
+        self._started = self._last = time.monotonic()
+
+    def fail(self, name: str, error: BaseException) -> None:
+        """Account file `name` given up on because of `error`."""
+        with self._lock:
+            self.failed.append((name, str(error)))
+        log.error("%sgave up on %s %s", self._label, name, error)
+
+    def advance(self, name: str, size: int) -> None:
+        """Account a completed file of `size` bytes and log progress."""
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            files, total_bytes = self.files, self.bytes
+            now = time.monotonic()
+            seconds, self._last = now - self._last, now
+
+        eta = ""
+        if self._estimator is not None and self.total_bytes is not None:
+            self._estimator.observe(size, seconds)
+            remaining = self._estimator.remaining(
+                self.total_bytes - total_bytes, total_bytes, now - self._started
+            )
+            eta = f" {format_eta(remaining)}"
+
+        log.info(
+            "%s[%4d/%4s] %8.2f MB %s%s ... %s",
+            self._label,
+            files,
+            "?" if self.total_files is None else self.total_files,
+            total_bytes / MB,
+            self._verb,
+            eta,
+            name,
+        )
+
+
+def pull_apks(
+    server: Adb,
+    items: List[ApkAbsPath],
+    dest_dir: Union[str, os.PathLike],
+    jobs: Optional[int] = None,
+    progress: Optional[Progress] = None,
+    on_pulled: Optional[Callable[[ApkAbsPath, str, int], None]] = None,
+    journal: Optional[Journal] = None,
+    keep_going: bool = False,
+) -> Progress:
+    """Pull apks of `items` into `dest_dir` with at most `jobs` transfers in flight.
+
+    Without `jobs` transfers in flight adapt to the throughput the device
+    and its usb bus sustain, see `adaptive`.
+
+    Each apk is written directly to `<dest_dir>/<package>.apk`, its split
+    apks to `<dest_dir>/<package>/`, pulls failing for transient reasons
+    are retried. On the first failed pull
+    transfers not yet started are cancelled and the error is raised once
+    running transfers are over, with `keep_going` the remaining apks are
+    pulled and failures are listed in `failed` of the returned progress.
+    `on_pulled` is called with the item, its destination and size of the
+    apk and its splits after each successful pull.
+
+    With `journal` pulls are recorded as started before the transfer and
+    as failed when it fails, `on_pulled` is left to record completion.
+
+    :raises AdbError if pulling an apk fails.
+    """
+    progress = progress or Progress(len(items), label=server.serial or "")
+
+    def attempt(item: ApkAbsPath, dest: str) -> int:
+        # a slot is held per attempt, backing off doesn't keep it busy
+        slot = (
+            limits.slot(server, "pull")
+            if jobs is None
+            else contextlib.nullcontext(Measurement())
+        )
+        with slot as measurement:
+            measurement.bytes = server.pull(item.fullpath, dest)
+            if item.splits:
+                os.makedirs(os.path.join(dest_dir, item.name), exist_ok=True)
+            for split in item.splits:
+                split_dest = os.path.join(dest_dir, split_file(item.name, split))
+                measurement.bytes += server.pull(split, split_dest)
+            return measurement.bytes
+
+    def pull(item: ApkAbsPath) -> None:
+        dest = os.path.join(dest_dir, f"{item.name}.apk")
+        if journal is not None:
+            journal.start(item.name)
+        try:
+            size = call_with_retry(
+                lambda: attempt(item, dest), "pull", server.device_label
+            )
+        except AdbError as error:
+            if journal is not None:
+                journal.fail(item.name, error)
+            if keep_going:
+                progress.fail(item.name, error)
+                return
+            raise
+        if on_pulled is not None:
+            on_pulled(item, dest, size)
+        progress.advance(item.name, size)
+
+    workers = max(jobs or DEFAULT_MAXIMUM, 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(pull, item) for item in items]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return progress
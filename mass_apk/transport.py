@@ -0,0 +1,352 @@
+"""Client for the adb-server host protocol.
+
+Talks to a running adb-server over TCP, port 5037 by default, instead of
+spawning the adb executable for every operation.
+
+Host requests are sent as a 4 hex digits length prefix followed by the
+request, server replies with `OKAY` or `FAIL` plus a length prefixed
+message. After `host:transport:<serial>` the same socket is connected to
+the device and device services like `shell:`, `exec:` or `sync:` can be
+requested on it.
+"""
+
+from typing import BinaryIO, Dict, Generator, Iterator, List, Optional, Tuple
+import contextlib
+import logging
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+from mass_apk.exceptions import TransportError
+
+__all__ = [
+    "TransportError",
+    "SocketTransport",
+    "SyncConnection",
+    "get_transport",
+    "is_timeout",
+]
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5037
+
+# maximum payload of a sync `DATA` packet
+SYNC_DATA_MAX = 64 * 1024
+
+# shell protocol v2 packet ids
+SHELL_STDIN = 0
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+SHELL_CLOSE_STDIN = 4
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    """Read exactly `size` bytes from `sock`."""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, SYNC_DATA_MAX))
+        if not chunk:
+            raise TransportError("Connection closed by adb-server")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _send_request(sock: socket.socket, request: str) -> None:
+    """Send a host request and wait for the server to acknowledge it."""
+    payload = request.encode("utf-8")
+    sock.sendall(b"%04x" % len(payload) + payload)
+    status = _recv_exact(sock, 4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        raise TransportError(f"{request} failed: {_recv_message(sock)}")
+    raise TransportError(f"{request} unexpected reply {status!r}")
+
+
+def _recv_message(sock: socket.socket) -> str:
+    """Read a 4 hex digits length prefixed message."""
+    size = int(_recv_exact(sock, 4), 16)
+    return _recv_exact(sock, size).decode("utf-8", errors="replace")
+
+
+class SyncConnection(object):
+    """Device connection switched to the file `sync:` protocol.
+
+    A sync connection serves any number of file transfers until closed,
+    sync packets are a 4 bytes id followed by a little endian length.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+
+    def _send_packet(self, packet_id: bytes, data: bytes) -> None:
+        self._sock.sendall(packet_id + struct.pack("<I", len(data)) + data)
+
+    def _recv_header(self) -> Tuple[bytes, int]:
+        packet_id, size = struct.unpack("<4sI", _recv_exact(self._sock, 8))
+        return packet_id, size
+
+    def _raise_fail(self, size: int, path: str) -> None:
+        message = _recv_exact(self._sock, size).decode("utf-8", errors="replace")
+        raise TransportError(f"sync failed for {path}: {message}")
+
+    def stat(self, path: str) -> Tuple[int, int, int]:
+        """Return `(mode, size, mtime)` of remote `path`.
+
+        Mode is zero when the path doesn't exist.
+        """
+        self._send_packet(b"STAT", path.encode("utf-8"))
+        packet_id, mode = self._recv_header()
+        if packet_id != b"STAT":
+            raise TransportError(f"sync stat unexpected reply {packet_id!r}")
+        size, mtime = struct.unpack("<II", _recv_exact(self._sock, 8))
+        return mode, size, mtime
+
+    def pull(self, path: str, out_file: BinaryIO) -> int:
+        """Stream remote `path` into `out_file`, return bytes written."""
+        self._send_packet(b"RECV", path.encode("utf-8"))
+        written = 0
+        while True:
+            packet_id, size = self._recv_header()
+            if packet_id == b"DATA":
+                out_file.write(_recv_exact(self._sock, size))
+                written += size
+            elif packet_id == b"DONE":
+                return written
+            elif packet_id == b"FAIL":
+                self._raise_fail(size, path)
+            else:
+                raise TransportError(f"sync pull unexpected reply {packet_id!r}")
+
+    def push(
+        self,
+        in_file: BinaryIO,
+        path: str,
+        mode: int = 0o644,
+        mtime: Optional[int] = None,
+    ) -> int:
+        """Stream `in_file` into remote `path`, return bytes sent."""
+        self._send_packet(b"SEND", f"{path},{stat.S_IFREG | mode}".encode("utf-8"))
+        sent = 0
+        while True:
+            chunk = in_file.read(SYNC_DATA_MAX)
+            if not chunk:
+                break
+            self._send_packet(b"DATA", chunk)
+            sent += len(chunk)
+        mtime = int(time.time()) if mtime is None else mtime
+        self._sock.sendall(b"DONE" + struct.pack("<I", mtime))
+        packet_id, size = self._recv_header()
+        if packet_id == b"FAIL":
+            self._raise_fail(size, path)
+        if packet_id != b"OKAY":
+            raise TransportError(f"sync push unexpected reply {packet_id!r}")
+        return sent
+
+    def close(self) -> None:
+        """End sync session and close the connection."""
+        with contextlib.suppress(OSError):
+            self._send_packet(b"QUIT", b"")
+        self._sock.close()
+
+
+class SocketTransport(object):
+    """Connect to adb-server and run device services over sockets.
+
+    Sync connections are pooled and reused between file transfers, other
+    device services consume their connection and open a new one.
+    """
+
+    def __init__(
+        self,
+        serial: Optional[str] = None,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        timeout: Optional[float] = None,
+    ):
+        self._serial = serial
+        self._address = (host, port)
+        self._timeout = timeout
+        self._sync_pool: List[SyncConnection] = []
+        self._lock = threading.Lock()
+
+    @property
+    def serial(self) -> Optional[str]:
+        """Get serial of the device this transport talks to."""
+        return self._serial
+
+    def _connect(self) -> socket.socket:
+        try:
+            return socket.create_connection(self._address, timeout=self._timeout)
+        except OSError as error:
+            raise TransportError(f"Can't connect to adb-server {error}")
+
+    def host_request(self, request: str) -> str:
+        """Send a `host:` request and return the server reply message."""
+        with contextlib.closing(self.open_host_service(request)) as sock:
+            return _recv_message(sock)
+
+    def open_host_service(self, request: str) -> socket.socket:
+        """Return a socket on which adb-server accepted host `request`.
+
+        Host services like `host:track-devices` keep replying on it.
+        """
+        sock = self._connect()
+        try:
+            _send_request(sock, request)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def host_serial_request(self, request: str) -> str:
+        """Send a host request about the device this transport targets."""
+        prefix = f"host-serial:{self._serial}" if self._serial else "host"
+        return self.host_request(f"{prefix}:{request}")
+
+    def version(self) -> int:
+        """Return adb-server protocol version."""
+        return int(self.host_request("host:version"), 16)
+
+    def get_state(self) -> str:
+        """Return device state e.g. `device`, `offline` or `unauthorized`."""
+        return self.host_serial_request("get-state")
+
+    def kill(self) -> None:
+        """Ask adb-server to exit."""
+        with contextlib.closing(self._connect()) as sock:
+            _send_request(sock, "host:kill")
+
+    def open_service(self, service: str) -> socket.socket:
+        """Return a socket connected to device `service`."""
+        sock = self._connect()
+        try:
+            if self._serial:
+                _send_request(sock, f"host:transport:{self._serial}")
+            else:
+                _send_request(sock, "host:transport-any")
+            _send_request(sock, service)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def iter_shell(self, cmd: str) -> Generator[str, None, int]:
+        """Run `cmd` in device shell and yield output lines.
+
+        Uses shell protocol v2 to get the exit code, the exit code is
+        returned as the generator return value.
+        """
+        with contextlib.closing(self.open_service(f"shell,v2,raw:{cmd}")) as sock:
+            pending = b""
+            return_code: Optional[int] = None
+            while return_code is None:
+                packet_id, size = struct.unpack("<BI", _recv_exact(sock, 5))
+                data = _recv_exact(sock, size)
+                if packet_id in (SHELL_STDOUT, SHELL_STDERR):
+                    pending += data
+                    *lines, pending = pending.split(b"\n")
+                    for line in lines:
+                        yield line.decode("utf-8", errors="replace").rstrip("\r")
+                elif packet_id == SHELL_EXIT:
+                    return_code = data[0] if data else 0
+            if pending:
+                yield pending.decode("utf-8", errors="replace").rstrip("\r")
+            return return_code
+
+    def exec_in(self, cmd: str, in_file: BinaryIO) -> str:
+        """Run `cmd` with `exec:` feeding `in_file` to its stdin.
+
+        Return command output once it exits.
+        """
+        with contextlib.closing(self.open_service(f"exec:{cmd}")) as sock:
+            while True:
+                chunk = in_file.read(SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                sock.sendall(chunk)
+            sock.shutdown(socket.SHUT_WR)
+            output = []
+            while True:
+                chunk = sock.recv(SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                output.append(chunk)
+        return b"".join(output).decode("utf-8", errors="replace")
+
+    @contextlib.contextmanager
+    def sync(self) -> Iterator[SyncConnection]:
+        """Borrow a sync connection from the pool.
+
+        A connection that raised during a transfer is not reused since its
+        protocol state is unknown.
+        """
+        with self._lock:
+            conn = self._sync_pool.pop() if self._sync_pool else None
+        if conn is None:
+            conn = SyncConnection(self.open_service("sync:"))
+
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+
+        with self._lock:
+            self._sync_pool.append(conn)
+
+    def pull(self, path: str, out_file: BinaryIO) -> int:
+        """Stream remote `path` into `out_file`, return bytes written."""
+        with self.sync() as conn:
+            return conn.pull(path, out_file)
+
+    def push(self, in_file: BinaryIO, path: str, mode: int = 0o644) -> int:
+        """Stream `in_file` into remote `path`, return bytes sent."""
+        with self.sync() as conn:
+            return conn.push(in_file, path, mode)
+
+    def close(self) -> None:
+        """Close pooled sync connections."""
+        with self._lock:
+            pool, self._sync_pool = self._sync_pool, []
+        for conn in pool:
+            conn.close()
+
+
+_transports: Dict[Tuple[Optional[str], str, int, Optional[float]], SocketTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(
+    serial: Optional[str] = None,
+    host: str = DEFAULT_HOST,
+    port: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> SocketTransport:
+    """Return the shared transport for device `serial`.
+
+    Sharing transports between `Adb` instances of the same device shares
+    their pooled connections too. Port defaults to `ANDROID_ADB_SERVER_PORT`
+    environment variable like the adb executable does. Connections of the
+    transport give up after `timeout` seconds without data.
+    """
+    if port is None:
+        port = int(os.environ.get("ANDROID_ADB_SERVER_PORT", DEFAULT_PORT))
+    key = (serial, host, port, timeout)
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = SocketTransport(serial, host, port, timeout)
+        return _transports[key]
+
+
+def is_timeout(error: BaseException) -> bool:
+    """Check if `error` is a socket operation timing out."""
+    # `socket.timeout` is only an alias of `TimeoutError` since python 3.10
+    return isinstance(error, (socket.timeout, TimeoutError))
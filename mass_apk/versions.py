@@ -0,0 +1,98 @@
+"""Skip apks the device already has at the same or a newer version.
+
+Package name and versionCode of an apk are read out of its binary
+`AndroidManifest.xml` and cached by content digest, a back up restored to
+many devices is parsed once. Installed versions come from a single
+`pm list packages --show-versioncode` per device.
+"""
+
+from typing import Dict, Hashable, List, Optional, Tuple
+import logging
+import os
+import threading
+
+from mass_apk.adb import Adb, AdbError
+from mass_apk.axml import ApkInfo, AxmlError, read_apk_info
+from mass_apk.manifest import query_package_info
+from mass_apk.metrics import metrics
+from mass_apk.sources import ApkSource, package_name
+
+__all__ = ["apk_info", "installed_versions", "split_up_to_date"]
+
+log = logging.getLogger(__name__)
+
+# apk infos of the running process keyed by content digest, None for apks
+# whose manifest couldn't be read
+_cache: Dict[Hashable, Optional[ApkInfo]] = {}
+_cache_lock = threading.Lock()
+
+
+def _cache_key(apk: ApkSource) -> Optional[Hashable]:
+    if apk.digest is not None:
+        return apk.digest
+    if apk.path is not None:
+        # without a digest an unchanged file is the best identity there is
+        stat = os.stat(apk.path)
+        return os.path.abspath(apk.path), stat.st_size, stat.st_mtime_ns
+    return None
+
+
+def apk_info(apk: ApkSource) -> Optional[ApkInfo]:
+    """Return package and versionCode of `apk`, None if they can't be read."""
+    key = _cache_key(apk)
+    with _cache_lock:
+        if key is not None and key in _cache:
+            return _cache[key]
+    try:
+        with apk.open() as in_file:
+            info: Optional[ApkInfo] = read_apk_info(in_file)
+    except (AxmlError, OSError) as error:
+        log.debug("Can't read version of %s %s", apk.name, error)
+        info = None
+    if key is not None:
+        with _cache_lock:
+            _cache[key] = info
+    return info
+
+
+def installed_versions(server: Adb) -> Dict[str, Optional[int]]:
+    """Return versionCode of packages installed on the device behind `server`.
+
+    Falls back on `dumpsys` when `pm` doesn't report versions, return an
+    empty dict if neither works.
+    """
+    try:
+        with metrics.measure("package_versions", server.device_label):
+            versions = server.package_versions()
+    except AdbError as error:
+        log.warning("Can't list installed package versions %r", error)
+        return {}
+    if any(version is None for version in versions.values()):
+        try:
+            infos = query_package_info(server)
+        except AdbError as error:
+            log.warning("Can't read installed package versions %r", error)
+            return {}
+        versions = {package: info.version_code for package, info in infos.items()}
+    return versions
+
+
+def split_up_to_date(
+    server: Adb, apks: List[ApkSource]
+) -> Tuple[List[ApkSource], List[ApkSource]]:
+    """Split `apks` into those to install and those the device has already.
+
+    An apk is up to date when the device has its package at the same or a
+    newer versionCode. Apks of packages not installed at all are not parsed,
+    apks whose version can't be read are installed.
+    """
+    installed = installed_versions(server)
+    to_install, up_to_date = [], []
+    for apk in apks:
+        info = apk_info(apk) if package_name(apk.name) in installed else None
+        version = installed.get(info.package) if info is not None else None
+        if info is not None and version is not None and version >= info.version_code:
+            up_to_date.append(apk)
+        else:
+            to_install.append(apk)
+    return to_install, up_to_date
@@ -0,0 +1,187 @@
+"""Watch devices being attached to and detached from adb-server.
+
+adb-server pushes the whole device table to `track-devices` clients each
+time a device changes state, so devices are noticed as soon as they are
+plugged in without polling `get-state`. Every message is a 4 hex digits
+length prefix followed by lines like `emulator-5554\tdevice`.
+
+    watcher = DeviceWatcher(server).start()
+    event = watcher.events.get()
+"""
+
+from typing import IO, Dict, Iterator, Optional
+import collections
+import logging
+import queue
+import socket
+import subprocess
+import threading
+
+from mass_apk.adb import Adb, parse_devices
+from mass_apk.exceptions import MassApkError, TransportError
+
+__all__ = [
+    "ATTACHED",
+    "READY",
+    "DETACHED",
+    "DeviceEvent",
+    "DeviceStream",
+    "DeviceWatcher",
+]
+
+log = logging.getLogger(__name__)
+
+# device showed up in any state, e.g. `unauthorized` until the user accepts
+ATTACHED = "attached"
+# device state became `device`, it accepts commands
+READY = "ready"
+# device is gone
+DETACHED = "detached"
+
+DeviceEvent = collections.namedtuple("DeviceEvent", "kind serial state")
+
+
+class DeviceStream(object):
+    """Device tables sent by adb-server to a `track-devices` client."""
+
+    def __init__(self, server: Adb):
+        self._sock: Optional[socket.socket] = None
+        self._process: Optional[subprocess.Popen] = None
+        if server.backend is Adb.Backend.SOCKET:
+            from mass_apk.transport import get_transport
+
+            self._sock = get_transport().open_host_service("host:track-devices")
+            self._file: IO[bytes] = self._sock.makefile("rb")
+        else:
+            # adb prints replies of the server unchanged, length prefix included
+            self._process = subprocess.Popen(
+                [str(server.path), "track-devices"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            assert self._process.stdout is not None
+            self._file = self._process.stdout
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        """Yield the table of devices and their states until the stream ends."""
+        while True:
+            prefix = self._file.read(4)
+            if len(prefix) < 4:
+                return
+            try:
+                size = int(prefix, 16)
+            except ValueError:
+                raise TransportError(f"track-devices unexpected reply {prefix!r}")
+            payload = self._file.read(size) if size else b""
+            if len(payload) < size:
+                return
+            yield parse_devices(payload.decode("utf-8", errors="replace"))
+
+    def close(self) -> None:
+        """End the stream, a thread blocked reading it returns."""
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._file.close()
+            self._sock.close()
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._file.close()
+
+
+class DeviceWatcher(object):
+    """Keep a table of attached devices and queue an event for each change.
+
+    A device is `ATTACHED` when first listed, `READY` each time its state
+    becomes `device` and `DETACHED` when no longer listed. When adb-server
+    goes away every device is detached and the watcher reconnects after
+    `reconnect_delay` seconds.
+    """
+
+    def __init__(
+        self,
+        server: Adb,
+        events: Optional["queue.Queue[DeviceEvent]"] = None,
+        reconnect_delay: float = 1.0,
+    ):
+        self.events: "queue.Queue[DeviceEvent]" = events or queue.Queue()
+        self._server = server
+        self._reconnect_delay = reconnect_delay
+        self._devices: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._stream: Optional[DeviceStream] = None
+        self._thread = threading.Thread(
+            target=self._run, name="device-watcher", daemon=True
+        )
+
+    @property
+    def devices(self) -> Dict[str, str]:
+        """Get a copy of the device table, serials mapped to states."""
+        with self._lock:
+            return dict(self._devices)
+
+    def start(self) -> "DeviceWatcher":
+        """Start watching in a background thread."""
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop watching and wait for the background thread to exit."""
+        self._stopped.set()
+        with self._lock:
+            stream = self._stream
+        if stream is not None:
+            stream.close()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def __enter__(self) -> "DeviceWatcher":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                stream = DeviceStream(self._server)
+            except (MassApkError, OSError) as error:
+                log.warning("Can't track devices %s", error)
+            else:
+                with self._lock:
+                    self._stream = stream
+                if self._stopped.is_set():
+                    stream.close()
+                try:
+                    for table in stream:
+                        self._update(table)
+                except (MassApkError, OSError) as error:
+                    if not self._stopped.is_set():
+                        log.warning("Tracking devices failed %s", error)
+                finally:
+                    stream.close()
+                    with self._lock:
+                        self._stream = None
+            if self._stopped.is_set():
+                return
+            # adb-server is gone, devices reappear once it is back
+            self._update({})
+            self._stopped.wait(self._reconnect_delay)
+
+    def _update(self, table: Dict[str, str]) -> None:
+        with self._lock:
+            previous, self._devices = self._devices, dict(table)
+        for serial, state in table.items():
+            if serial not in previous:
+                log.info("Device %s attached %s", serial, state)
+                self.events.put(DeviceEvent(ATTACHED, serial, state))
+            if state == "device" and previous.get(serial) != "device":
+                self.events.put(DeviceEvent(READY, serial, state))
+        for serial in previous.keys() - table.keys():
+            log.info("Device %s detached", serial)
+            self.events.put(DeviceEvent(DETACHED, serial, None))
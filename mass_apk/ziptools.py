@@ -1,44 +1,342 @@
-"""Compression related functions."""
+"""Compression related functions.
 
+Entries are compressed with zlib outside of any lock, zlib releases the
+GIL while it works so threads compress, and extract, on as many cores.
+"""
+
+import concurrent.futures
+import io
 import os
-from zipfile import ZipFile, ZIP_DEFLATED, is_zipfile
-from typing import Optional, Union
+import shutil
+import tarfile
+import tempfile
+import threading
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, is_zipfile
+from typing import BinaryIO, List, Optional, Set, Tuple, Union
 from pathlib import Path
 
-__all__ = ["unzipify", "zipify"]
+from mass_apk.helpers import balance
+from mass_apk.manifest import MANIFEST_NAME
+from mass_apk.metrics import metrics
+
+__all__ = [
+    "unzipify",
+    "zipify",
+    "ZipSink",
+    "TarSink",
+    "COMPRESSION_CHOICES",
+    "COMPRESSION_LEVELS",
+]
+
+# apks are zip archives already, deflating them again mostly burns cpu
+COMPRESSION_CHOICES = ("stored", "deflated", "auto")
+
+# `auto` compression deflates an entry only when samples shrink below this ratio
+_AUTO_RATIO = 0.9
+_SAMPLE_SIZE = 64 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+# zlib levels, 1 is fastest, 9 compresses most
+COMPRESSION_LEVELS = range(1, 10)
+
+# ZipFile internals adding an entry compressed beforehand relies on
+_RAW_WRITE_ATTRIBUTES = ("_writecheck", "_didModify", "start_dir", "fp")
+
+
+def _supports_raw_writes(zip_file: ZipFile) -> bool:
+    """Check if entries compressed beforehand can be added to `zip_file`."""
+    return all(hasattr(zip_file, name) for name in _RAW_WRITE_ATTRIBUTES)
+
+
+def _sample_ratio(path: Union[str, os.PathLike]) -> float:
+    """Estimate how well a file compresses from a few samples of it."""
+    size = os.path.getsize(path)
+    if not size:
+        return 1.0
+
+    offsets = {0, max(size // 2 - _SAMPLE_SIZE // 2, 0), max(size - _SAMPLE_SIZE, 0)}
+    raw, compressed = 0, 0
+    with open(path, "rb") as in_file:
+        for offset in sorted(offsets):
+            in_file.seek(offset)
+            sample = in_file.read(_SAMPLE_SIZE)
+            raw += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return compressed / raw
+
+
+class ZipSink(object):
+    """Zip archive apks are appended to one by one as they become available.
+
+    Safe to use from many threads, entries are written one at a time. The
+    archive is written under a temporary name and renamed on `close`, an
+    interrupted back up doesn't leave a truncated archive behind.
+
+    With `resume` entries are appended to the partial archive a previous
+    `abort(keep=True)` left behind, if any. `level` is the zlib level of
+    deflated entries, zlib default when None.
+
+    Files are compressed by the thread adding them before the lock is
+    taken, threads adding files at the same time compress in parallel.
+    That relies on ZipFile internals, without them files are compressed
+    by `ZipFile.open` under the lock instead.
+    """
+
+    def __init__(
+        self,
+        dest_path: Union[str, os.PathLike],
+        compression: str = "auto",
+        resume: bool = False,
+        level: Optional[int] = None,
+    ):
+        if compression not in COMPRESSION_CHOICES:
+            raise ValueError(f"Unknown compression {compression}")
+        if level is not None and level not in COMPRESSION_LEVELS:
+            raise ValueError(f"Unknown compression level {level}")
+        self.dest_path = os.fspath(dest_path)
+        self._partial_path = f"{self.dest_path}.partial"
+        self._compression = compression
+        self._level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        # a partial archive without central directory, e.g. the process was
+        # killed, can't be appended to and is started over
+        append = (
+            resume
+            and os.path.isfile(self._partial_path)
+            and is_zipfile(self._partial_path)
+        )
+        self._zip_file = ZipFile(
+            self._partial_path, "a" if append else "w", ZIP_STORED, compresslevel=level
+        )
+        self._raw_writes = _supports_raw_writes(self._zip_file)
+        self._lock = threading.Lock()
+
+    def names(self) -> Set[str]:
+        """Return names of entries already in the archive."""
+        with self._lock:
+            return set(self._zip_file.namelist())
+
+    def _compress_type(self, path: Union[str, os.PathLike]) -> int:
+        if self._compression == "stored":
+            return ZIP_STORED
+        if self._compression == "deflated":
+            return ZIP_DEFLATED
+        return ZIP_DEFLATED if _sample_ratio(path) < _AUTO_RATIO else ZIP_STORED
+
+    def add_file(self, path: Union[str, os.PathLike], arcname: str) -> None:
+        """Append file `path` to the archive as `arcname`."""
+        with metrics.measure("zip") as measurement:
+            measurement.bytes = os.path.getsize(path)
+            info, data = self.compress(path, arcname)
+            with data:
+                self.add_compressed(info, data)
+
+    def compress(
+        self, path: Union[str, os.PathLike], arcname: str
+    ) -> Tuple[ZipInfo, BinaryIO]:
+        """Prepare file `path` for `add_compressed`, safe to call from any thread.
 
+        Return its zip entry and a file object of its data, deflated into a
+        temporary file or the file itself when stored or compressed while
+        added. Close it once added.
+        """
+        info = ZipInfo.from_file(path, arcname)
+        info.compress_type = self._compress_type(path)
+        if not self._raw_writes:
+            return info, open(path, "rb")
+        crc = 0
+        if info.compress_type == ZIP_STORED:
+            with open(path, "rb") as in_file:
+                for chunk in iter(lambda: in_file.read(_CHUNK_SIZE), b""):
+                    crc = zlib.crc32(chunk, crc)
+            info.CRC, info.compress_size = crc, info.file_size
+            return info, open(path, "rb")
 
-def zipify(src_path: Union[str, os.PathLike], dest_path: Union[str, os.PathLike]):
-    """Compress a folder into a zip archive."""
-    with ZipFile(dest_path, "w", ZIP_DEFLATED) as zip_file:
+        data = tempfile.TemporaryFile(dir=os.path.dirname(self._partial_path) or None)
+        try:
+            # raw deflate stream, zip entries have no zlib header
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            with open(path, "rb") as in_file:
+                for chunk in iter(lambda: in_file.read(_CHUNK_SIZE), b""):
+                    crc = zlib.crc32(chunk, crc)
+                    data.write(compressor.compress(chunk))
+            data.write(compressor.flush())
+            info.CRC, info.compress_size = crc, data.tell()
+            data.seek(0)
+        except BaseException:
+            data.close()
+            raise
+        return info, data
 
-        def dir_to_zip(path, out_file: ZipFile = zip_file):
-            abs_src = os.path.abspath(path)
+    def add_compressed(self, info: ZipInfo, data: BinaryIO) -> None:
+        """Append entry `info` with data returned by `compress` to the archive."""
+        with self._lock:
+            if not self._raw_writes:
+                with self._zip_file.open(info, "w") as out_file:
+                    shutil.copyfileobj(data, out_file, _CHUNK_SIZE)
+                return
+            # what `ZipFile.write` does once data is compressed, ZipFile has
+            # no public api to add data compressed beforehand
+            zip_file = self._zip_file
+            zip_file._writecheck(info)  # type: ignore[attr-defined]
+            zip_file._didModify = True  # type: ignore[attr-defined]
+            assert zip_file.fp is not None
+            info.header_offset = zip_file.fp.tell()
+            zip_file.fp.write(info.FileHeader())
+            shutil.copyfileobj(data, zip_file.fp, _CHUNK_SIZE)
+            zip_file.filelist.append(info)
+            zip_file.NameToInfo[info.filename] = info
+            zip_file.start_dir = zip_file.fp.tell()
 
-            if os.path.isdir(abs_src):
-                apks = [
-                    item
-                    for item in os.listdir(abs_src)
-                    if os.path.isfile(item) and item.endswith(".apk")
-                ]
+    def writestr(self, arcname: str, data: Union[str, bytes]) -> None:
+        """Append `data` to the archive as `arcname`."""
+        with self._lock:
+            self._zip_file.writestr(arcname, data, compress_type=ZIP_DEFLATED)
 
-                for apk in apks:
-                    # don't preserver folder structure inside zip file
-                    abs_path = Path(os.path.join(abs_src, apk))
-                    apk_name = abs_path.parts[-1]
-                    out_file.write(os.path.join(path, apk), apk_name)
+    def close(self) -> None:
+        """Finish the archive and move it to its destination."""
+        with self._lock:
+            self._zip_file.close()
+        os.replace(self._partial_path, self.dest_path)
 
-        dir_to_zip(src_path, zip_file)
+    def abort(self, keep: bool = False) -> None:
+        """Discard the archive, with `keep` leave it partial for a resumed run."""
+        with self._lock:
+            self._zip_file.close()
+        if not keep and os.path.exists(self._partial_path):
+            os.remove(self._partial_path)
+
+
+class TarSink(object):
+    """Tar stream apks are written to one by one as they become available.
+
+    Made for pipes, `out_file` is written sequentially and never seeked,
+    apks are left uncompressed for the tools down the pipe. Has the
+    interface of `ZipSink` and is thread safe alike. An aborted stream
+    lacks the end of archive marker and the back up index written last.
+    """
+
+    def __init__(self, out_file: BinaryIO):
+        self._out_file = out_file
+        self._tar_file = tarfile.open(fileobj=out_file, mode="w|")
+        self._names: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def names(self) -> Set[str]:
+        """Return names of entries already written."""
+        with self._lock:
+            return set(self._names)
+
+    def add_file(self, path: Union[str, os.PathLike], arcname: str) -> None:
+        """Write file `path` to the stream as `arcname`."""
+        with metrics.measure("tar") as measurement:
+            measurement.bytes = os.path.getsize(path)
+            with self._lock:
+                self._tar_file.add(path, arcname)
+                self._names.add(arcname)
+
+    def writestr(self, arcname: str, data: Union[str, bytes]) -> None:
+        """Write `data` to the stream as `arcname`."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mode = 0o644
+        with self._lock:
+            self._tar_file.addfile(info, io.BytesIO(data))
+            self._names.add(arcname)
+
+    def close(self) -> None:
+        """Finish the stream, `out_file` is flushed but left open."""
+        with self._lock:
+            self._tar_file.close()
+            self._out_file.flush()
+
+    def abort(self, keep: bool = False) -> None:
+        """Flush what was written and leave the stream unfinished.
+
+        A stream can't be taken back, `keep` is accepted for `ZipSink`
+        compatibility.
+        """
+        with self._lock:
+            # the archive is deliberately left without its end of archive
+            # marker, `TarFile.close` writing it is never called, a reader
+            # finds the stream ending before the back up index. Closing the
+            # stream `TarFile` writes through flushes its buffer, `out_file`
+            # stays open
+            stream = self._tar_file.fileobj
+            assert stream is not None
+            stream.close()
+            self._out_file.flush()
+
+
+def zipify(
+    src_path: Union[str, os.PathLike],
+    dest_path: Union[str, os.PathLike],
+    compression: str = "auto",
+    level: Optional[int] = None,
+    jobs: Optional[int] = None,
+):
+    """Compress a folder into a zip archive.
+
+    Apks and the back up manifest are added, folder structure is not
+    preserved inside the zip file. Up to `jobs` files, by default one per
+    cpu, are compressed at once, entries keep their name order.
+    """
+    abs_src = os.path.abspath(src_path)
+    sink = ZipSink(dest_path, compression, level=level)
+    jobs = jobs or os.cpu_count() or 1
+    items = []
+    if os.path.isdir(abs_src):
+        for name in sorted(os.listdir(abs_src)):
+            abs_path = Path(os.path.join(abs_src, name))
+            if abs_path.is_file() and (name.endswith(".apk") or name == MANIFEST_NAME):
+                items.append((abs_path, abs_path.parts[-1]))
+
+    def compress(item: Tuple[Path, str]) -> Tuple[ZipInfo, BinaryIO]:
+        with metrics.measure("zip") as measurement:
+            measurement.bytes = os.path.getsize(item[0])
+            return sink.compress(*item)
+
+    pending: List[concurrent.futures.Future] = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            try:
+                for item in items:
+                    pending.append(pool.submit(compress, item))
+                    # at most two files per worker wait compressed on disk
+                    if len(pending) >= 2 * jobs:
+                        _add_next(sink, pending)
+                while pending:
+                    _add_next(sink, pending)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+    except BaseException:
+        sink.abort()
+        raise
+    sink.close()
+
+
+def _add_next(sink: ZipSink, pending: List[concurrent.futures.Future]) -> None:
+    """Add the oldest pending compressed file to the archive."""
+    info, data = pending.pop(0).result()
+    with data:
+        sink.add_compressed(info, data)
 
 
 def unzipify(
     file: Union[str, os.PathLike],
     dest_dir: Optional[Union[str, os.PathLike]] = None,
+    jobs: Optional[int] = None,
 ):
     """Decompress zip file into `dest_dir` path.
 
     If `dest_dir` is None use current working directory as `dest_dir`
-    to extract data .
+    to extract data . Entries are split between `jobs` threads, by default
+    one per cpu, each reading the archive on its own.
 
     raises ValueError if `file` arg is not a zip file.
     """
@@ -52,5 +350,22 @@ def unzipify(
 
     os.makedirs(dest_dir)
 
-    with ZipFile(file, "r") as file:
-        file.extractall(dest_dir)
+    with ZipFile(file, "r") as zip_file:
+        infos = zip_file.infolist()
+    groups = balance(infos, jobs or os.cpu_count() or 1, lambda info: info.file_size)
+
+    def extract(group):
+        with ZipFile(file, "r") as zip_file:
+            for info in group:
+                try:
+                    zip_file.extract(info, dest_dir)
+                except FileExistsError:
+                    # another thread created the same parent folder meanwhile
+                    zip_file.extract(info, dest_dir)
+
+    with metrics.measure("unzip") as measurement:
+        workers = max(len(groups), 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(extract, groups):
+                pass
+        measurement.bytes = sum(info.file_size for info in infos)
@@ -0,0 +1,76 @@
+"""Build minimal apks whose `AndroidManifest.xml` is Android binary XML."""
+
+import io
+import struct
+import zipfile
+
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+
+
+def _string_pool(strings, utf8):
+    data = b""
+    offsets = []
+    for string in strings:
+        offsets.append(len(data))
+        if utf8:
+            raw = string.encode("utf-8")
+            data += bytes([len(string), len(raw)]) + raw + b"\0"
+        else:
+            data += struct.pack("<H", len(string)) + string.encode("utf-16-le")
+            data += b"\0\0"
+    data += b"\0" * (-len(data) % 4)
+    strings_start = 28 + 4 * len(strings)
+    header = struct.pack(
+        "<HHIIIIII",
+        0x0001,
+        28,
+        strings_start + len(data),
+        len(strings),
+        0,
+        0x100 if utf8 else 0,
+        strings_start,
+        0,
+    )
+    return header + struct.pack(f"<{len(strings)}I", *offsets) + data
+
+
+def build_manifest(package, version_code, utf8=False, version_attr="versionCode"):
+    """Return binary xml of `<manifest package=... android:versionCode=...>`.
+
+    `version_attr` is the attribute name in the string pool, obfuscated apks
+    strip it, the resource id still identifies it.
+    """
+    major, minor = divmod(version_code, 1 << 32)
+    # strings with a resource id come first, their index is the map index
+    strings = [version_attr, "versionCodeMajor", "package", "android"]
+    strings += [ANDROID_NS, "manifest", package]
+    resource_map = struct.pack("<HHI", 0x0180, 8, 16) + struct.pack(
+        "<II", 0x0101021B, 0x01010576
+    )
+    namespace = struct.pack("<HHIIIII", 0x0100, 16, 24, 1, 0xFFFFFFFF, 3, 4)
+    attributes = [
+        (4, 0, 0xFFFFFFFF, 0x10, minor),
+        (0xFFFFFFFF, 2, 6, 0x03, 6),
+    ]
+    if major:
+        attributes.append((4, 1, 0xFFFFFFFF, 0x10, major))
+    body = struct.pack(
+        "<IIHHHHHH", 0xFFFFFFFF, 5, 20, 20, len(attributes), 0, 0, 0
+    ) + b"".join(
+        struct.pack("<IIIHBBI", ns, name, raw, 8, 0, kind, value)
+        for ns, name, raw, kind, value in attributes
+    )
+    element = struct.pack("<HHIII", 0x0102, 16, 16 + len(body), 1, 0xFFFFFFFF)
+    chunks = _string_pool(strings, utf8) + resource_map + namespace + element + body
+    return struct.pack("<HHI", 0x0003, 8, 8 + len(chunks)) + chunks
+
+
+def build_apk(package, version_code, **kwargs):
+    """Return bytes of an apk holding only the manifest of `package`."""
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(
+            "AndroidManifest.xml", build_manifest(package, version_code, **kwargs)
+        )
+        zip_file.writestr("classes.dex", b"dex\n035\0")
+    return out.getvalue()
@@ -0,0 +1,209 @@
+"""Fake adb-server speaking enough of the host protocol for tests.
+
+The fake device holds files in memory, answers shell commands through a
+user supplied handler and records installed apks.
+"""
+
+import socketserver
+import struct
+import threading
+from typing import Callable, Dict, List, Tuple
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("client closed connection")
+        data += chunk
+    return data
+
+
+def _recv_request(sock):
+    size = int(_recv_exact(sock, 4), 16)
+    return _recv_exact(sock, size).decode()
+
+
+def _okay(sock, message=None):
+    sock.sendall(b"OKAY")
+    if message is not None:
+        sock.sendall(b"%04x" % len(message) + message.encode())
+
+
+def _fail(sock, message):
+    sock.sendall(b"FAIL" + b"%04x" % len(message) + message.encode())
+
+
+class FakeDevice:
+    """In memory android device."""
+
+    def __init__(self, serial="emulator-5554"):
+        self.serial = serial
+        self.files: Dict[str, bytes] = {}
+        self.installed: List[Tuple[str, bytes]] = []
+        self.shell: Callable[[str], Tuple[str, int]] = lambda cmd: ("", 0)
+        # package manager reply to an install of the received apk
+        self.install_output: Callable[[str, bytes], str] = lambda cmd, data: (
+            "Success\n"
+        )
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        sock = self.request
+        try:
+            request = _recv_request(sock)
+            server.requests.append(request)
+            if request == "host:version":
+                _okay(sock, "0029")
+            elif request == "host:devices":
+                _okay(sock, "".join(f"{serial}\tdevice\n" for serial in server.devices))
+            elif request == "host:kill":
+                _okay(sock)
+            elif request == "host:track-devices":
+                _okay(sock)
+                self.track_devices()
+            elif request.endswith(":get-state"):
+                device = server.find_device(request)
+                if device is None:
+                    _fail(sock, "device not found")
+                else:
+                    _okay(sock, "device")
+            elif request.startswith("host:transport"):
+                device = server.find_device(request)
+                if device is None:
+                    _fail(sock, "device not found")
+                    return
+                _okay(sock)
+                self.device_service(device, _recv_request(sock))
+            else:
+                _fail(sock, f"unknown request {request}")
+        except ConnectionError:
+            pass
+
+    def track_devices(self):
+        server = self.server
+        while True:
+            with server.changed:
+                table = "".join(f"{serial}\tdevice\n" for serial in server.devices)
+                version = server.version
+            self.request.sendall(b"%04x" % len(table) + table.encode())
+            with server.changed:
+                server.changed.wait_for(
+                    lambda: server.version != version or server.closed
+                )
+                if server.closed:
+                    return
+
+    def device_service(self, device, service):
+        sock = self.request
+        self.server.requests.append(service)
+        if service.startswith("shell,v2,raw:"):
+            output, return_code = device.shell(service[len("shell,v2,raw:") :])
+            _okay(sock)
+            data = output.encode()
+            sock.sendall(struct.pack("<BI", 1, len(data)) + data)
+            sock.sendall(struct.pack("<BIB", 3, 1, return_code))
+        elif service.startswith("exec:"):
+            _okay(sock)
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            device.installed.append((service[len("exec:") :], data))
+            sock.sendall(device.install_output(service[len("exec:") :], data).encode())
+        elif service == "sync:":
+            _okay(sock)
+            self.sync(device)
+        else:
+            _fail(sock, f"unknown service {service}")
+
+    def sync(self, device):
+        sock = self.request
+        while True:
+            packet_id, size = struct.unpack("<4sI", _recv_exact(sock, 8))
+            if packet_id == b"QUIT":
+                return
+            path = _recv_exact(sock, size).decode()
+            self.server.requests.append(f"sync:{packet_id.decode()}:{path}")
+            if packet_id == b"STAT":
+                data = device.files.get(path)
+                mode = 0o100644 if data is not None else 0
+                size = len(data) if data is not None else 0
+                sock.sendall(b"STAT" + struct.pack("<III", mode, size, 0))
+            elif packet_id == b"RECV":
+                if path not in device.files:
+                    message = b"No such file or directory"
+                    sock.sendall(b"FAIL" + struct.pack("<I", len(message)) + message)
+                    continue
+                data = device.files[path]
+                for offset in range(0, len(data), 65536):
+                    chunk = data[offset : offset + 65536]
+                    sock.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                sock.sendall(b"DONE" + struct.pack("<I", 0))
+            elif packet_id == b"SEND":
+                remote = path.rsplit(",", 1)[0]
+                data = b""
+                while True:
+                    packet_id, size = struct.unpack("<4sI", _recv_exact(sock, 8))
+                    if packet_id == b"DONE":
+                        break
+                    data += _recv_exact(sock, size)
+                device.files[remote] = data
+                sock.sendall(b"OKAY" + struct.pack("<I", 0))
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """Fake adb-server listening on a random local port."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, devices=None):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.devices = {device.serial: device for device in devices or [FakeDevice()]}
+        self.requests: List[str] = []
+        # bumped on each attach or detach, wakes track-devices clients
+        self.changed = threading.Condition()
+        self.version = 0
+        self.closed = False
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def find_device(self, request):
+        for serial, device in self.devices.items():
+            if serial in request:
+                return device
+        if "transport-any" in request or request.startswith("host:"):
+            return next(iter(self.devices.values()), None)
+        return None
+
+    def attach(self, device):
+        with self.changed:
+            self.devices[device.serial] = device
+            self.version += 1
+            self.changed.notify_all()
+
+    def detach(self, serial):
+        with self.changed:
+            del self.devices[serial]
+            self.version += 1
+            self.changed.notify_all()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        self.shutdown()
+        self.server_close()
@@ -1,12 +1,15 @@
 """Test module for mass apk."""
-import  pytest
+
+import os
+
+import pytest
 from click.testing import CliRunner
 from mass_apk import __version__
 from mass_apk import cli
 
 
 def test_version():
-    assert __version__ == '0.3.1'
+    assert __version__ == "0.3.1"
 
 
 def test_start_server():
@@ -35,6 +38,27 @@ def test_exec_command():
     output = Adb().exec_command("help")
 
 
+def test_process_paths_with_spaces(tmp_path, monkeypatch):
+    from mass_apk.adb import Adb
+
+    # adb gets paths as separate arguments, the shell never splits them
+    fake = tmp_path / "fake adb"
+    fake.write_text(
+        '#!/bin/sh\ncase "$1" in\n'
+        '  pull) cp "$2" "$3" ;;\n'
+        '  install) [ -f "$4" ] && echo Success ;;\n'
+        "esac\n"
+    )
+    fake.chmod(0o755)
+    monkeypatch.setenv("MASS_APK_ADB", str(fake))
+    remote = tmp_path / "data app" / "base.apk"
+    remote.parent.mkdir()
+    remote.write_bytes(b"apk")
+    adb = Adb(shell_sessions=0)
+    assert adb.pull(str(remote), tmp_path / "my backup.apk") == 3
+    adb.push(tmp_path / "my backup.apk")
+
+
 @pytest.fixture(scope="module")
 def runner():
     return CliRunner()
@@ -50,3 +74,1380 @@ def test_restore_command_no_params(runner):
 
     response = runner.invoke(cli.restore, input="")
     assert response.exit_code == 2
+
+
+def test_list_device_paths(monkeypatch):
+    from mass_apk.adb import Adb
+
+    output = [
+        "package:/data/app/~~Ab==/com.skype.raider-2/base.apk=com.skype.raider",
+        "package:/data/app/~~Ab==/com.skype.raider-2/split_config.en.apk=com.skype.raider",
+        "package:/data/app/com.dog-1.apk=com.dog",
+        "garbage",
+    ]
+    monkeypatch.setattr(Adb, "iter_shell", lambda self, cmd: iter(output))
+
+    assert list(Adb().list_device_paths("3")) == [
+        ("com.skype.raider", "/data/app/~~Ab==/com.skype.raider-2/base.apk"),
+        ("com.skype.raider", "/data/app/~~Ab==/com.skype.raider-2/split_config.en.apk"),
+        ("com.dog", "/data/app/com.dog-1.apk"),
+    ]
+
+
+def test_map_apk_paths_batched(monkeypatch):
+    from mass_apk import adb, apk
+
+    output = [
+        ("com.a", "/data/app/com.a-1/split_config.en.apk"),
+        ("com.a", "/data/app/com.a-1/base.apk"),
+        ("com.b", "/data/app/com.b-1/base.apk"),
+    ]
+    monkeypatch.setattr(adb, "list_device_paths", lambda flag: iter(output))
+
+    assert apk.map_apk_paths(["com.a"], "3") == [
+        apk.ApkAbsPath(
+            "com.a",
+            "/data/app/com.a-1/base.apk",
+            ("/data/app/com.a-1/split_config.en.apk",),
+        )
+    ]
+
+
+def test_shell_session():
+    from mass_apk.shell import ShellError, ShellPool, ShellSession
+
+    pool = ShellPool(lambda: ShellSession(["sh"]), size=1)
+    with pool.session() as shell:
+        assert shell.run("echo one; echo two") == (0, "one\ntwo")
+        assert shell.run("printf partial") == (0, "partial")
+        assert shell.run("echo failed; exit 3") == (3, "failed")
+        assert shell.run("true") == (0, "")
+
+    # session is reused after being released
+    with pool.session() as again:
+        assert again is shell
+    pool.close()
+    assert not shell.alive
+
+    with pytest.raises(ShellError):
+        ShellSession(["sh", "-c", "exit 1"])
+
+
+def test_socket_transport(tmp_path, monkeypatch):
+    from mass_apk.adb import Adb
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    device = FakeDevice()
+    device.files["/data/app/com.a-1/base.apk"] = b"apk" * 100000
+    device.shell = lambda cmd: ("package:com.a\npackage:com.b\n", 0)
+
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+
+        assert adb.state is Adb.ConnectionState.CONNECTED
+        assert adb.list_device("3") == ["com.a", "com.b"]
+
+        with open(tmp_path / "base.apk", "wb") as out_file:
+            written = adb.pull_into("/data/app/com.a-1/base.apk", out_file)
+        assert written == 300000
+        assert (tmp_path / "base.apk").read_bytes() == device.files[
+            "/data/app/com.a-1/base.apk"
+        ]
+
+        # sync connection is pooled and reused for the second pull
+        with open(tmp_path / "again.apk", "wb") as out_file:
+            adb.pull_into("/data/app/com.a-1/base.apk", out_file)
+        assert server.requests.count("sync:") == 1
+
+        adb.push(str(tmp_path / "base.apk"), ignore_errors=False)
+        assert device.installed == [
+            (
+                "cmd package install -d -r -S 300000",
+                device.files["/data/app/com.a-1/base.apk"],
+            )
+        ]
+        adb.close()
+
+
+def test_pull_apks(tmp_path):
+    import threading
+    from mass_apk.apk import ApkAbsPath
+    from mass_apk.transfer import pull_apks
+
+    class FakeServer:
+        serial = None
+        device_label = "default"
+        threads = set()
+
+        def pull(self, apk_path, dest):
+            self.threads.add(threading.get_ident())
+            with open(dest, "wb") as out_file:
+                out_file.write(apk_path.encode())
+            return len(apk_path)
+
+    items = [
+        ApkAbsPath(f"com.pkg{i}", f"/data/app/com.pkg{i}/base.apk") for i in range(8)
+    ]
+    progress = pull_apks(FakeServer(), items, tmp_path, jobs=4)
+
+    assert progress.files == 8
+    assert progress.bytes == sum(len(item.fullpath) for item in items)
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{item.name}.apk" for item in items)
+    assert not os.path.exists("base.apk")
+
+
+def test_run_on_devices(monkeypatch):
+    from mass_apk.adb import Adb, AdbError
+    from mass_apk.fleet import run_on_devices
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    devices = [FakeDevice(f"serial-{index}") for index in (1, 2, 3)]
+    with FakeAdbServer(devices) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        serials = adb.devices()
+        assert serials == ["serial-1", "serial-2", "serial-3"]
+
+        def job(device):
+            if device.serial == "serial-1":
+                raise AdbError("cable unplugged")
+            if device.serial == "serial-3":
+                # an unexpected error stays with its device
+                raise ValueError("corrupt apk")
+            return device.serial
+
+        results = run_on_devices(adb, serials, job)
+
+    assert [(r.serial, r.summary, r.error) for r in results] == [
+        ("serial-1", None, "cable unplugged"),
+        ("serial-2", "serial-2", None),
+        ("serial-3", None, "ValueError('corrupt apk')"),
+    ]
+
+
+def test_parse_dumpsys_packages():
+    from mass_apk.manifest import PackageInfo, parse_dumpsys_packages
+
+    output = """Packages:
+  Package [com.skype.raider] (5a2bc31):
+    userId=10123
+    codePath=/data/app/com.skype.raider-2
+    versionCode=1234 minSdk=21 targetSdk=30
+    versionName=8.1
+    lastUpdateTime=2021-02-13 10:21:07
+  Package [com.dog] (8d1a):
+    codePath=/data/app/com.dog-1
+    versionCode=7 minSdk=21 targetSdk=30
+    lastUpdateTime=2020-01-01 00:00:00
+
+Hidden system packages:
+  Package [com.android.chrome] (11):
+    versionCode=1 minSdk=21 targetSdk=30
+"""
+    assert list(parse_dumpsys_packages(output.splitlines())) == [
+        PackageInfo(
+            "com.skype.raider",
+            1234,
+            "2021-02-13 10:21:07",
+            "/data/app/com.skype.raider-2",
+        ),
+        PackageInfo("com.dog", 7, "2020-01-01 00:00:00", "/data/app/com.dog-1"),
+    ]
+
+
+def test_manifest_round_trip(tmp_path):
+    from mass_apk.manifest import Manifest, ManifestEntry, PackageInfo
+
+    manifest = Manifest(
+        [ManifestEntry("com.dog", 7, "2020-01-01", 3, "ab", "com.dog.apk")]
+    )
+    manifest.save(tmp_path)
+    loaded = Manifest.load(tmp_path)
+
+    assert list(loaded) == list(manifest)
+    assert loaded.is_current(PackageInfo("com.dog", 7, "2020-01-01", None))
+    assert not loaded.is_current(PackageInfo("com.dog", 8, "2020-02-01", None))
+    assert not loaded.is_current(PackageInfo("com.cat", 7, "2020-01-01", None))
+
+
+def test_apk_store(tmp_path):
+    from mass_apk.manifest import Manifest, ManifestEntry, sha256_file
+    from mass_apk.store import ApkStore
+
+    store = ApkStore(tmp_path / "store").init()
+    for name in ("phone-1", "phone-2"):
+        backup_dir = tmp_path / name
+        backup_dir.mkdir()
+        (backup_dir / "com.dog.apk").write_bytes(b"same apk on every phone")
+        (backup_dir / f"com.{name}.apk").write_bytes(name.encode())
+        Manifest(
+            ManifestEntry(file[:-4], 1, "t", 0, sha256_file(backup_dir / file), file)
+            for file in os.listdir(backup_dir)
+        ).save(backup_dir)
+        store.ingest(backup_dir, name)
+        assert (backup_dir / "com.dog.apk").read_bytes() == b"same apk on every phone"
+
+    # the shared apk is stored once
+    assert len(list(store.iter_objects())) == 3
+    assert store.has(sha256_file(tmp_path / "phone-1" / "com.dog.apk"))
+
+    store.materialize("phone-2", tmp_path / "copy")
+    assert (tmp_path / "copy" / "com.phone-2.apk").read_bytes() == b"phone-2"
+
+    os.remove(os.path.join(store.backups_dir, "phone-1.json"))
+    assert store.gc() == (1, len(b"phone-1"))
+    assert sorted(store.backups()) == ["phone-2"]
+
+
+def test_zip_sink_compression(tmp_path):
+    import zipfile
+    from mass_apk.ziptools import ZipSink
+
+    (tmp_path / "text.apk").write_bytes(b"a" * 200000)
+    (tmp_path / "random.apk").write_bytes(os.urandom(200000))
+
+    sink = ZipSink(tmp_path / "backup.zip", "auto")
+    sink.add_file(tmp_path / "text.apk", "text.apk")
+    sink.add_file(tmp_path / "random.apk", "random.apk")
+    assert not (tmp_path / "backup.zip").exists()
+    sink.close()
+
+    with zipfile.ZipFile(tmp_path / "backup.zip") as zip_file:
+        assert zip_file.getinfo("text.apk").compress_type == zipfile.ZIP_DEFLATED
+        assert zip_file.getinfo("random.apk").compress_type == zipfile.ZIP_STORED
+        assert zip_file.read("random.apk") == (tmp_path / "random.apk").read_bytes()
+
+
+def test_zip_sink_without_raw_writes(tmp_path, monkeypatch):
+    import io
+    import zipfile
+    from mass_apk import ziptools
+
+    # pinned, a python release dropping them falls back to ZipFile.open
+    assert ziptools._supports_raw_writes(zipfile.ZipFile(io.BytesIO(), "w"))
+
+    monkeypatch.setattr(ziptools, "_RAW_WRITE_ATTRIBUTES", ("_gone",))
+    (tmp_path / "text.apk").write_bytes(b"a" * 200000)
+    (tmp_path / "random.apk").write_bytes(os.urandom(200000))
+    sink = ziptools.ZipSink(tmp_path / "backup.zip", "auto")
+    sink.add_file(tmp_path / "text.apk", "text.apk")
+    sink.add_file(tmp_path / "random.apk", "random.apk")
+    sink.close()
+
+    with zipfile.ZipFile(tmp_path / "backup.zip") as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.getinfo("text.apk").compress_type == zipfile.ZIP_DEFLATED
+        assert zip_file.getinfo("text.apk").compress_size < 10000
+        assert zip_file.read("random.apk") == (tmp_path / "random.apk").read_bytes()
+
+
+def test_restore_zip_without_extracting(tmp_path, monkeypatch):
+    import zipfile
+    from mass_apk.adb import Adb
+    from mass_apk.sources import install, open_sources
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    with zipfile.ZipFile(
+        tmp_path / "backup.zip", "w", zipfile.ZIP_DEFLATED
+    ) as zip_file:
+        zip_file.writestr("com.a.apk", b"a" * 100000)
+        zip_file.writestr("manifest.json", "{}")
+
+    device = FakeDevice()
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        with open_sources(tmp_path / "backup.zip") as apks:
+            assert [(apk.name, apk.size, apk.path) for apk in apks] == [
+                ("com.a.apk", 100000, None)
+            ]
+            install(adb, apks[0])
+
+    assert device.installed == [("cmd package install -d -r -S 100000", b"a" * 100000)]
+    assert os.listdir(tmp_path) == ["backup.zip"]
+
+
+def test_selective_restore(tmp_path, caplog):
+    import zipfile
+    import pytest
+    from mass_apk.exceptions import MassApkError
+    from mass_apk.manifest import Manifest, ManifestEntry
+    from mass_apk.sources import PackageFilter, open_sources
+
+    packages = ["com.google.maps", "com.google.mail", "org.fdroid.app", "org.x"]
+    manifest = Manifest(
+        ManifestEntry(package, 1, None, 3, "", f"{package}.apk") for package in packages
+    )
+    with zipfile.ZipFile(tmp_path / "backup.zip", "w") as zip_file:
+        # members of packages left out aren't looked up, org.x is missing
+        for package in packages[:3]:
+            zip_file.writestr(f"{package}.apk", b"apk")
+        # not indexed, e.g. left behind by an interrupted back up
+        zip_file.writestr("com.stale.apk", b"apk")
+        zip_file.writestr("manifest.json", manifest.to_json())
+
+    select = PackageFilter(["com.google.*", "re:^org\\.fd"], ["*.mail"])
+    with open_sources(tmp_path / "backup.zip", select=select) as apks:
+        assert [apk.name for apk in apks] == [
+            "com.google.maps.apk",
+            "org.fdroid.app.apk",
+        ]
+        assert apks[0].open().read() == b"apk"
+    with pytest.raises(MassApkError):
+        with open_sources(tmp_path / "backup.zip"):
+            pass
+
+    manifest.save(tmp_path)
+    (tmp_path / "org.x.apk").write_bytes(b"apk")
+    (tmp_path / "com.stale.apk").write_bytes(b"apk")
+    select = PackageFilter(exclude=["com.*", "org.fdroid.*"])
+    with open_sources(tmp_path, select=select) as apks:
+        assert [apk.name for apk in apks] == ["org.x.apk"]
+    assert "manifest doesn't list com.stale.apk" in caplog.text
+    # indexed but missing
+    with pytest.raises(MassApkError):
+        with open_sources(tmp_path, select=PackageFilter(exclude=["com.*"])):
+            pass
+
+    with pytest.raises(MassApkError):
+        PackageFilter(["re:("])
+
+
+def test_skip_up_to_date_apks(tmp_path, monkeypatch):
+    import pytest
+    from mass_apk.adb import Adb
+    from mass_apk.axml import ApkInfo, AxmlError, parse_manifest
+    from mass_apk.commands import restore_device
+    from mass_apk.sources import ApkSource, folder_sources
+    from mass_apk.versions import apk_info
+    from tests.apk_builder import build_apk, build_manifest
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    assert parse_manifest(build_manifest("com.a", 7)) == ApkInfo("com.a", 7)
+    manifest = build_manifest("com.a", 7 + (2 << 32), utf8=True, version_attr="")
+    assert parse_manifest(manifest) == ApkInfo("com.a", 7 + (2 << 32))
+    with pytest.raises(AxmlError):
+        parse_manifest(build_manifest("com.a", 7)[:100])
+
+    (tmp_path / "com.a.apk").write_bytes(build_apk("com.a", 5))
+    (tmp_path / "com.b.apk").write_bytes(build_apk("com.b", 3))
+    (tmp_path / "com.c.apk").write_bytes(build_apk("com.c", 1))
+    (tmp_path / "com.d.apk").write_bytes(b"not an apk")
+    listing = "".join(
+        f"package:{package} versionCode:{version}\n"
+        for package, version in [("com.a", 5), ("com.b", 2), ("com.d", 9)]
+    )
+
+    def shell(cmd):
+        if cmd == "pm list packages --show-versioncode":
+            return listing, 0
+        return "Success\n", 0
+
+    device = FakeDevice()
+    device.shell = shell
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        summary = restore_device(adb, folder_sources(tmp_path))
+        assert summary.endswith(", 1 up to date")
+        # com.a is current, com.b is older, com.c missing, com.d unreadable
+        assert len(device.installed) == 3
+        restore_device(adb, folder_sources(tmp_path), force=True)
+        assert len(device.installed) == 7
+
+    # an apk that can't be read is installed, its version is unknown
+    def unreadable():
+        raise OSError("member vanished")
+
+    assert apk_info(ApkSource("com.e.apk", 1, None, unreadable, "e")) is None
+
+
+def test_session_installer(tmp_path, monkeypatch):
+    import itertools
+    from mass_apk.adb import Adb
+    from mass_apk.installer import InstallPackage, SessionInstaller, install_packages
+    from mass_apk.metrics import metrics
+    from mass_apk.sources import folder_sources
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    metrics.reset()
+    for name in ("com.a", "com.b", "com.c"):
+        (tmp_path / f"{name}.apk").write_bytes(name.encode() * 10)
+
+    sessions = itertools.count(100)
+    commands = []
+
+    def shell(cmd):
+        commands.append(cmd)
+        if "install-create" in cmd:
+            return f"Success: created install session [{next(sessions)}]\n", 0
+        if "install-commit 103" in cmd:
+            return "Failure [INSTALL_FAILED_VERIFICATION_FAILURE]\n", 0
+        return "Success\n", 0
+
+    device = FakeDevice()
+    device.shell = shell
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        installed = []
+        results = install_packages(
+            adb,
+            folder_sources(tmp_path),
+            batch_size=2,
+            on_installed=lambda package: installed.append(package.name),
+        )
+
+    assert [result.error for result in results] == [None, None, None]
+    assert sorted(installed) == ["com.a.apk", "com.b.apk", "com.c.apk"]
+    # first batch goes through a multi-package session
+    assert "cmd package install-add-session 102 100 101" in commands
+    assert "cmd package install-commit 102" in commands
+    # the commit of the second batch fails, its package is installed on its own
+    assert [cmd for cmd, _ in device.installed] == [
+        "cmd package install-write -S 50 100 0.apk -",
+        "cmd package install-write -S 50 101 0.apk -",
+        "cmd package install-write -S 50 103 0.apk -",
+        "cmd package install -d -r -S 50",
+    ]
+    assert device.installed[-1][1] == b"com.c" * 10
+    # only the package installed again after the failed commit is a retry
+    assert metrics.snapshot()[("install", adb.device_label)]["retries"] == 1
+
+    # a base apk and its split apks are installed together in one session
+    base, split = folder_sources(tmp_path)[:2]
+    del commands[:], device.installed[:]
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        results = install_packages(adb, [base._replace(splits=(split,))], 1)
+    assert [tuple(result) for result in results] == [("com.a.apk", None)]
+    assert [cmd for cmd, _ in device.installed] == [
+        "cmd package install-write -S 50 104 0.apk -",
+        "cmd package install-write -S 50 104 1.apk -",
+    ]
+    assert "cmd package install-commit 104" in commands
+    assert metrics.snapshot()[("install", adb.device_label)]["retries"] == 1
+
+    # packages of a batch failing to stage are installed on their own, they
+    # aren't retries of an install
+    install_output = device.install_output
+    device.install_output = lambda cmd, data: (
+        "Failure\n" if "install-write" in cmd else install_output(cmd, data)
+    )
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        results = install_packages(adb, folder_sources(tmp_path), batch_size=2)
+    assert [result.error for result in results] == [None, None, None]
+    assert metrics.snapshot()[("install", adb.device_label)]["retries"] == 1
+    device.install_output = install_output
+
+    # an error of a commit is raised instead of leaving staging blocked
+    def broken(package):
+        raise ValueError(package.name)
+
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        packages = [InstallPackage(apk.name, [apk]) for apk in folder_sources(tmp_path)]
+        with pytest.raises(ValueError):
+            SessionInstaller(adb, 1, broken).install(packages * 3)
+
+
+def test_journal_replay(tmp_path):
+    from mass_apk.journal import Journal
+
+    with Journal(tmp_path / "journal") as journal:
+        journal.start("com.a", "com.b")
+        journal.done("com.a", size=10)
+        journal.fail("com.b", "broken pipe")
+    # a crash interrupted the last write
+    with open(tmp_path / "journal", "a") as out_file:
+        out_file.write('{"item": "com.c", "sta')
+
+    journal = Journal(tmp_path / "journal", resume=True)
+    assert journal.done_items() == {"com.a"}
+    assert journal.record("com.a")["size"] == 10
+    assert journal.state("com.b") == "failed"
+    assert journal.record("com.b") is None
+    journal.close(remove=True)
+    assert not os.path.exists(tmp_path / "journal")
+
+
+def test_resume_backup(tmp_path, monkeypatch):
+    import pathlib
+    import zipfile
+    from mass_apk.commands import backup_device
+    from mass_apk.adb import Adb, AdbError
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    packages = ("com.a", "com.b", "com.c")
+    device = FakeDevice()
+    for name in packages[:2]:
+        device.files[f"/data/app/{name}/base.apk"] = name.encode() * 100
+
+    def shell(cmd):
+        if cmd.startswith("pm list packages -f"):
+            return (
+                "".join(
+                    f"package:/data/app/{name}/base.apk={name}\n" for name in packages
+                ),
+                0,
+            )
+        if cmd.startswith("pm list packages"):
+            return "".join(f"package:{name}\n" for name in packages), 0
+        return "", 1
+
+    device.shell = shell
+    path = pathlib.Path(tmp_path / "backup")
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        with pytest.raises(AdbError):
+            backup_device(adb, path, "3", True, 1)
+        assert os.path.exists(tmp_path / "backup.zip.partial")
+
+        device.files["/data/app/com.c/base.apk"] = b"c" * 100
+        del server.requests[:]
+        backup_device(adb, path, "3", True, 1, resume=True)
+
+    pulled = [request for request in server.requests if request.startswith("sync:RECV")]
+    assert pulled == ["sync:RECV:/data/app/com.c/base.apk"]
+    with zipfile.ZipFile(tmp_path / "backup.zip") as zip_file:
+        assert sorted(zip_file.namelist()) == [
+            "com.a.apk",
+            "com.b.apk",
+            "com.c.apk",
+            "manifest.json",
+        ]
+    assert os.listdir(tmp_path) == ["backup.zip"]
+
+
+def test_in_place_backup(tmp_path, monkeypatch):
+    import pathlib
+    from mass_apk.adb import Adb
+    from mass_apk.commands import IncompleteBackupError, backup_device
+    from mass_apk.manifest import Manifest
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    packages = ["com.a", "com.b", "com.c"]
+    device = FakeDevice()
+    for name in packages:
+        device.files[f"/data/app/{name}/base.apk"] = name.encode() * 100
+
+    def shell(cmd):
+        if cmd.startswith("pm list packages -f"):
+            return (
+                "".join(
+                    f"package:/data/app/{name}/base.apk={name}\n" for name in packages
+                ),
+                0,
+            )
+        if cmd.startswith("pm list packages"):
+            return "".join(f"package:{name}\n" for name in packages), 0
+        return "", 1
+
+    device.shell = shell
+    path = pathlib.Path(tmp_path / "backup")
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        backup_device(adb, path, "3", False, 1)
+        # an older back up sharing the apks through hard links
+        os.mkdir(tmp_path / "older")
+        for name in packages:
+            os.link(path / f"{name}.apk", tmp_path / "older" / f"{name}.apk")
+
+        device.files["/data/app/com.a/base.apk"] = b"A" * 100
+        del device.files["/data/app/com.b/base.apk"]
+        packages.remove("com.c")
+        with pytest.raises(IncompleteBackupError, match="1 failed: com.b"):
+            backup_device(adb, path, "3", False, 1, path, keep_going=True)
+
+    assert (path / "com.a.apk").read_bytes() == b"A" * 100
+    # the older back up isn't written through its links
+    assert (tmp_path / "older" / "com.a.apk").read_bytes() == b"com.a" * 100
+    # a failed pull keeps the apk pulled before
+    assert (path / "com.b.apk").read_bytes() == b"com.b" * 100
+    assert not os.path.exists(path / "com.c.apk")
+    assert sorted(os.listdir(path)) == ["com.a.apk", "com.b.apk", "manifest.json"]
+    assert [entry.package for entry in Manifest.load(path)] == ["com.a"]
+
+
+def test_benchmarks_simulated_device(tmp_path):
+    from benchmarks.bench import compare, run_benchmarks
+    from benchmarks.simulator import DeviceConfig
+
+    config = DeviceConfig(packages=3, apk_size=4096)
+    report = run_benchmarks(
+        config, ["backup", "restore"], jobs=2, workdir=str(tmp_path)
+    )
+
+    results = {result["scenario"]: result for result in report["results"]}
+    assert [result["error"] for result in results.values()] == [None, None]
+    assert results["backup"]["packages"] == 3
+    assert results["restore"]["packages"] == 3
+    assert results["restore"]["process_spawns"] > 0
+    assert sorted(os.listdir(tmp_path / "backup")) == [
+        "com.bench.app0000.apk",
+        "com.bench.app0001.apk",
+        "com.bench.app0002.apk",
+        "manifest.json",
+    ]
+    assert compare(report, report) == []
+
+
+def test_metrics_report(tmp_path):
+    import json
+    from mass_apk.metrics import Metrics
+
+    metrics = Metrics()
+    for size in (10, 20):
+        with metrics.measure("pull", "emulator-5554") as measurement:
+            measurement.bytes = size
+    with pytest.raises(ValueError):
+        with metrics.measure("pull", "emulator-5554"):
+            raise ValueError("broken pipe")
+    metrics.retry("pull", "emulator-5554")
+    metrics.observe("zip", None, 0.2, 30)
+
+    metrics.write_json(tmp_path / "report.json", command="backup")
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report["command"] == "backup"
+    pull, zip_ = report["phases"]
+    assert (pull["phase"], pull["device"]) == ("pull", "emulator-5554")
+    assert (pull["count"], pull["errors"], pull["retries"], pull["bytes"]) == (
+        3,
+        1,
+        1,
+        30,
+    )
+    assert pull["buckets"]["+Inf"] == 3
+    assert (zip_["device"], zip_["latency"]["p50"], zip_["buckets"]["0.1"]) == (
+        "local",
+        0.2,
+        0,
+    )
+
+    metrics.write_prometheus(tmp_path / "mass_apk.prom")
+    lines = (tmp_path / "mass_apk.prom").read_text().splitlines()
+    assert (
+        'mass_apk_operation_seconds_bucket{phase="zip",device="local",le="0.25"} 1'
+        in lines
+    )
+    assert (
+        'mass_apk_operation_errors_total{phase="pull",device="emulator-5554"} 1'
+        in lines
+    )
+    assert 'mass_apk_operation_bytes_total{phase="zip",device="local"} 30' in lines
+
+
+def test_lazy_import():
+    import subprocess
+    import sys
+
+    # a fresh interpreter, modules imported by other tests don't count
+    code = "import sys, mass_apk\n" "assert 'mass_apk.adb' not in sys.modules\n"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+    code = (
+        "import sys, mass_apk.cli, mass_apk\n"
+        "loaded = {'platform', 'socket', 'zipfile', 'mass_apk.commands'}\n"
+        "assert not loaded & set(sys.modules), loaded & set(sys.modules)\n"
+        "assert mass_apk.adb._path is None\n"
+        "assert len(mass_apk.logger.handlers) == 1\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_device_watcher_serve(tmp_path, monkeypatch):
+    import queue
+    import threading
+    from mass_apk.adb import Adb
+    from mass_apk.commands import serve_restore
+    from mass_apk.sources import open_sources
+    from mass_apk.watcher import ATTACHED, DETACHED, READY, DeviceWatcher
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    backup = tmp_path / "backup"
+    backup.mkdir()
+    (backup / "com.a.apk").write_bytes(b"a" * 1000)
+
+    first, second = FakeDevice("phone-1"), FakeDevice("phone-2")
+    with FakeAdbServer([first]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+
+        with DeviceWatcher(adb) as watcher:
+            assert watcher.events.get(timeout=5) == (ATTACHED, "phone-1", "device")
+            assert watcher.events.get(timeout=5) == (READY, "phone-1", "device")
+            server.attach(second)
+            assert watcher.events.get(timeout=5) == (ATTACHED, "phone-2", "device")
+            assert watcher.events.get(timeout=5) == (READY, "phone-2", "device")
+            server.detach("phone-1")
+            assert watcher.events.get(timeout=5) == (DETACHED, "phone-1", None)
+            assert watcher.devices == {"phone-2": "device"}
+        with pytest.raises(queue.Empty):
+            watcher.events.get(timeout=0.2)
+
+        # attached devices are restored, then a device plugged in later
+        stop = threading.Event()
+        results = []
+
+        def on_result(result):
+            results.append(result)
+            if len(results) == 1:
+                server.attach(FakeDevice("phone-3"))
+            else:
+                stop.set()
+
+        with open_sources(backup) as apks:
+            done = serve_restore(adb, backup, apks, 1, stop=stop, on_result=on_result)
+
+    assert sorted(result.serial for result in done) == ["phone-2", "phone-3"]
+    assert all(result.error is None for result in done)
+    assert second.installed == [("cmd package install -d -r -S 1000", b"a" * 1000)]
+
+
+def test_daemon(tmp_path, monkeypatch):
+    import threading
+    import time
+    from mass_apk.adb import Adb
+    from mass_apk.cli import cli
+    from mass_apk.daemon import Daemon, DaemonClient, DaemonError, running_daemon
+    from mass_apk.daemon import _JOB_RUNNERS
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    backup = tmp_path / "backup"
+    backup.mkdir()
+    (backup / "com.a.apk").write_bytes(b"a" * 1000)
+    address = str(tmp_path / "daemon.sock")
+
+    first, second = FakeDevice("phone-1"), FakeDevice("phone-2")
+    with FakeAdbServer([first, second]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        daemon = Daemon(Adb(backend="socket"), address)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            client = running_daemon(address)
+            assert client is not None
+            with pytest.raises(DaemonError):
+                Daemon(Adb(backend="socket"), address)
+            for _ in range(50):
+                if len(client.devices()) == 2:
+                    break
+                time.sleep(0.1)
+
+            job = client.submit("restore", {"path": str(backup)}, "phone-1")
+            assert job["state"] in ("queued", "running", "done")
+            job = client.wait(job["id"])
+            assert (job["state"], job["error"]) == ("done", None)
+            assert first.installed == [
+                ("cmd package install -d -r -S 1000", b"a" * 1000)
+            ]
+
+            # two devices are ready, the daemon can't pick one
+            with pytest.raises(DaemonError):
+                client.submit("restore", {"path": str(backup)})
+            with pytest.raises(DaemonError):
+                client.submit("restore", {"path": str(backup), "batch_size": "16"})
+            job = client.submit("restore", {"path": "missing"}, "phone-2")
+            assert client.wait(job["id"])["state"] == "failed"
+
+            # an unexpected error fails the job, the device keeps its worker
+            restore = _JOB_RUNNERS["restore"]
+            _JOB_RUNNERS["restore"] = lambda device, args: 1 / 0
+            try:
+                job = client.submit("restore", {"path": str(backup)}, "phone-2")
+                job = client.wait(job["id"])
+            finally:
+                _JOB_RUNNERS["restore"] = restore
+            assert job["state"] == "failed"
+            assert job["error"].startswith("ZeroDivisionError")
+
+            # the cli hands its work to the daemon, adb-server is left running
+            result = CliRunner().invoke(
+                cli,
+                ["restore", str(backup), "--all-devices", "-b", "1"],
+                env={"MASS_APK_DAEMON": address},
+            )
+            assert result.exit_code == 0, result.output
+            assert len(first.installed) == len(second.installed) + 1 == 2
+            states = [job["state"] for job in client.jobs()]
+            assert states == ["done", "failed", "failed", "done", "done"]
+        finally:
+            DaemonClient(address).shutdown()
+            thread.join(10)
+    assert not thread.is_alive()
+    assert not os.path.exists(address)
+
+
+def test_async_adb(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    import time
+    from mass_apk.adb import Adb, AdbError, AdbTimeoutError
+    from mass_apk.aio import AsyncAdb
+    from benchmarks.simulator import DeviceConfig, SimulatedDevice
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    device = FakeDevice()
+    device.files["/data/app/com.a-1/base.apk"] = b"apk" * 100000
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def shell(cmd):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.5 if cmd == "sleep" else 0.05)
+        with lock:
+            running[0] -= 1
+        return "package:com.a\npackage:com.b\n", 0
+
+    device.shell = shell
+
+    async def socket_backend():
+        adb = AsyncAdb(backend="socket", max_commands=2).for_device(device.serial)
+        assert await adb.state() is Adb.ConnectionState.CONNECTED
+        assert await adb.devices() == [device.serial]
+        listings = await asyncio.gather(*(adb.list_device("3") for _ in range(6)))
+        assert listings == [["com.a", "com.b"]] * 6
+        assert (
+            await adb.pull("/data/app/com.a-1/base.apk", tmp_path / "a.apk") == 300000
+        )
+        with pytest.raises(AdbError):
+            await adb.pull("/data/app/missing.apk", tmp_path / "missing.apk")
+        assert not (tmp_path / "missing.apk").exists()
+        with pytest.raises(AdbTimeoutError):
+            await adb.shell("sleep", timeout=0.1)
+        await adb.push(tmp_path / "a.apk", ignore_errors=False)
+
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        asyncio.run(socket_backend())
+    # no more than `max_commands` shell commands ran at once
+    assert running[1] == 2
+    assert device.installed == [
+        ("cmd package install -d -r -S 300000", b"apk" * 100000)
+    ]
+
+    simulated = SimulatedDevice(str(tmp_path / "device"), DeviceConfig(packages=2))
+    simulated.create()
+    monkeypatch.setenv("MASS_APK_ADB", simulated.adb_path)
+
+    async def process_backend():
+        adb = AsyncAdb(serial=simulated.config.serial)
+        assert await adb.devices() == [simulated.config.serial]
+        packages = await adb.list_device("3")
+        assert packages == simulated.package_names()
+        size = await adb.pull(simulated.apk_path(packages[0]), tmp_path / "b.apk")
+        assert size == os.path.getsize(simulated.apk_path(packages[0]))
+
+    asyncio.run(process_backend())
+
+    # calls timing out or cancelled kill their adb process, a round trip
+    # to this device takes 30 seconds
+    slow = SimulatedDevice(
+        str(tmp_path / "slow"), DeviceConfig(packages=1, latency=30)
+    ).create()
+    monkeypatch.setenv("MASS_APK_ADB", slow.adb_path)
+
+    async def slow_device():
+        adb = AsyncAdb(timeout=0.5)
+        with pytest.raises(AdbTimeoutError):
+            await adb.devices()
+        task = asyncio.ensure_future(adb.devices(timeout=60))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    asyncio.run(slow_device())
+    assert time.monotonic() - start < 10
+
+
+def test_schedule_apks(tmp_path, caplog):
+    import logging
+    from mass_apk.helpers import MB
+    from mass_apk.schedule import InstallEstimator, read_priority, schedule_apks
+    from mass_apk.sources import ApkSource
+    from mass_apk.transfer import Progress
+
+    apks = [
+        ApkSource(name, size, None, None)
+        for name, size in [("a.apk", 10), ("b.apk", 300), ("c.apk", 20), ("d.apk", 300)]
+    ]
+    (tmp_path / "priority.txt").write_text("# critical first\nc\nmissing.apk\n")
+    priority = read_priority(tmp_path / "priority.txt")
+    assert priority == ["c", "missing"]
+
+    ordered = schedule_apks(apks, priority)
+    assert [apk.name for apk in ordered] == ["c.apk", "b.apk", "d.apk", "a.apk"]
+    assert [apk.name for apk in schedule_apks(apks)] == [
+        "b.apk",
+        "d.apk",
+        "c.apk",
+        "a.apk",
+    ]
+    # a small base apk with large split apks is as long to install as both
+    split = ApkSource("a/split_config.arm64_v8a.apk", 500, None, None)
+    apks[0] = apks[0]._replace(splits=(split,))
+    assert [apk.name for apk in schedule_apks(apks)] == [
+        "a.apk",
+        "b.apk",
+        "d.apk",
+        "c.apk",
+    ]
+
+    estimator = InstallEstimator(seconds_per_mb=1.0)
+    assert estimator.estimate(2 * MB) == 2.0
+    # 64 MB taking 3 s each on top of the 1 s/MB default of 64 MB
+    estimator.observe(64 * MB, 192.0)
+    assert estimator.seconds_per_mb == 2.0
+    # a device twice as fast as the estimate so far gets a shorter ETA
+    assert estimator.remaining(MB, 64 * MB, 64.0) < estimator.estimate(MB)
+
+    progress = Progress(2, "installed", total_bytes=2 * MB, estimator=estimator)
+    with caplog.at_level(logging.INFO, logger="mass_apk.transfer"):
+        progress.advance("a.apk", MB)
+    assert "installed ETA 0:02 ... a.apk" in caplog.text
+
+
+def test_parallel_zipify(tmp_path):
+    import zipfile
+    from mass_apk.helpers import balance
+    from mass_apk.ziptools import unzipify, zipify
+
+    assert balance([5, 1, 4, 2, 3], 2, lambda size: size) == [[5, 2, 1], [4, 3]]
+    assert balance([], 4, lambda size: size) == []
+
+    src = tmp_path / "backup"
+    src.mkdir()
+    for index in range(7):
+        (src / f"com.a{index}.apk").write_bytes(b"apk %d " % index * (20000 * index))
+    (src / "random.apk").write_bytes(os.urandom(100000))
+    (src / "manifest.json").write_text("{}")
+
+    zipify(src, tmp_path / "backup.zip", "auto", level=9, jobs=3)
+    zipify(src, tmp_path / "fast.zip", "deflated", level=1, jobs=1)
+    zipify(src, tmp_path / "small.zip", "deflated", level=9, jobs=1)
+    with zipfile.ZipFile(tmp_path / "backup.zip") as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == sorted(os.listdir(src))
+        assert zip_file.getinfo("random.apk").compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo("com.a6.apk").compress_type == zipfile.ZIP_DEFLATED
+    assert os.path.getsize(tmp_path / "small.zip") < os.path.getsize(
+        tmp_path / "fast.zip"
+    )
+
+    unzipify(tmp_path / "backup.zip", tmp_path / "restored", jobs=3)
+    for name in os.listdir(src):
+        assert (tmp_path / "restored" / name).read_bytes() == (src / name).read_bytes()
+
+
+def test_adaptive_limit(caplog):
+    import heapq
+    import logging
+    from mass_apk.adaptive import AdaptiveLimit
+    from mass_apk.adb import AdbError, parse_usb_buses
+    from mass_apk.helpers import MB
+    from mass_apk.metrics import metrics
+
+    assert parse_usb_buses(
+        "List of devices attached\n"
+        "0123456789ABCDEF\tdevice usb:1-1.2 product:x model:y device:z\n"
+        "emulator-5554\tdevice product:sdk model:sdk device:generic\n"
+        "FEDCBA\tunauthorized usb:3-2 transport_id:4\n"
+    ) == {"0123456789ABCDEF": "usb:1", "FEDCBA": "usb:3"}
+
+    now = [0.0]
+    limit = AdaptiveLimit("pull usb:1", clock=lambda: now[0])
+    in_flight, started, seen = [], 0, []
+    with caplog.at_level(logging.INFO, logger="mass_apk.adaptive"):
+        for _ in range(300):
+            while limit.in_flight < limit.limit:
+                slot = limit.slot()
+                slot.__enter__().bytes = MB
+                # the bus moves 3 MB/s shared by the pulls in flight
+                end = now[0] + max(1.0, limit.in_flight / 3)
+                heapq.heappush(in_flight, (end, started, slot))
+                started += 1
+            now[0], _, slot = heapq.heappop(in_flight)
+            slot.__exit__(None, None, None)
+            seen.append(limit.limit)
+    # no more pulls than the bus pays for, probing one above now and then
+    assert set(seen[-100:]) <= {3, 4, 5}
+    assert "pull usb:1 concurrency 2 -> 3, throughput grew" in caplog.text
+    assert metrics.gauges()[("concurrency_limit", "pull usb:1")] == limit.limit
+
+    before = limit.limit
+    with pytest.raises(AdbError):
+        with limit.slot():
+            raise AdbError("error: device offline")
+    assert limit.limit == max(before // 2, 1)
+    for _, _, slot in in_flight:
+        slot.__exit__(None, None, None)
+
+    # the bus moved a rejected apk fine
+    before = limit.limit
+    with pytest.raises(AdbError):
+        with limit.slot():
+            raise AdbError("Failure [INSTALL_FAILED_OLDER_SDK]")
+    assert limit.limit == before
+
+
+def test_store_deltas(tmp_path):
+    import io
+    import zipfile
+    from mass_apk.delta import apply_delta, encode_delta
+    from mass_apk.manifest import Manifest, ManifestEntry, sha256_file
+    from mass_apk.sources import open_sources
+    from mass_apk.store import ApkStore
+
+    def build(version):
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w") as zip_file:
+            zip_file.writestr("AndroidManifest.xml", b"manifest %d" % version)
+            zip_file.writestr("classes.dex", os.urandom(20000))
+            zip_file.writestr("lib/arm64-v8a/libapp.so", lib)
+            zip_file.writestr(
+                "assets/data.txt", b"asset\n" * 20000, zipfile.ZIP_DEFLATED
+            )
+        return out.getvalue()
+
+    lib = os.urandom(200000)
+    versions = [build(version) for version in (1, 2, 3)]
+
+    delta = io.BytesIO()
+    encode_delta(io.BytesIO(versions[1]), io.BytesIO(versions[0]), delta, "0" * 64)
+    assert len(delta.getvalue()) < len(versions[0]) // 5
+    rebuilt = io.BytesIO()
+    delta.seek(0)
+    apply_delta(io.BytesIO(versions[1]), delta, rebuilt)
+    assert rebuilt.getvalue() == versions[0]
+
+    store = ApkStore(tmp_path / "store").init()
+    shas = []
+    for index, content in enumerate(versions):
+        name = f"backup-{index}"
+        (tmp_path / name).write_bytes(content)
+        shas.append(store.add_file(str(tmp_path / name)))
+        store.save_backup(
+            name,
+            Manifest(
+                [
+                    ManifestEntry(
+                        "com.app", index, "t", len(content), shas[-1], "com.app.apk"
+                    )
+                ]
+            ),
+        )
+        # backups are ordered by manifest mtime
+        os.utime(os.path.join(store.backups_dir, f"{name}.json"), (index, index))
+        if index == 1:
+            encoded, saved = store.compact()
+            assert encoded == 1 and saved > len(versions[0]) * 0.8
+            assert not store.has_full(shas[0]) and store.has(shas[0])
+
+    # older deltas are encoded again against the newest version
+    assert store.compact()[0] == 2
+    assert store.has_full(shas[2]) and not store.has_full(shas[1])
+    assert store.compact() == (0, 0)
+    assert store.gc() == (0, 0)
+
+    with open_sources(store.root, "backup-0") as sources:
+        with sources[0].open() as in_file:
+            assert in_file.read() == versions[0]
+    store.materialize("backup-1", tmp_path / "copy")
+    assert sha256_file(tmp_path / "copy" / "com.app.apk") == shas[1]
+
+
+def test_store_compact_keeps_rejected_deltas_full(tmp_path):
+    import io
+    import zipfile
+    from mass_apk.manifest import Manifest, ManifestEntry
+    from mass_apk.store import ApkStore
+
+    def build(*contents):
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w") as zip_file:
+            for index, content in enumerate(contents):
+                zip_file.writestr(f"entry-{index}", content)
+        return out.getvalue()
+
+    # versions sharing fewer entries the further apart they are
+    a, b, c, d, e, f, A, B, E, F = (os.urandom(50000) for _ in range(10))
+    versions = [build(a, b, c, d, e, f), build(a, b, c, d, E, F)]
+    versions.append(build(A, B, c, d, E, F))
+
+    store = ApkStore(tmp_path / "store").init()
+    shas = []
+    for index, content in enumerate(versions):
+        name = f"backup-{index}"
+        (tmp_path / name).write_bytes(content)
+        shas.append(store.add_file(str(tmp_path / name)))
+        entry = ManifestEntry("com.app", index, "t", len(content), shas[-1], "a.apk")
+        store.save_backup(name, Manifest([entry]))
+        os.utime(os.path.join(store.backups_dir, f"{name}.json"), (index, index))
+        store.compact()
+
+    # the first version differs too much from the newest to stay a delta
+    # against the second, which is a delta itself now
+    assert store.has_full(shas[0]) and not store.has_full(shas[1])
+    for sha256, content in zip(shas, versions):
+        with store.open_blob(sha256) as in_file:
+            assert in_file.read() == content
+
+
+def test_stream_restore(tmp_path, monkeypatch):
+    import io
+    from mass_apk.adb import Adb
+    from mass_apk.commands import (
+        IncompleteRestoreError,
+        restore_journal_path,
+        restore_journaled,
+        restore_stream,
+    )
+    from mass_apk.exceptions import MassApkError
+    from mass_apk.manifest import Manifest, ManifestEntry
+    from mass_apk.sources import folder_sources
+    from mass_apk.ziptools import TarSink
+    from tests.apk_builder import build_apk
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    stream = io.BytesIO()
+    sink = TarSink(stream)
+    manifest = Manifest()
+    for package, version in [("com.a", 5), ("com.b", 3), ("com.c", 1)]:
+        (tmp_path / f"{package}.apk").write_bytes(build_apk(package, version))
+        sink.add_file(tmp_path / f"{package}.apk", f"{package}.apk")
+        manifest.add(ManifestEntry(package, version, "t", 0, "", f"{package}.apk"))
+    sink.writestr("manifest.json", manifest.to_json())
+    sink.close()
+    complete = stream.getvalue()
+
+    def shell(cmd):
+        if cmd == "pm list packages --show-versioncode":
+            return "package:com.a versionCode:5\npackage:com.b versionCode:2\n", 0
+        return "Success\n", 0
+
+    device = FakeDevice()
+    device.shell = shell
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        # a non seekable pipe
+        reader = io.BufferedReader(io.BytesIO(complete))
+        reader.seekable = lambda: False
+        summary = restore_stream(adb, reader)
+        assert summary.endswith(" MB, 1 up to date")
+        assert [data for _, data in device.installed] == [
+            (tmp_path / "com.b.apk").read_bytes(),
+            (tmp_path / "com.c.apk").read_bytes(),
+        ]
+
+        # an interrupted back up ends before its manifest
+        cut = complete.index(b"manifest.json") - 512
+        with pytest.raises(MassApkError, match="truncated"):
+            restore_stream(adb, io.BytesIO(complete[:cut]), force=True)
+        # apks before the cut are installed as they arrived
+        assert [data for _, data in device.installed[2:4]] == [
+            (tmp_path / "com.a.apk").read_bytes(),
+            (tmp_path / "com.b.apk").read_bytes(),
+        ]
+
+        # a rejected apk fails the restore once the others are installed
+        rejected = (tmp_path / "com.b.apk").read_bytes()
+        device.install_output = lambda cmd, data: (
+            "Failure [INSTALL_FAILED_OLDER_SDK]\n" if data == rejected else "Success\n"
+        )
+        del device.installed[:]
+        with pytest.raises(IncompleteRestoreError, match="1 failed: com.b$"):
+            restore_stream(adb, io.BytesIO(complete), force=True)
+        assert len(device.installed) == 3
+        journaled = tmp_path / "backup"
+        with pytest.raises(IncompleteRestoreError, match="1 failed: com.b.apk$"):
+            apks = folder_sources(tmp_path)
+            restore_journaled(adb, journaled, apks, 1, False, force=True)
+        # kept to retry the failed apk
+        assert os.path.exists(restore_journal_path(journaled, adb.serial))
+
+
+def test_split_apks(tmp_path, monkeypatch, caplog):
+    import io
+    import itertools
+    import logging
+    import pathlib
+    import tarfile
+    from mass_apk.adb import Adb
+    from mass_apk.commands import backup_device, restore_device, restore_stream
+    from mass_apk.manifest import Manifest
+    from mass_apk.sources import open_sources, stream_sources
+    from mass_apk.store import ApkStore
+    from mass_apk.ziptools import TarSink
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    apks = {
+        "/data/app/com.a/base.apk": b"a" * 100,
+        "/data/app/com.a/split_config.en.apk": b"en" * 10,
+        "/data/app/com.b/base.apk": b"b" * 50,
+    }
+    device = FakeDevice()
+    device.files.update(apks)
+    sessions = itertools.count(100)
+
+    def shell(cmd):
+        if cmd.startswith("pm list packages -f"):
+            return "".join(f"package:{p}={p.split('/')[3]}\n" for p in apks), 0
+        if cmd.startswith("pm list packages"):
+            return "package:com.a\npackage:com.b\n", 0
+        if "install-create" in cmd:
+            return f"Success: created install session [{next(sessions)}]\n", 0
+        if cmd.startswith("cmd package"):
+            return "Success\n", 0
+        return "", 1
+
+    def installed():
+        # the two apks of com.a are written to one session, com.b is pushed
+        writes = sorted(data for _, data in device.installed)
+        del device.installed[:]
+        return writes
+
+    device.shell = shell
+    path = pathlib.Path(tmp_path / "backup")
+    stream = io.BytesIO()
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        backup_device(adb, path, "3", False, 1)
+        assert (path / "com.a" / "split_config.en.apk").read_bytes() == b"en" * 10
+        (split,) = Manifest.load(path).get("com.a").splits
+        assert (split.file, split.size) == ("com.a/split_config.en.apk", 20)
+        assert Manifest.load(path).get("com.b").splits == ()
+
+        backup_device(adb, tmp_path / "archive", "3", True, 1)
+        store = ApkStore(tmp_path / "store").init()
+        store.ingest(path, "backup")
+        for backup in (path, tmp_path / "archive.zip", store.root):
+            with open_sources(backup) as sources:
+                assert [apk.name for apk in sources] == ["com.a.apk", "com.b.apk"]
+                assert [apk.name for apk in sources[0].splits] == [split.file]
+                restore_device(adb, sources, force=True)
+            assert installed() == [b"a" * 100, b"b" * 50, b"en" * 10]
+
+        # a folder without a manifest
+        os.remove(path / "manifest.json")
+        with open_sources(path) as sources:
+            assert [apk.name for apk in sources[0].splits] == [split.file]
+
+        backup_device(adb, tmp_path / "stream", "3", False, 1, stream=stream)
+        stream.seek(0)
+        restore_stream(adb, stream, force=True)
+        assert installed() == [b"a" * 100, b"b" * 50, b"en" * 10]
+
+    # a split apk whose base apk never arrives isn't installed on its own
+    orphaned = io.BytesIO()
+    sink = TarSink(orphaned)
+    sink.writestr("org.z/split_config.en.apk", b"z" * 10)
+    stream.seek(0)
+    with tarfile.open(fileobj=stream, mode="r|") as tar_file:
+        for member in tar_file:
+            data = tar_file.extractfile(member)
+            assert data is not None
+            sink.writestr(member.name, data.read())
+    sink.close()
+    orphaned.seek(0)
+    with caplog.at_level(logging.WARNING, logger="mass_apk.sources"):
+        assert [apk.name for apk in stream_sources(orphaned)] == [
+            "com.a.apk",
+            "com.b.apk",
+        ]
+    assert "org.z/split_config.en.apk" in caplog.text
+
+
+def test_timeouts_and_retries(tmp_path, monkeypatch):
+    import pathlib
+    import time
+    from mass_apk.adb import Adb, AdbError, AdbTimeoutError, Timeouts
+    from mass_apk.commands import IncompleteBackupError, backup_device
+    from mass_apk.manifest import Manifest
+    from mass_apk.retry import RetryPolicy, call_with_retry, is_transient
+    from tests.fake_adb_server import FakeAdbServer, FakeDevice
+
+    # an adb stuck on a flaky cable is killed, not waited for
+    hung = tmp_path / "adb"
+    hung.write_text("#!/bin/sh\nsleep 30\n")
+    hung.chmod(0o755)
+    monkeypatch.setenv("MASS_APK_ADB", str(hung))
+    adb = Adb(shell_sessions=0, timeouts=Timeouts(0.5, 0.5))
+    start = time.monotonic()
+    with pytest.raises(AdbTimeoutError):
+        adb.exec_command("get-state")
+    with pytest.raises(AdbTimeoutError):
+        adb.shell("pm list packages")
+    assert time.monotonic() - start < 10
+
+    assert is_transient(AdbTimeoutError("pull timed out"))
+    assert is_transient(AdbError("error: device offline"))
+    assert not is_transient(AdbError("Failure [INSTALL_FAILED_INSUFFICIENT_STORAGE]"))
+    assert not is_transient(
+        AdbError(
+            "adb: error: failed to copy '/a.apk' to 'a.apk': remote object "
+            "'/a.apk' does not exist"
+        )
+    )
+
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise AdbError("error: device offline")
+        return "pulled"
+
+    delays = []
+    assert call_with_retry(flaky, "pull", "dev", sleep=delays.append) == "pulled"
+    assert len(delays) == 2 and delays[0] <= 1.0 and delays[1] <= 2.0
+
+    def rejected():
+        calls.append(1)
+        raise AdbError("Failure [INSTALL_FAILED_OLDER_SDK]")
+
+    del calls[:]
+    with pytest.raises(AdbError, match="OLDER_SDK"):
+        call_with_retry(rejected, "install", "dev", sleep=delays.append)
+    assert len(calls) == 1
+    with pytest.raises(AdbError, match="offline"):
+        call_with_retry(flaky, "pull", "dev", RetryPolicy(1), sleep=delays.append)
+
+    # one failed pull doesn't stop the others
+    packages = ("com.a", "com.b", "com.c")
+    device = FakeDevice()
+    for name in ("com.a", "com.c"):
+        device.files[f"/data/app/{name}/base.apk"] = name.encode() * 100
+
+    def shell(cmd):
+        if cmd.startswith("pm list packages -f"):
+            return (
+                "".join(
+                    f"package:/data/app/{name}/base.apk={name}\n" for name in packages
+                ),
+                0,
+            )
+        if cmd.startswith("pm list packages"):
+            return "".join(f"package:{name}\n" for name in packages), 0
+        return "", 1
+
+    device.shell = shell
+    path = pathlib.Path(tmp_path / "backup")
+    with FakeAdbServer([device]) as server:
+        monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.port))
+        adb = Adb(backend="socket")
+        with pytest.raises(IncompleteBackupError, match="1 failed: com.b"):
+            backup_device(adb, path, "3", False, 1, keep_going=True)
+    assert sorted(entry.package for entry in Manifest.load(path)) == ["com.a", "com.c"]